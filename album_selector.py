@@ -1,37 +1,46 @@
-import os
 import json
 import random
 import logging
 
+from sys import intern
+from bisect import bisect_left, bisect_right, insort
 from pathlib import Path
 from datetime import datetime, timedelta
 
-dir_path = Path(__file__).parent.resolve()
+from sampler import DEFAULT_WINDOW, SAMPLERS, bin_weights
+from safe_io import atomic_write
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename=dir_path / "logs" / "album_selection.log",
-                    encoding="utf-8",
-                    format='%(asctime)s %(levelname)s: %(message)s',
-                    datefmt="%Y-%m-%d %H:%M:%S",
-                    level=logging.DEBUG)
+
+# albums submitted within this distance of a bin's start share the bin
+BIN_WINDOW = timedelta(hours=16)
 
 
 class Album():
+    # a queue holds many albums, so no per-instance __dict__
+    __slots__ = ('title', 'artist', 'submitted_on', 'submitted_by', 'date',
+                 'chosen_on', 'image', 'mbid')
+
     def __init__(self, title: str, artist: str,
                  submitted_on: datetime = None,
                  submitted_by: str = "",
                  date: str = "",
                  chosen_on: datetime = datetime.min,
-                 image: str = ""):
+                 image: str = "",
+                 mbid: str = ""):
         self.title = title
-        self.artist = artist
+        # artists and submitters repeat across the queue; share one copy
+        self.artist = intern(artist) if type(artist) is str else artist
         self.submitted_on = submitted_on
         if submitted_on is None:
             self.submitted_on = datetime.now()
-        self.submitted_by = submitted_by
+        self.submitted_by = intern(submitted_by) \
+            if type(submitted_by) is str else submitted_by
 
         self.date = date
         self.chosen_on = chosen_on
         self.image = image
+        self.mbid = mbid
 
     def to_dict(self):
         return {
@@ -41,7 +50,8 @@ class Album():
             'submitted_by': self.submitted_by,
             'chosen_on': self.chosen_on.isoformat(),
             'image': self.image,
-            'date': self.date
+            'date': self.date,
+            'mbid': self.mbid
         }
 
     @classmethod
@@ -54,7 +64,8 @@ class Album():
                 album_info.get("submitted_on")),
             chosen_on=datetime.fromisoformat(album_info.get("chosen_on")),
             image=album_info.get("image", ""),
-            date=album_info.get("date", "")
+            date=album_info.get("date", ""),
+            mbid=album_info.get("mbid", "")
         )
 
     @classmethod
@@ -72,17 +83,59 @@ class Album():
 
 
 class Bin():
+    __slots__ = ('_elements', '_rows', '_decode', 'start', 'id')
+
     def __init__(self, start: datetime, id: int):
-        self.elements: list[Album] = []
+        self._elements: list[Album] = []
+        self._rows = None
+        self._decode = None
         self.start = start
         self.id = id
 
+    @classmethod
+    def lazy(cls, start: datetime, id: int, rows: list, decode):
+        # A bin whose albums are only decoded, with decode(row), when
+        # `elements` is first used. The selector only needs the length of
+        # most bins, and codec.py can write the rows out again as they are.
+        bin = cls(start, id)
+        bin._rows = rows
+        bin._decode = decode
+        return bin
+
+    @property
+    def elements(self) -> list[Album]:
+        if self._rows is not None:
+            decode = self._decode
+            self._elements = [decode(row) for row in self._rows]
+            self._rows = None
+        return self._elements
+
+    @elements.setter
+    def elements(self, albums: list[Album]):
+        self._elements = albums
+        self._rows = None
+
+    def rows(self) -> list | None:
+        # the undecoded rows, or None once the albums have been decoded
+        return self._rows
+
+    def copy(self):
+        if self._rows is not None:
+            return Bin.lazy(self.start, self.id, list(self._rows),
+                            self._decode)
+        newBin = Bin(self.start, self.id)
+        newBin.elements = list(self._elements)
+        return newBin
+
     def is_album_valid_entry(self, album: Album) -> bool:
-        return abs(album.submitted_on - self.start) < timedelta(hours=16)
+        return abs(album.submitted_on - self.start) < BIN_WINDOW
 
     def add_album(self, album: Album):
         self.elements.append(album)
 
+    def pop_album(self, idx: int) -> Album:
+        return self.elements.pop(idx)
+
     def to_dict(self):
         return {
             'elements': [album.to_dict() for album in self.elements],
@@ -101,7 +154,9 @@ class Bin():
         return newBin
 
     def __len__(self) -> int:
-        return len(self.elements)
+        if self._rows is not None:
+            return len(self._rows)
+        return len(self._elements)
 
     def __eq__(self, other):
         if not isinstance(other, Bin):
@@ -111,28 +166,98 @@ class Bin():
 
 
 class UpcomingAlbums():
-    def __init__(self):
+    def __init__(self, window: int = DEFAULT_WINDOW,
+                 sampler: str = 'cumulative',
+                 rng: random.Random = None, seed: int = None):
         self.bins: list[Bin] = []
         self.next_id: int = 1
         self.streak_len: int = 0
         self.streak_id: int = -1
 
+        self.window = window
+        self.sampler = sampler
+        # the global random module unless an rng or seed is given, so picks
+        # can be replayed
+        self.rng = rng
+        if rng is None:
+            self.rng = random if seed is None else random.Random(seed)
+        # bumped on every change to the bins; together with the streak and
+        # window it decides whether the cached sampler is still valid
+        self._version: int = 0
+        self._sampler_key = None
+        self._sampler_cache = None
+
+        # (start, seq) for every bin, sorted by start. seq is the bin's
+        # position in creation order, so the lowest seq among the bins whose
+        # window contains an album is the bin a linear scan would find first.
+        self._bin_index: list[tuple[datetime, int]] = []
+        self._bins_by_seq: dict[int, Bin] = {}
+        self._seq_by_id: dict[int, int] = {}
+        self._next_seq: int = 0
+
+        # kept up to date by append_bin/add_album/get_next_album
+        self._length: int = 0
+
     def length_queue(self) -> int:
-        return sum([len(bin) for bin in self.bins])
+        return self._length
+
+    def stats(self, now: datetime = None) -> dict:
+        if now is None:
+            now = datetime.now()
+        oldest_age = None
+        if self._bin_index:
+            oldest_age = (now - self._bin_index[0][0]).total_seconds()
+        return {
+            'queue_length': self._length,
+            'bin_count': len(self.bins),
+            'oldest_bin_age': oldest_age,
+            'streak_id': self.streak_id,
+            'streak_len': self.streak_len,
+        }
 
-    def add_album(self, album: Album):
+    def append_bin(self, bin: Bin):
+        seq = self._next_seq
+        self._next_seq += 1
+        self.bins.append(bin)
+        self._bins_by_seq[seq] = bin
+        self._seq_by_id[bin.id] = seq
+        insort(self._bin_index, (bin.start, seq))
+        self._length += len(bin)
+        self._version += 1
+
+    def remove_bin(self, idx: int) -> Bin:
+        bin = self.bins.pop(idx)
+        seq = self._seq_by_id.pop(bin.id)
+        del self._bins_by_seq[seq]
+        pos = bisect_left(self._bin_index, (bin.start, seq))
+        del self._bin_index[pos]
+        self._length -= len(bin)
+        self._version += 1
+        return bin
+
+    def find_bin(self, album: Album) -> Bin | None:
+        # bins strictly inside (submitted_on - window, submitted_on + window)
+        lo = bisect_right(self._bin_index,
+                          (album.submitted_on - BIN_WINDOW, float('inf')))
+        hi = bisect_left(self._bin_index,
+                         (album.submitted_on + BIN_WINDOW, -1))
+        if lo >= hi:
+            return None
+        seq = min(seq for _, seq in self._bin_index[lo:hi])
+        return self._bins_by_seq[seq]
+
+    def add_album(self, album: Album) -> Bin:
+        # returns the bin the album went into
         logger.debug("Adding album %s", album.title)
-        added = False
-        for bin in self.bins:
-            if bin.is_album_valid_entry(album):
-                bin.add_album(album)
-                added = True
-                break
-        if not added:
-            newBin = Bin(album.submitted_on, self.next_id)
+        bin = self.find_bin(album)
+        if bin is None:
+            bin = Bin(album.submitted_on, self.next_id)
             self.next_id += 1
-            newBin.add_album(album)
-            self.bins.append(newBin)
+            self.append_bin(bin)
+        bin.add_album(album)
+        self._length += 1
+        self._version += 1
+        return bin
 
     def get_next_album(self) -> Album:
         if self.length_queue() == 0:
@@ -142,49 +267,33 @@ class UpcomingAlbums():
         selected_bin_idx = self.select_random_bin_idx()
 
         selected_bin = self.bins[selected_bin_idx]
-        r_idx = random.randrange(len(selected_bin.elements))
-        album = self.bins[selected_bin_idx].elements.pop(r_idx)
-        if len(self.bins[selected_bin_idx].elements) == 0:
-            self.bins.pop(selected_bin_idx)
+        r_idx = self.rng.randrange(len(selected_bin.elements))
+        album = selected_bin.pop_album(r_idx)
+        self._length -= 1
+        self._version += 1
+        if len(selected_bin) == 0:
+            self.remove_bin(selected_bin_idx)
 
         return album
 
+    def get_sampler(self):
+        key = (self._version, self.window, self.sampler,
+               self.streak_id, self.streak_len)
+        if key != self._sampler_key:
+            weights = bin_weights(self.bins, self.streak_id,
+                                  self.streak_len, self.window)
+            self._sampler_cache = SAMPLERS[self.sampler](weights)
+            self._sampler_key = key
+        return self._sampler_cache
+
     def select_random_bin_idx(self) -> int:
         logger.debug("Selecting random bin index")
 
-        num_bins = min(len(self.bins), 6)
-        relative_odds = [1 for _ in range(num_bins)]
-
-        # iterate backwards with second to last idx
-        for i in range(num_bins - 2, -1, -1):
-            bin = self.bins[i]
-            mult = len(bin) + 1
-            if self.streak_id == bin.id:
-                mult -= self.streak_len
-                if mult < 1:
-                    mult = pow(2, mult)
-            relative_odds[i] = mult * relative_odds[i + 1]
+        sampler = self.get_sampler()
+        logger.debug("random bin idx relative weights %s", sampler.weights)
+        idx = sampler.draw(self.rng)
 
-        probabilities = [p / sum(relative_odds) for p in relative_odds]
-        logger.debug(f"random bin idx relative probabilities {probabilities}")
-
-        random_value = random.random()
-        logger.debug(f"random value selected: {random_value}")
-
-        for idx, p in enumerate(probabilities):
-            if random_value >= p:
-                random_value -= p
-                continue
-
-            bin = self.bins[idx]
-            if self.streak_id == bin.id:
-                self.streak_len += 1
-            else:
-                self.streak_id = bin.id
-                self.streak_len = 1
-            return idx
-
-        bin = self.bins[0]
+        bin = self.bins[idx]
         if self.streak_id == bin.id:
             self.streak_len += 1
         else:
@@ -192,52 +301,83 @@ class UpcomingAlbums():
             self.streak_len = 1
         return idx
 
-    def backup(self, filepath: str | Path):
-        os.makedirs(filepath, exist_ok=True)
-        now = datetime.now()
-        timestamp = now.strftime("%Y%m%d_%H%M%S")
+    def sample_bin_indices(self, k: int) -> list[int]:
+        # k independent draws from the current state, without touching the
+        # streak or the rng, so the picks that follow don't change;
+        # useful for looking at the selection odds
+        rng = random.Random()
+        rng.setstate(self.rng.getstate())
+        return self.get_sampler().draw_many(k, rng)
+
+    def copy(self, rng: random.Random = None, keep=None):
+        # keep(album) -> bool limits the copy to some albums; bins left empty
+        # are dropped
+        if rng is None:
+            rng = random.Random()
+            rng.setstate(self.rng.getstate())
+        upcoming = UpcomingAlbums(self.window, self.sampler, rng=rng)
+        for bin in self.bins:
+            if keep is None:
+                # undecoded bins stay undecoded
+                upcoming.append_bin(bin.copy())
+                continue
+            newBin = Bin(bin.start, bin.id)
+            newBin.elements = [album for album in bin.elements
+                               if keep(album)]
+            if newBin.elements:
+                upcoming.append_bin(newBin)
+        upcoming.next_id = self.next_id
+        upcoming.streak_len = self.streak_len
+        upcoming.streak_id = self.streak_id
+        return upcoming
 
-        data = {
-            'bins': [bin.to_dict() for bin in self.bins],
-            'next_id': self.next_id,
-            'streak_len': self.streak_len,
-            'streak_id': self.streak_id,
-        }
-        output = f"upcoming_{timestamp}.json"
-        with open(filepath / output, 'w') as fp:
-            json.dump(data, fp, indent=2)
+    def preview(self, k: int) -> list[Album]:
+        # the next k picks, drawn on a copy so the queue itself is untouched.
+        # The copy starts from the same rng state, so these are the albums
+        # get_next_album will return unless the queue changes in between.
+        upcoming = self.copy()
+        albums = []
+        for _ in range(k):
+            album = upcoming.get_next_album()
+            if album is None:
+                break
+            albums.append(album)
+        return albums
 
-    def save(self, filename: str | Path):
-        data = {
+    def to_dict(self):
+        return {
             'bins': [bin.to_dict() for bin in self.bins],
             'next_id': self.next_id,
             'streak_len': self.streak_len,
             'streak_id': self.streak_id,
         }
-        with open(filename, 'w') as fp:
-            json.dump(data, fp, indent=2)
+
+    def save(self, filename: str | Path, fmt: str = "json"):
+        # minified, in one of codec.py's formats
+        import codec
+        atomic_write(filename, codec.dump_queue(self, fmt))
 
     @classmethod
-    def load_from_file(cls, filename: Path, backup: Path):
+    def load_from_file(cls, filename: Path, **kwargs):
+        import codec
 
         # no file exists, init
         if not filename.is_file():
-            obj = cls()
+            obj = cls(**kwargs)
             obj.save(filename)
             return obj
 
-        with open(filename, 'r') as fp:
-            data = json.load(fp)
+        with open(filename, 'rb') as fp:
+            return codec.load_queue(fp.read(), **kwargs)
 
-        upcoming = cls()
+    @classmethod
+    def load_from_dict(cls, data: dict, **kwargs):
+        upcoming = cls(**kwargs)
         for bin_data in data.get('bins', []):
-            upcoming.bins.append(Bin.from_dict(bin_data))
+            upcoming.append_bin(Bin.from_dict(bin_data))
         upcoming.next_id = data.get('next_id', 1)
         upcoming.streak_len = data.get('streak_len', 0)
         upcoming.streak_id = data.get('streak_id', -1)
-
-        upcoming.backup(backup)
-
         return upcoming
 
     def __eq__(self, other):
@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import helper
+from search import normalize
+from metadata_cache import MetadataCache
+
+logger = logging.getLogger(__name__)
+
+LASTFM_URL = "http://ws.audioscrobbler.com/2.0/"
+MUSICBRAINZ_URL = "https://musicbrainz.org/ws/2/"
+COVERART_URL = "http://coverartarchive.org/"
+# MusicBrainz rejects anonymous clients
+USER_AGENT = "album_of_the_week/1.0 " \
+    "(https://github.com/connoraubry/album_of_the_week)"
+
+# (connect, read) seconds
+TIMEOUT = (3.05, 10)
+RETRIES = 2
+BACKOFF = 0.3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# connections kept alive per host
+POOL_SIZE = 8
+# answers that are cached as misses
+MISSING_STATUSES = (404, 410)
+# file downloads
+CHUNK_SIZE = 64 * 1024
+MAX_DOWNLOAD_BYTES = int(os.environ.get("AOTW_MAX_ARTWORK_MB", 20)) * 2 ** 20
+RESUME_ATTEMPTS = 3
+
+
+class UpstreamError(Exception):
+    # a lookup that failed, as opposed to one upstream had no answer for
+    pass
+
+
+class Download():
+    # a finished download, not yet moved into place
+    def __init__(self, path: Path, sha256: str, size: int,
+                 content_type: str):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.content_type = content_type
+
+
+def _no_matches(value: dict) -> bool:
+    # Last.fm answers unknown names with an empty list
+    return not value.get("results", {}).get("albummatches", {}).get("album")
+
+
+def _no_top_albums(value: dict) -> bool:
+    return not value.get("topalbums", {}).get("album")
+
+
+class Client():
+    # Last.fm, MusicBrainz and Cover Art Archive behind one keep-alive
+    # session. GETs are retried with exponential backoff on connection
+    # errors and 429/5xx. Every call returns None when the service can't be
+    # reached or answers with an error, so callers only check for that.
+    # With a MetadataCache, answers and definite misses are reused across
+    # processes; errors are never cached.
+    def __init__(self, lastfm_url: str = LASTFM_URL,
+                 musicbrainz_url: str = MUSICBRAINZ_URL,
+                 coverart_url: str = COVERART_URL,
+                 api_key: str = None, timeout=TIMEOUT,
+                 retries: int = RETRIES, backoff: float = BACKOFF,
+                 pool_size: int = POOL_SIZE, cache: MetadataCache = None,
+                 resume_attempts: int = RESUME_ATTEMPTS):
+        self.lastfm_url = lastfm_url
+        self.musicbrainz_url = musicbrainz_url
+        self.coverart_url = coverart_url
+        self.timeout = timeout
+        self.backoff = backoff
+        self.resume_attempts = resume_attempts
+        self.cache = cache
+        self._api_key = api_key
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset(["GET"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def api_key(self) -> str:
+        # read late so load_dotenv() after import still applies
+        if self._api_key is not None:
+            return self._api_key
+        return os.environ.get("LASTFM_API_KEY", "")
+
+    def fetch(self, url: str, params: dict = None) -> tuple[bytes | None,
+                                                            bool]:
+        # (body, missing): missing is True when the body is None because
+        # upstream doesn't have it, rather than because of an error
+        try:
+            response = self.session.get(url, params=params,
+                                        timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.error("Request to %s failed: %s", url, e)
+            return None, False
+        if response.status_code in MISSING_STATUSES:
+            return None, True
+        if not response.ok:
+            logger.warning("%s answered %s", url, response.status_code)
+            return None, False
+        return response.content, False
+
+    def lookup(self, endpoint: str, key: str, url: str, params: dict = None,
+               parse=None, empty=None):
+        # body (or parse(body)) for url, through the cache; empty(value)
+        # marks answers that are cached as misses
+        cache = self.cache
+        if cache is not None:
+            found, body = cache.get(endpoint, key)
+            if found:
+                return body if body is None or parse is None \
+                    else parse(body)
+
+        body, missing = self.fetch(url, params)
+        value = body
+        if body is not None and parse is not None:
+            try:
+                value = parse(body)
+            except ValueError:
+                logger.error("%s answered with invalid JSON", url)
+                return None
+            if isinstance(value, dict) and "error" in value:
+                # Last.fm reports bad keys and the like in the body
+                logger.warning("%s answered %s", url, value.get("message"))
+                return None
+        if cache is not None and (body is not None or missing):
+            negative = body is None or (empty is not None and empty(value))
+            cache.put(endpoint, key, body, negative)
+        return value
+
+    def album_search(self, title: str, api_key: str = None) -> dict | None:
+        return self.lookup("album.search", normalize(title),
+                           self.lastfm_url, {
+                               "method": "album.search",
+                               "album": title,
+                               "api_key": api_key or self.api_key,
+                               "format": "json",
+                           }, parse=json.loads, empty=_no_matches)
+
+    def artist_top_albums(self, artist: str,
+                          api_key: str = None) -> dict | None:
+        return self.lookup("artist.gettopalbums", normalize(artist),
+                           self.lastfm_url, {
+                               "method": "artist.gettopalbums",
+                               "artist": artist,
+                               "api_key": api_key or self.api_key,
+                               "format": "json",
+                           }, parse=json.loads, empty=_no_top_albums)
+
+    def release(self, mbid: str) -> dict | None:
+        return self.lookup("release", mbid.lower(),
+                           f"{self.musicbrainz_url}release/{mbid}",
+                           {"fmt": "json"}, parse=json.loads)
+
+    def cover_art_url(self, mbid: str) -> str:
+        return f"{self.coverart_url}release/{mbid}/front"
+
+    def stream(self, url: str, directory: Path, accept=None,
+               max_bytes: int = None) -> tuple[Download | None, bool]:
+        # Stream url into a temporary file in directory, (download,
+        # missing) as for fetch(). accept(head) checks the first bytes.
+        # A transfer cut off part way is resumed with a Range request.
+        max_bytes = MAX_DOWNLOAD_BYTES if max_bytes is None else max_bytes
+        directory.mkdir(parents=True, exist_ok=True)
+        part = directory / f".{os.getpid()}-{threading.get_ident()}.part"
+        digest = hashlib.sha256()
+        size = 0
+        content_type = ""
+        try:
+            with open(part, "wb") as fp:
+                for attempt in range(self.resume_attempts):
+                    if attempt:
+                        time.sleep(self.backoff * 2 ** (attempt - 1))
+                    headers = {"Range": f"bytes={size}-"} if size else {}
+                    try:
+                        with self.session.get(url, headers=headers,
+                                              timeout=self.timeout,
+                                              stream=True) as response:
+                            if response.status_code in MISSING_STATUSES:
+                                return None, True
+                            if not response.ok:
+                                logger.warning("%s answered %s", url,
+                                               response.status_code)
+                                return None, False
+                            if size and response.status_code != 206:
+                                # range ignored, start over
+                                fp.seek(0)
+                                fp.truncate()
+                                digest = hashlib.sha256()
+                                size = 0
+
+                            content_type = response.headers.get(
+                                "Content-Type", "").split(";")[0].strip()
+                            if content_type.split("/")[0] not in \
+                                    ("image", "application", ""):
+                                logger.warning("%s is %s, not an image",
+                                               url, content_type)
+                                return None, True
+                            length = response.headers.get("Content-Length")
+                            if length is not None and \
+                                    size + int(length) > max_bytes:
+                                logger.warning("%s is over %d bytes", url,
+                                               max_bytes)
+                                return None, True
+
+                            for chunk in response.iter_content(CHUNK_SIZE):
+                                if size == 0 and accept is not None and \
+                                        not accept(chunk):
+                                    logger.warning("%s is not an image",
+                                                   url)
+                                    return None, True
+                                size += len(chunk)
+                                if size > max_bytes:
+                                    logger.warning("%s is over %d bytes",
+                                                   url, max_bytes)
+                                    return None, True
+                                fp.write(chunk)
+                                digest.update(chunk)
+                    except requests.RequestException as e:
+                        logger.warning("Download of %s interrupted at %d "
+                                       "bytes: %s", url, size, e)
+                        continue
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                    download = Download(part, digest.hexdigest(), size,
+                                        content_type)
+                    part = None
+                    return download, False
+            logger.error("Giving up on %s", url)
+            return None, False
+        finally:
+            # anything not handed over is incomplete
+            if part is not None:
+                part.unlink(missing_ok=True)
+
+    def fetch_file(self, endpoint: str, key: str, url: str,
+                   directory: Path, store, accept=None,
+                   refresh: bool = False) -> dict | None:
+        # Download url and hand the finished file to store(download), which
+        # moves it into place and returns where (a path, say). The result
+        # is cached with the file's checksum:
+        # {"stored": ..., "sha256": ..., "size": ..., "content_type": ...}
+        cache = self.cache
+        if cache is not None and not refresh:
+            found, body = cache.get(endpoint, key)
+            if found:
+                return None if body is None else json.loads(body)
+
+        download, missing = self.stream(url, directory, accept)
+        record = None
+        if download is not None:
+            try:
+                stored = store(download)
+            except ValueError as e:
+                logger.warning("Discarding %s: %s", url, e)
+                missing = True
+            else:
+                record = {"stored": stored, "sha256": download.sha256,
+                          "size": download.size,
+                          "content_type": download.content_type}
+            finally:
+                download.path.unlink(missing_ok=True)
+        if cache is not None and (record is not None or missing):
+            body = json.dumps(record).encode() if record else None
+            cache.put(endpoint, key, body)
+        return record
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncClient():
+    # asyncio front end to a Client, for the loader and the enricher, which
+    # gather several lookups at once. Calls run on a thread pool sized to
+    # the connection pool, so every event loop shares the same keep-alive
+    # connections and the number of lookups in flight is bounded per
+    # process.
+    def __init__(self, client: Client = None, max_workers: int = POOL_SIZE):
+        self.client = client if client is not None else Client()
+        self._executor = ThreadPoolExecutor(max_workers,
+                                            thread_name_prefix="api")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          partial(func, *args))
+
+    async def album_search(self, title: str,
+                           api_key: str = None) -> dict | None:
+        return await self._run(self.client.album_search, title, api_key)
+
+    async def artist_top_albums(self, artist: str,
+                                api_key: str = None) -> dict | None:
+        return await self._run(self.client.artist_top_albums, artist,
+                               api_key)
+
+    async def release(self, mbid: str) -> dict | None:
+        return await self._run(self.client.release, mbid)
+
+    async def fetch_file(self, endpoint: str, key: str, url: str,
+                         directory: Path, store, accept=None,
+                         refresh: bool = False) -> dict | None:
+        # store() runs on the executor too, off the event loop
+        return await self._run(self.client.fetch_file, endpoint, key, url,
+                               directory, store, accept, refresh)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def get_client() -> Client:
+    # one per process; sockets and executor threads don't survive a fork
+    with _lock:
+        if _clients.get("pid") != os.getpid():
+            _clients.clear()
+            _clients["pid"] = os.getpid()
+        if "sync" not in _clients:
+            _clients["sync"] = Client(
+                cache=MetadataCache(helper.METADATA_CACHE_PATH))
+        return _clients["sync"]
+
+
+def get_async_client() -> AsyncClient:
+    client = get_client()
+    with _lock:
+        if "async" not in _clients:
+            _clients["async"] = AsyncClient(client)
+        return _clients["async"]
@@ -1,48 +1,118 @@
-import os
-import requests
-import urllib.parse
+import gc
+import logging
 
-from datetime import datetime
 from dotenv import load_dotenv
-from flask import Flask, render_template, request
+from flask import Flask, render_template, stream_template, request
 
+import enrich
+import pages
 import helper
+import metrics
+import api_client
+import write_behind
 from album_selector import Album
+from search import Searcher
 
 app = Flask(__name__)
 env = load_dotenv()
+logger = logging.getLogger(__name__)
+
+# streamed pages are timed until their first byte
+REQUEST_SECONDS = metrics.histogram(
+    "aotw_request_seconds", "Time spent handling a request", ["endpoint"])
+UPSTREAM_SECONDS = metrics.histogram(
+    "aotw_upstream_seconds", "Time spent waiting for an upstream API",
+    ["call"])
+
+def history_page_args():
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", helper.HISTORY_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), helper.MAX_HISTORY_PAGE_SIZE)
+    return before, limit
+
+@app.after_request
+def artwork_cache_headers(response):
+    # artwork files are named by content hash and never change
+    if request.path.startswith("/static/artwork/") and \
+            response.status_code in (200, 304):
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 86400
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+@app.after_request
+def flush_metrics(response):
+    metrics.registry.maybe_flush(helper.METRICS_DIR)
+    return response
 
 @app.route("/")
+@REQUEST_SECONDS.time(endpoint="index")
 def index():
-    album = helper.get_current_album()
-    values = {"album": album.to_dict()}
-    return render_template("index.html", **values)
+    return pages.cached_page("index")
 
 @app.route("/history")
+@REQUEST_SECONDS.time(endpoint="history")
 def history():
-    values = {"albums": []}
-    album_list = []
-    for entry in helper.get_history():
-        date = datetime.fromisoformat(entry.get("chosen_on"))
-        new_album = {
-            "title": entry.get('title'),
-            "artist": entry.get('artist'),
-            "date": date.strftime("%B %d, %Y"),
-        }
-        album_list.append(new_album)
-    album_list.reverse()
-    values = {'albums': album_list}
-    return render_template("history.html", **values)
+    # the first page is identical for everyone until the next rotation
+    if "before" not in request.args and "limit" not in request.args:
+        return pages.cached_page("history")
+    before, limit = history_page_args()
+    return stream_template("history.html",
+                           **pages.history_values(before, limit))
+
+@app.route("/history.json")
+@REQUEST_SECONDS.time(endpoint="history_json")
+def history_json():
+    before, limit = history_page_args()
+    albums, next_before = helper.get_history_page(before, limit,
+                                                  display=False)
+    return {'albums': albums, 'next_before': next_before}
+
+@app.route("/stats")
+def stats():
+    values = helper.get_queue_stats()
+    # per worker
+    values["search"] = searcher.metrics()
+    cache = api_client.get_client().cache
+    if cache is not None:
+        values["metadata_cache"] = cache.metrics()
+    if write_behind.WRITE_BEHIND:
+        values["submissions"] = helper.get_submission_queue().metrics()
+    return values
+
+@app.route("/metrics")
+def prometheus_metrics():
+    # every worker's counters and histograms, the queue as gauges
+    stats = helper.get_queue_stats()
+    gauges = [
+        ("aotw_queue_length", "Albums waiting in the queue",
+         stats["queue_length"]),
+        ("aotw_queue_bins", "Bins in the queue", stats["bin_count"]),
+        ("aotw_queue_oldest_bin_age_seconds", "Age of the oldest bin",
+         stats["oldest_bin_age"]),
+        ("aotw_queue_streak_length", "Picks in a row from the same bin",
+         stats["streak_len"]),
+        ("aotw_history_length", "Albums picked so far",
+         len(helper.get_history_log())),
+    ]
+    registry = metrics.registry
+    text = registry.render(registry.collect(helper.METRICS_DIR), gauges)
+    return text, 200, {"Content-Type": metrics.CONTENT_TYPE}
 
 @app.route("/search", methods=["GET"])
+@REQUEST_SECONDS.time(endpoint="options")
 def options():
-    title = request.args.get("title")
-    resp_json = query_options(title)
-    matches = parse_album_matches(resp_json)
+    # A search waiting on upstream holds its gunicorn thread. The searcher's
+    # upstream slots (AOTW_SEARCH_UPSTREAM_SLOTS), fewer than the threads,
+    # keep slow lookups from taking every thread away from the other pages.
+    title = request.args.get("title", "")
+    matches = searcher.search(title)
 
     return render_template("options.html", albums=matches)
 
 @app.route("/submit", methods=["POST"])
+@REQUEST_SECONDS.time(endpoint="submit")
 def submit():
     query = request.form.get("title", "")
 
@@ -58,30 +128,69 @@ def submit():
     album = Album(title=album_name, artist=artist_name,
                   submitted_by=ip_addr_hash)
 
-    helper.add_album_upcoming(album)
+    on_stored = enrich.enricher.submit if enrich.ENRICH_ON_SUBMIT else None
+    helper.add_album_upcoming(album, on_stored)
     return render_template("form.html", form_result="Submitted an album!")
 
 def query_options(query):
-    api_key = os.environ.get("LASTFM_API_KEY", "")
-    if api_key == "" or query == "":
+    # Failures are raised, not answered with no matches: the searcher
+    # caches what it gets back, and counts and logs what raises.
+    client = api_client.get_client()
+    if query == "":
         return {}
-
-    query = urllib.parse.quote(query)
-    base = "http://ws.audioscrobbler.com/2.0/"
-    method = "method=album.search"
-    url = f"{base}?{method}&album={query}&api_key={api_key}&format=json"
-
-    resp = requests.get(url)
-    return resp.json()
-
-def parse_album_matches(json_obj):
+    if client.api_key == "":
+        raise api_client.UpstreamError("LASTFM_API_KEY is not set")
+    with UPSTREAM_SECONDS.time(call="album_search"):
+        result = client.album_search(query)
+    if result is None:
+        raise api_client.UpstreamError(f"album.search failed for {query!r}")
+    return result
+
+def parse_album_matches(json_obj, limit=5):
     matches = json_obj.get("results", {}).get("albummatches", {})
-    print(len(matches.get("album", [])))
+    logger.debug("%d upstream matches", len(matches.get("album", [])))
     first_5_albums = [
         {
             "title": a.get("name", ""),
             "artist": a.get("artist", ""),
             "mbid": a.get("mbid", "")
-        } for a in matches.get("album", [])[:5]
+        } for a in matches.get("album", [])[:limit]
     ]
     return first_5_albums
+
+def upstream_search(query):
+    # keep every match so related queries can be answered from the cache
+    return parse_album_matches(query_options(query), limit=None)
+
+searcher = Searcher(upstream_search, helper.get_search_version,
+                    helper.get_search_entries)
+
+def preload():
+    # Load what every worker reads, in the gunicorn master before it forks
+    # them (preload_app), so it is read and parsed once and shared
+    # copy-on-write. The caches all check their files, so a worker forked
+    # after the data changed reloads it on its own.
+    try:
+        # the cached pages have their own environment
+        for environment in (app.jinja_env, pages.templates):
+            for name in environment.list_templates():
+                environment.get_template(name)
+        helper.get_history()
+        searcher.index()
+        if helper.ALBUM_INFO_PATH.is_file():
+            helper.get_current_album()
+            pages.warm_render_cache()
+    except Exception:
+        logger.exception("Preloading failed; workers load on first use")
+    finally:
+        # connections must not cross the fork
+        helper.get_queue_store().close()
+    # keep the collector from touching (and so copying) the shared objects
+    gc.freeze()
+
+def after_fork():
+    # In each worker, right after the fork: its own HTTP pool and threads,
+    # ready before the first request. Everything else per process (SQLite
+    # connections, the enricher, write-behind, metrics) notices the new pid
+    # and starts over on first use.
+    api_client.get_async_client()
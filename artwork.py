@@ -0,0 +1,142 @@
+import os
+import re
+import io
+import hashlib
+import threading
+
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import helper
+from safe_io import atomic_write
+
+ARTWORK_DIR = helper.DIR_PATH / "static" / "artwork"
+
+# variant widths in pixels; the page shows the album at up to 600 CSS px
+WIDTHS = (150, 300, 600, 1200)
+DEFAULT_WIDTH = 600
+# (Pillow format, extension, save options)
+FORMATS = [
+    ("WEBP", "webp", {"quality": 80, "method": 4}),
+    ("JPEG", "jpg", {"quality": 85, "optimize": True, "progressive": True}),
+]
+
+# extension by leading bytes
+MAGIC = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+VARIANT = re.compile(r"^(?P<digest>[0-9a-f]{32})(-(?P<width>\d+))?"
+                     r"\.(?P<ext>jpg|png|gif|webp)$")
+
+
+def sniff(data: bytes) -> str | None:
+    # file extension for image bytes, or None if they aren't an image
+    for magic, ext in MAGIC:
+        if data.startswith(magic):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _relative(path: Path) -> str:
+    return str(path.relative_to(helper.DIR_PATH))
+
+
+def save(data: bytes, directory: Path = None) -> str:
+    # save_file() for artwork already in memory
+    directory = ARTWORK_DIR if directory is None else directory
+    directory.mkdir(parents=True, exist_ok=True)
+    part = directory / f".{os.getpid()}-{threading.get_ident()}.part"
+    part.write_bytes(data)
+    try:
+        return save_file(part, hashlib.sha256(data).hexdigest(), directory)
+    finally:
+        part.unlink(missing_ok=True)
+
+
+def save_file(path: Path, sha256: str, directory: Path = None) -> str:
+    # Store the artwork in `path` under its checksum, with resized JPEG and
+    # WebP variants when Pillow is available. Returns the path (relative to
+    # the app, like Album.image) of the variant the page shows by default.
+    # Storing the same artwork again is a no-op. Raises ValueError if path
+    # isn't an image.
+    directory = ARTWORK_DIR if directory is None else directory
+    with open(path, "rb") as fp:
+        ext = sniff(fp.read(16))
+    if ext is None:
+        raise ValueError("not an image")
+    digest = sha256[:32]
+    directory.mkdir(parents=True, exist_ok=True)
+
+    if Image is None:
+        original = directory / f"{digest}.{ext}"
+        if not original.exists():
+            os.replace(path, original)
+        return _relative(original)
+
+    try:
+        with Image.open(path) as image:
+            # a smaller original stands in for the larger variants
+            widths = {w for w in WIDTHS if w < image.width}
+            widths.add(min(image.width, WIDTHS[-1]))
+            shown = max(w for w in widths if w <= DEFAULT_WIDTH)
+            default = f"{digest}-{shown}.jpg"
+            # the default variant is written last, so it marks a complete
+            # set
+            if (directory / default).exists():
+                return _relative(directory / default)
+
+            # JPEGs are decoded straight at a reduced scale where possible
+            image.draft("RGB", (WIDTHS[-1], WIDTHS[-1]))
+            image = image.convert("RGB")
+            outputs = {}
+            # largest first, so each variant is scaled from the one before
+            for width in sorted(widths, reverse=True):
+                height = max(1, round(image.height * width / image.width))
+                image = image.resize((width, height), Image.LANCZOS)
+                for fmt, variant_ext, options in FORMATS:
+                    out = io.BytesIO()
+                    image.save(out, fmt, **options)
+                    outputs[f"{digest}-{width}.{variant_ext}"] = \
+                        out.getvalue()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"unreadable image: {e}")
+
+    for name in sorted(outputs, key=lambda name: name == default):
+        atomic_write(directory / name, outputs[name])
+    return _relative(directory / default)
+
+
+def variants(directory: Path, digest: str) -> list[tuple[int, str, Path]]:
+    # (width, extension, path), smallest first; width 0 is an unresized
+    # original
+    found = []
+    for path in directory.glob(f"{digest}*"):
+        match = VARIANT.match(path.name)
+        if match is not None:
+            found.append((int(match["width"] or 0), match["ext"], path))
+    return sorted(found)
+
+
+def srcset(image: str) -> dict | None:
+    # srcset attributes by format for an Album.image stored by save(), or
+    # None for older title-named images and originals kept without Pillow
+    path = helper.DIR_PATH / image
+    match = VARIANT.match(path.name)
+    if match is None or match["width"] is None:
+        return None
+    sets = {}
+    for width, ext, variant in variants(path.parent, match["digest"]):
+        if width:
+            url = f"/{_relative(variant)}"
+            sets.setdefault(ext, []).append(f"{url} {width}w")
+    return {ext: ", ".join(entries) for ext, entries in sets.items()}
@@ -0,0 +1,440 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import shutil
+import subprocess
+import statistics
+import tempfile
+
+from pathlib import Path
+from datetime import datetime, timedelta
+from contextlib import ExitStack
+from unittest import mock
+
+import helper
+import storage
+from album_selector import Album, UpcomingAlbums
+
+SIZES = [10, 1000, 100000]
+DISTRIBUTIONS = ["uniform", "skewed", "sparse", "burst"]
+# median seconds per operation may grow by this fraction over the baseline
+THRESHOLD = 0.25
+# results below this are mostly timer noise and never count as regressions
+MIN_SECONDS = 1e-6
+
+
+def bin_sizes(n: int, distribution: str, rng: random.Random) -> list[int]:
+    # number of albums in each bin, summing to n
+    if distribution == "sparse":
+        return [1] * n
+    if distribution == "burst":
+        return [n]
+    if distribution == "uniform":
+        bins = max(1, n // 10)
+        return [n // bins + (i < n % bins) for i in range(bins)]
+    if distribution == "skewed":
+        # a few busy weeks and a long tail
+        sizes = []
+        while sum(sizes) < n:
+            sizes.append(min(int(rng.paretovariate(1.2)), n - sum(sizes)))
+        return sizes
+    raise ValueError(f"unknown distribution {distribution!r}")
+
+
+def synthetic_albums(n: int, distribution: str = "uniform",
+                     seed: int = 0) -> list[Album]:
+    # Albums in submission order, like simulate.synthetic_queue but without
+    # numpy and with a choice of bin sizes. Bins start two days apart and a
+    # bin's albums arrive within its first 10 hours; 20 submitters, 500
+    # artists.
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    albums = []
+    for b, size in enumerate(bin_sizes(n, distribution, rng)):
+        bin_start = start + timedelta(days=2 * b)
+        for i in range(size):
+            offset = timedelta(seconds=36000 * i // size)
+            albums.append(Album(f"album {len(albums)}",
+                                f"artist {rng.randrange(500)}",
+                                submitted_on=bin_start + offset,
+                                submitted_by=f"ip{rng.randrange(20)}"))
+    return albums
+
+
+def build_queue(albums: list[Album], seed: int = 0) -> UpcomingAlbums:
+    upcoming = UpcomingAlbums(seed=seed)
+    for album in albums:
+        upcoming.add_album(album)
+    return upcoming
+
+
+# Micro benchmarks: bench(albums, workdir) -> (run, operations per run)
+
+def bench_add_album(albums, workdir):
+    def run():
+        build_queue(albums)
+    return run, len(albums)
+
+
+def bench_select_random_bin_idx(albums, workdir):
+    upcoming = build_queue(albums)
+
+    def run():
+        for _ in range(1000):
+            upcoming.select_random_bin_idx()
+    return run, 1000
+
+
+def bench_get_next_album(albums, workdir):
+    def run():
+        upcoming = build_queue(albums[:])
+        for _ in range(min(len(albums), 100)):
+            upcoming.get_next_album()
+    return run, 1
+
+
+def bench_save(fmt):
+    def bench(albums, workdir):
+        upcoming = build_queue(albums)
+        path = workdir / f"upcoming.{fmt}"
+        return (lambda: upcoming.save(path, fmt)), 1
+    return bench
+
+
+def bench_load_from_file(fmt):
+    def bench(albums, workdir):
+        path = workdir / f"upcoming.{fmt}"
+        build_queue(albums).save(path, fmt)
+        return (lambda: UpcomingAlbums.load_from_file(path)), 1
+    return bench
+
+
+def bench_store_load(albums, workdir):
+    store = storage.QueueStore(workdir / "bench.db")
+    store.replace(build_queue(albums))
+    return store.load, 1
+
+
+def bench_store_add_album(albums, workdir):
+    store = storage.QueueStore(workdir / "bench.db")
+    store.replace(build_queue(albums))
+    latest = albums[-1].submitted_on if albums else datetime(2024, 1, 1)
+
+    def run():
+        for i in range(100):
+            store.add_album(Album(f"new {i}", "artist", submitted_on=latest))
+    return run, 100
+
+
+def bench_add_current_to_history(albums, workdir):
+    helper.write_json_atomic(helper.ALBUM_INFO_PATH, albums[0].to_dict())
+
+    def run():
+        for _ in range(20):
+            helper.add_current_to_history()
+    return run, 20
+
+
+MICRO = {
+    "add_album": bench_add_album,
+    "select_random_bin_idx": bench_select_random_bin_idx,
+    # builds the queue too: compare with add_album
+    "get_next_album_x100": bench_get_next_album,
+    "save_json": bench_save("json"),
+    "save_rows": bench_save("rows"),
+    "load_from_file_json": bench_load_from_file("json"),
+    "load_from_file_rows": bench_load_from_file("rows"),
+    "store_load": bench_store_load,
+    "store_add_album": bench_store_add_album,
+    "add_current_to_history": bench_add_current_to_history,
+}
+
+
+class StubClient():
+    # upstream APIs for the route benchmarks
+    api_key = "bench"
+    cache = None
+
+    def results(self, title: str) -> dict:
+        return {"results": {"albummatches": {"album": [
+            {"name": f"{title} {i}", "artist": f"artist {i}", "mbid": ""}
+            for i in range(10)]}}}
+
+    def album_search(self, title: str, api_key: str = None) -> dict:
+        return self.results(title)
+
+
+def route(method: str, path, data=None, headers=None):
+    # path may be a function of the request number
+    def bench(albums, workdir):
+        import app
+
+        client = app.app.test_client()
+        store = helper.get_queue_store()
+        store.replace(build_queue(albums))
+        helper.write_json_atomic(helper.ALBUM_INFO_PATH, albums[0].to_dict())
+        log = helper.get_history_log()
+        log.extend([album.to_dict() for album in albums[:1000]])
+        counter = iter(range(10 ** 9))
+
+        def run():
+            for _ in range(50):
+                url = path(next(counter)) if callable(path) else path
+                response = client.open(url, method=method, data=data,
+                                       headers=headers)
+                response.close()
+        return run, 50
+    return bench
+
+
+ROUTES = {
+    "GET /": route("GET", "/"),
+    "GET / (gzip)": route("GET", "/", headers={"Accept-Encoding": "gzip"}),
+    "GET /history": route("GET", "/history"),
+    "GET /history.json": route("GET", "/history.json?limit=50&before=500"),
+    "GET /search": route("GET", lambda i: f"/search?title=album+{i}"),
+    "GET /stats": route("GET", "/stats"),
+    "POST /submit": route("POST", "/submit",
+                          data={"title": "Bench Album (Bench Artist)"}),
+}
+
+
+def isolated(workdir: Path) -> ExitStack:
+    # point every data file at workdir and stub the upstream APIs
+    import app
+    import pages
+    import enrich
+    import render_cache
+
+    stack = ExitStack()
+    rendered = render_cache.RenderCache(workdir / "rendered")
+    for target, name, value in [
+            (helper, "DATA_DIR_PATH", workdir),
+            (helper, "ALBUM_INFO_PATH", workdir / "album_info.json"),
+            (helper, "UPCOMING_PATH", workdir / "upcoming.json"),
+            (helper, "UPCOMING_DB_PATH", workdir / "upcoming.db"),
+            (helper, "HISTORY_PATH", workdir / "history.json"),
+            (helper, "HISTORY_LOG_PATH", workdir / "history.jsonl"),
+            (helper, "BACKUP_DIR", workdir / "backup"),
+            (helper, "SUBMISSIONS_DIR", workdir / "submissions"),
+            (helper, "METRICS_DIR", workdir / "metrics"),
+            (pages, "render_cache", rendered),
+            (enrich, "ENRICH_ON_SUBMIT", False),
+            (app.api_client, "get_client", StubClient)]:
+        stack.enter_context(mock.patch.object(target, name, value))
+    return stack
+
+
+def summarize(times: list[float], operations: int = 1) -> dict:
+    return {"median": statistics.median(times), "min": min(times),
+            "operations": operations, "repeat": len(times)}
+
+
+def measure(run, operations: int, repeat: int) -> dict:
+    run()  # warm up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) / operations)
+    return summarize(times, operations)
+
+
+# Startup: each probe is a fresh interpreter that imports the app and then
+# times its first response to each of STARTUP_ROUTES, either right away
+# ("cold", a worker without preload_app) or in a child forked after
+# app.preload() and set up with app.after_fork() (what the gunicorn hooks
+# do).
+STARTUP_ALBUMS = 10000
+STARTUP_HISTORY = 500
+STARTUP_ROUTES = ["/", "/history", "/history.json?limit=50",
+                  "/search?title=album+1"]
+PROBE = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+import bench
+bench.probe_startup({workdir!r}, {preload!r}, imported)
+"""
+
+
+def startup_data(workdir: Path):
+    albums = synthetic_albums(STARTUP_ALBUMS)
+    with isolated(workdir):
+        store = helper.get_queue_store()
+        store.replace(build_queue(albums))
+        store.close()
+        helper.get_history_log().extend(
+            [album.to_dict() for album in albums[:STARTUP_HISTORY]])
+        helper.write_json_atomic(helper.ALBUM_INFO_PATH, albums[0].to_dict())
+
+
+def first_responses() -> float:
+    import app
+
+    client = app.app.test_client()
+    start = time.perf_counter()
+    for url in STARTUP_ROUTES:
+        client.get(url).close()
+    return time.perf_counter() - start
+
+
+def probe_startup(workdir: str, preload: bool, imported: float):
+    # prints {"import": ..., "preload": ..., "first_response": ...} seconds
+    import app
+
+    logging.disable(logging.CRITICAL)
+    result = {"import": imported, "preload": None}
+    with isolated(Path(workdir)):
+        if not preload:
+            result["first_response"] = first_responses()
+        else:
+            start = time.perf_counter()
+            app.preload()
+            result["preload"] = time.perf_counter() - start
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                app.after_fork()
+                os.write(write, json.dumps(first_responses()).encode())
+                os._exit(0)
+            os.close(write)
+            os.waitpid(pid, 0)
+            with os.fdopen(read) as fp:
+                result["first_response"] = json.loads(fp.read())
+    print(json.dumps(result))
+
+
+def run_startup(repeat: int = 5) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        startup_data(workdir)
+        for mode, preload in [("cold", False), ("preloaded", True)]:
+            probes = []
+            for _ in range(repeat):
+                # nothing rendered by an earlier probe
+                shutil.rmtree(workdir / "rendered", ignore_errors=True)
+                out = subprocess.run(
+                    [sys.executable, "-c",
+                     PROBE.format(workdir=tmp, preload=preload)],
+                    cwd=Path(__file__).parent, capture_output=True,
+                    text=True, check=True)
+                probes.append(json.loads(out.stdout.splitlines()[-1]))
+            results[f"startup_first_response[{mode}]"] = summarize(
+                [probe["first_response"] for probe in probes])
+            if preload:
+                results["startup_preload"] = summarize(
+                    [probe["preload"] for probe in probes])
+            else:
+                results["startup_import_app"] = summarize(
+                    [probe["import"] for probe in probes])
+    return results
+
+
+def run_benchmarks(sizes: list[int], distributions: list[str],
+                   names: list[str] = None, repeat: int = 5,
+                   progress=None) -> dict:
+    # {"<name>[<size>,<distribution>]": measurement}; routes only run on
+    # the first distribution
+    benchmarks = {**MICRO, **ROUTES}
+    results = {}
+    for size in sizes:
+        for d, distribution in enumerate(distributions):
+            albums = synthetic_albums(size, distribution)
+            for name, bench in benchmarks.items():
+                if names and name not in names:
+                    continue
+                if name in ROUTES and d > 0:
+                    continue
+                key = f"{name}[{size},{distribution}]"
+                with tempfile.TemporaryDirectory() as tmp, \
+                        isolated(Path(tmp)):
+                    helper.get_queue_store().close()
+                    run, operations = bench(albums, Path(tmp))
+                    results[key] = measure(run, operations, repeat)
+                    helper.get_queue_store().close()
+                if progress is not None:
+                    progress(key, results[key])
+    return results
+
+
+def compare(results: dict, baseline: dict,
+            threshold: float = THRESHOLD) -> list[tuple[str, float, float]]:
+    # (benchmark, baseline median, median) for every regression
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        before, after = base["median"], result["median"]
+        if after > max(before, MIN_SECONDS) * (1 + threshold):
+            regressions.append((key, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the selector, storage and web routes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="queue sizes (up to 1000000)")
+    parser.add_argument("--distributions", nargs="+", default=["uniform"],
+                        choices=DISTRIBUTIONS)
+    parser.add_argument("--only", nargs="+", default=None,
+                        choices=[*MICRO, *ROUTES], metavar="NAME",
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, default=None,
+                        help="write results as JSON")
+    parser.add_argument("--baseline", type=Path, default=None,
+                        help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown as a fraction (0.25 = 25%%)")
+    parser.add_argument("--startup", action="store_true",
+                        help="also time importing the app and the first "
+                             "responses of a cold and a preloaded worker")
+    args = parser.parse_args()
+
+    # writing out log records isn't part of what's measured
+    logging.disable(logging.CRITICAL)
+
+    def progress(key, result):
+        print(f"{key:55} {result['median'] * 1e6:12.2f} us/op",
+              file=sys.stderr)
+
+    results = run_benchmarks(args.sizes, args.distributions, args.only,
+                             args.repeat, progress)
+    if args.startup:
+        for key, result in run_startup(args.repeat).items():
+            results[key] = result
+            progress(key, result)
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, before, after in regressions:
+            print(f"REGRESSION {key}: {before * 1e6:.2f} -> "
+                  f"{after * 1e6:.2f} us/op ({after / before - 1:+.0%})",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions over {args.threshold:.0%} against "
+              f"{args.baseline}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import sys
+import csv
+import json
+import argparse
+
+from datetime import datetime
+from contextlib import contextmanager
+
+import helper
+from album_selector import Album
+from storage import QueueStore
+from history_log import HistoryLog
+
+# CSV columns; JSON lines use the same keys (Album.to_dict)
+FIELDS = ['title', 'artist', 'submitted_on', 'submitted_by', 'chosen_on',
+          'image', 'date', 'mbid']
+# history entries read per batch when exporting
+EXPORT_BATCH = 1000
+
+
+def detect_format(path: str, fmt: str = None) -> str:
+    if fmt is not None:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+@contextmanager
+def open_text(path: str, mode: str):
+    # '-' is stdin or stdout
+    if path == "-":
+        yield sys.stdin if mode == 'r' else sys.stdout
+        return
+    with open(path, mode, newline='', encoding="utf-8") as fp:
+        yield fp
+
+
+def read_records(fp, fmt: str):
+    if fmt == "csv":
+        yield from csv.DictReader(fp)
+        return
+    for number, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"line {number}: {e}")
+
+
+def album_from_record(record: dict, now: datetime) -> Album:
+    # empty CSV cells fall back to the defaults a submission would get
+    title = (record.get("title") or "").strip()
+    if not title:
+        raise ValueError("missing title")
+
+    def when(key: str, default: datetime) -> datetime:
+        value = record.get(key)
+        return datetime.fromisoformat(value) if value else default
+
+    return Album(title=title,
+                 artist=record.get("artist") or "",
+                 submitted_on=when("submitted_on", now),
+                 submitted_by=record.get("submitted_by") or "",
+                 chosen_on=when("chosen_on", datetime.min),
+                 image=record.get("image") or "",
+                 date=str(record.get("date") or ""),
+                 mbid=record.get("mbid") or "")
+
+
+def read_albums(fp, fmt: str) -> list[Album]:
+    now = datetime.now()
+    albums = []
+    for number, record in enumerate(read_records(fp, fmt), 1):
+        try:
+            albums.append(album_from_record(record, now))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"record {number}: {e}")
+    return albums
+
+
+def import_queue(albums: list[Album], store: QueueStore = None) -> int:
+    # Bin the albums as submitting them one after another would, oldest
+    # first, and store them all in one transaction. Imported albums can
+    # predate existing bins, but a new bin is appended to `bins` whatever
+    # its start, so bins[known:] are the new ones. find_bin goes through
+    # the bisect index on start times, not list order, so each album is
+    # still placed with one bisection.
+    store = store if store is not None else helper.get_queue_store()
+    albums = sorted(albums, key=lambda album: album.submitted_on)
+    with store.transaction():
+        upcoming = store.load()
+        known = len(upcoming.bins)
+        placed = [(upcoming.add_album(album).id, album) for album in albums]
+        store.add_binned(upcoming.bins[known:], placed, upcoming.next_id)
+    helper.get_snapshot_manager().maybe_snapshot(store)
+    return len(placed)
+
+
+def import_history(albums: list[Album], log: HistoryLog = None) -> int:
+    # appended after the existing entries, oldest pick first
+    log = log if log is not None else helper.get_history_log()
+    albums = sorted(albums, key=lambda album: album.chosen_on)
+    log.extend([album.to_dict() for album in albums])
+    return len(albums)
+
+
+def queue_records(store: QueueStore = None):
+    store = store if store is not None else helper.get_queue_store()
+    for album in store.iter_albums():
+        yield album.to_dict()
+
+
+def history_records(log: HistoryLog = None):
+    log = log if log is not None else helper.get_history_log()
+    total = len(log)
+    for start in range(0, total, EXPORT_BATCH):
+        yield from log.read(start, min(start + EXPORT_BATCH, total))
+
+
+def write_records(fp, fmt: str, records) -> int:
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(fp, FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+        return count
+    for record in records:
+        fp.write(json.dumps(record, separators=(',', ':')) + "\n")
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import albums into, or export them from, the upcoming "
+                    "queue or the history, as CSV or JSON lines")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("target", choices=["queue", "history"])
+    parser.add_argument("file", help="- for stdin or stdout")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None,
+                        help="defaults to csv for .csv files, else jsonl")
+    args = parser.parse_args()
+    fmt = detect_format(args.file, args.format)
+
+    if args.command == "import":
+        with open_text(args.file, 'r') as fp:
+            try:
+                albums = read_albums(fp, fmt)
+            except ValueError as e:
+                parser.error(f"{args.file}: {e}")
+        if args.target == "queue":
+            count = import_queue(albums)
+        else:
+            count = import_history(albums)
+        print(f"imported {count} albums into the {args.target}",
+              file=sys.stderr)
+        return
+
+    records = queue_records() if args.target == "queue" \
+        else history_records()
+    with open_text(args.file, 'w') as fp:
+        count = write_records(fp, fmt, records)
+    print(f"exported {count} albums from the {args.target}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import json
+
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from album_selector import Album, Bin, UpcomingAlbums
+
+# Album fields in row order. QueueStore selects its columns in this order,
+# so rows read from SQLite can be kept, and written out again, undecoded.
+ROW_FIELDS = ('title', 'artist', 'submitted_on', 'submitted_by', 'chosen_on',
+              'image', 'date', 'mbid')
+# Timestamps are written with a fixed width so that text comparison in
+# SQLite matches chronological order (the bin window lookup relies on this),
+# and rows kept undecoded match the ones QueueStore writes.
+TIMESPEC = "microseconds"
+
+
+def dumps(obj) -> bytes:
+    # minified; orjson when it's installed
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def loads(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def album_to_row(album: Album) -> list:
+    return [album.title, album.artist,
+            album.submitted_on.isoformat(timespec=TIMESPEC),
+            album.submitted_by, album.chosen_on.isoformat(timespec=TIMESPEC),
+            album.image, album.date, album.mbid]
+
+
+def album_from_row(row) -> Album:
+    return Album(row[0], row[1],
+                 submitted_on=datetime.fromisoformat(row[2]),
+                 submitted_by=row[3],
+                 chosen_on=datetime.fromisoformat(row[4]),
+                 image=row[5],
+                 date=row[6],
+                 mbid=row[7])
+
+
+class JsonCodec():
+    # UpcomingAlbums.to_dict: one object per album, keyed by field. Files
+    # without a "format" are in this format.
+    name = "json"
+
+    def bin_to_obj(self, bin: Bin):
+        return bin.to_dict()
+
+    def bin_from_obj(self, obj) -> Bin:
+        return Bin.from_dict(obj)
+
+    def bin_id(self, obj) -> int:
+        return obj['id']
+
+    def encode(self, upcoming: UpcomingAlbums) -> dict:
+        return self.with_state(
+            {'bins': [self.bin_to_obj(bin) for bin in upcoming.bins]},
+            upcoming)
+
+    def with_state(self, obj: dict, upcoming: UpcomingAlbums) -> dict:
+        obj['next_id'] = upcoming.next_id
+        obj['streak_len'] = upcoming.streak_len
+        obj['streak_id'] = upcoming.streak_id
+        return obj
+
+    def decode(self, obj: dict, **kwargs) -> UpcomingAlbums:
+        upcoming = UpcomingAlbums(**kwargs)
+        for bin in obj['bins']:
+            upcoming.append_bin(self.bin_from_obj(bin))
+        upcoming.next_id = obj.get('next_id', 1)
+        upcoming.streak_len = obj.get('streak_len', 0)
+        upcoming.streak_id = obj.get('streak_id', -1)
+        return upcoming
+
+
+class RowsCodec(JsonCodec):
+    # Bins as [id, start, rows], albums as positional rows (ROW_FIELDS).
+    # About half the size of the json format before compression, bins
+    # loaded from SQLite are written without decoding their albums, and
+    # decoded bins are lazy.
+    name = "rows"
+
+    def bin_to_obj(self, bin: Bin):
+        rows = bin.rows()
+        if rows is None:
+            rows = [album_to_row(album) for album in bin.elements]
+        else:
+            rows = [list(row) for row in rows]
+        return [bin.id, bin.start.isoformat(timespec=TIMESPEC), rows]
+
+    def bin_from_obj(self, obj) -> Bin:
+        return Bin.lazy(datetime.fromisoformat(obj[1]), obj[0], obj[2],
+                        album_from_row)
+
+    def bin_id(self, obj) -> int:
+        return obj[0]
+
+    def encode(self, upcoming: UpcomingAlbums) -> dict:
+        obj = super().encode(upcoming)
+        obj['format'] = self.name
+        return obj
+
+
+CODECS = {codec.name: codec for codec in [JsonCodec(), RowsCodec()]}
+
+
+def get_codec(name: str) -> JsonCodec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"unknown queue format {name!r}")
+
+
+def codec_of(obj: dict) -> JsonCodec:
+    return get_codec(obj.get('format', JsonCodec.name))
+
+
+def decode(obj: dict, **kwargs) -> UpcomingAlbums:
+    return codec_of(obj).decode(obj, **kwargs)
+
+
+def dump_queue(upcoming: UpcomingAlbums, fmt: str = JsonCodec.name) -> bytes:
+    return dumps(get_codec(fmt).encode(upcoming))
+
+
+def load_queue(data: bytes, **kwargs) -> UpcomingAlbums:
+    return decode(loads(data), **kwargs)
@@ -0,0 +1,216 @@
+import os
+import asyncio
+import logging
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+import helper
+import artwork
+import metrics
+import log_config
+import api_client
+from album_selector import Album
+from storage import ENRICH_PENDING
+
+logger = logging.getLogger(__name__)
+
+# look albums up as soon as they are submitted
+ENRICH_ON_SUBMIT = os.environ.get("AOTW_ENRICH_ON_SUBMIT", "1") != "0"
+ENRICH_WORKERS = int(os.environ.get("AOTW_ENRICH_WORKERS", 2))
+# failed lookups are retried by later sweeps up to this many times
+ENRICH_ATTEMPTS = int(os.environ.get("AOTW_ENRICH_ATTEMPTS", 3))
+
+# resolve_album's steps, and the loader's save
+STAGE_SECONDS = metrics.histogram(
+    "aotw_resolve_stage_seconds", "Time spent in each step of resolving an "
+    "album", ["stage"])
+
+
+@STAGE_SECONDS.time(stage="search")
+async def get_album_matches_from_name(api_key: str, name: str):
+    client = api_client.get_async_client()
+    json_obj = await client.album_search(name, api_key)
+    if json_obj is None:
+        return []
+    matches = json_obj.get("results", {}).get("albummatches", {})
+    return matches
+
+
+async def get_album_matches_from_artist(api_key: str, artist: str):
+    client = api_client.get_async_client()
+    json_obj = await client.artist_top_albums(artist, api_key)
+    if json_obj is None:
+        return []
+    albums = json_obj.get("topalbums", {}).get("album", [])
+    return albums
+
+
+@STAGE_SECONDS.time(stage="find_match")
+async def find_match(matches: dict, api_key: str, album: Album):
+    if album.artist == "":
+        return matches.get("album", [])[0]
+
+    for match in matches.get("album", []):
+        if match.get("artist", "") == album.artist:
+            return match
+
+    # if name, artist combo not in album search, filter by artist
+    for match in await get_album_matches_from_artist(api_key, album.artist):
+        if match.get("name", "") == album.title:
+            return match
+
+    return matches.get("album", [])[0]
+
+
+@STAGE_SECONDS.time(stage="date")
+async def get_date_from_mbid(mbid):
+    json_obj = await api_client.get_async_client().release(mbid)
+    if json_obj is None:
+        return 0, False
+    date = json_obj.get("date", "")
+    if date != "":
+        s = date.split("-")
+        if len(s) > 0:
+            date = s[0]
+    return date, True
+
+
+def get_image_url(final_match) -> str:
+    image_url = ""
+    for image in final_match.get('image', []):
+        if image['size'] == "extralarge":
+            image_url = image['#text']
+    return image_url
+
+
+def store_artwork(download) -> str:
+    return artwork.save_file(download.path, download.sha256)
+
+
+def is_image(head: bytes) -> bool:
+    return artwork.sniff(head) is not None
+
+
+@STAGE_SECONDS.time(stage="image")
+async def fetch_artwork(endpoint: str, key: str, url: str) -> str | None:
+    # stream the artwork into the content-addressed store, reusing an
+    # earlier download of the same thing while its files are still there
+    client = api_client.get_async_client()
+    record = await client.fetch_file(endpoint, key, url, artwork.ARTWORK_DIR,
+                                     store_artwork, is_image)
+    if record is not None and \
+            not (helper.DIR_PATH / record["stored"]).is_file():
+        record = await client.fetch_file(endpoint, key, url,
+                                         artwork.ARTWORK_DIR, store_artwork,
+                                         is_image, refresh=True)
+    return None if record is None else record["stored"]
+
+
+async def resolve_album(album: Album):
+    # Look up what's needed to show `album`: (mbid, artwork path, release
+    # year or None), or None if it can't be shown. Only the artwork is
+    # written, content-addressed, so nothing is overwritten.
+    logger.debug("resolving album: %s", album.title)
+    client = api_client.get_async_client()
+    api_key = os.environ.get("LASTFM_API_KEY", "")
+
+    matches = await get_album_matches_from_name(api_key, album.title)
+    if not matches or not matches.get("album"):
+        return None
+    final_match = await find_match(matches, api_key, album)
+
+    mbid = final_match.get("mbid", "")
+    if mbid != "":
+        (date, ok), image = await asyncio.gather(
+            get_date_from_mbid(mbid),
+            fetch_artwork("cover_art", mbid.lower(),
+                          client.client.cover_art_url(mbid)))
+        if ok and image is not None:
+            return mbid, image, date
+
+    # not successful in loading with mbid
+    logger.info("Attempting to load album %s without mbid", album.title)
+    image_url = get_image_url(final_match)
+    if image_url != "":
+        image = await fetch_artwork("image", image_url, image_url)
+        if image is not None:
+            return mbid, image, None
+    return None
+
+
+def enrich(seq: int, max_attempts: int = ENRICH_ATTEMPTS) -> bool:
+    # resolve a queued album and store the result on its row
+    store = helper.get_queue_store()
+    found = store.get_album(seq)
+    if found is None or found[1] != ENRICH_PENDING:
+        return False
+    album = found[0]
+
+    result = asyncio.run(resolve_album(album))
+    if result is None:
+        logger.warning("Could not enrich %s (%s)", album.title, album.artist)
+        store.enrichment_failed(seq, max_attempts)
+        return False
+    mbid, image, date = result
+    store.set_enrichment(seq, mbid, image,
+                         album.date if date is None else date)
+    return True
+
+
+def sweep(limit: int = None) -> tuple[int, int]:
+    # enrich everything still pending; (enriched, failed)
+    done = failed = 0
+    for seq in helper.get_queue_store().pending_enrichment(limit):
+        if enrich(seq):
+            done += 1
+        else:
+            failed += 1
+    return done, failed
+
+
+class Enricher():
+    # Enriches albums on a small thread pool in the background, so /submit
+    # returns right away. Anything lost with a worker restart is picked up
+    # by `python3 enrich.py` from cron.
+    def __init__(self, max_workers: int = ENRICH_WORKERS):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _run(self, seq: int):
+        try:
+            enrich(seq)
+        except Exception:
+            logger.exception("Enriching album %s failed", seq)
+
+    def submit(self, seq: int):
+        with self._lock:
+            # threads don't survive a fork
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="enrich")
+                self._pid = os.getpid()
+            return self._executor.submit(self._run, seq)
+
+
+enricher = Enricher()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Look up metadata and artwork for queued albums")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    load_dotenv()
+    log_config.configure("enrich.log")
+    done, failed = sweep(args.limit)
+    print(f"enriched {done} albums, {failed} failed")
+
+
+if __name__ == '__main__':
+    main()
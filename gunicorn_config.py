@@ -8,3 +8,19 @@ bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8080')
 
 forwarded_allow_ips = '*'
 secure_scheme_headers = {'X-Forwarded-Proto': 'https'}
+
+# import the app and load its data once, in the master, and fork the workers
+# from it
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+def when_ready(server):
+    # once, before the first fork. Workers replacing old ones are forked
+    # from the same state; the caches check their files, so one forked
+    # after the data changed reloads only what changed.
+    if server.cfg.preload_app:
+        from app import preload
+        preload()
+
+def post_fork(server, worker):
+    from app import after_fork
+    after_fork()
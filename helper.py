@@ -1,9 +1,17 @@
-import json
+import os
 import hashlib
+import threading
 
 from pathlib import Path
+from datetime import datetime
 
 from album_selector import UpcomingAlbums, Album
+from storage import QueueStore, QueueChanged
+from snapshots import SnapshotManager, SnapshotPolicy
+from history_log import HistoryLog
+from safe_io import file_lock, write_json_atomic
+import write_behind
+from write_behind import SubmissionQueue
 
 DIR_PATH = Path(__file__).parent.resolve()
 LOG_DIR_PATH = DIR_PATH / "logs"
@@ -11,32 +19,161 @@ DATA_DIR_PATH = DIR_PATH / "data"
 
 ALBUM_INFO_PATH = DATA_DIR_PATH / "album_info.json"
 UPCOMING_PATH = DATA_DIR_PATH / "upcoming.json"
+UPCOMING_DB_PATH = DATA_DIR_PATH / "upcoming.db"
+# history.json is only read to migrate it into the log
 HISTORY_PATH = DATA_DIR_PATH / "history.json"
+HISTORY_LOG_PATH = DATA_DIR_PATH / "history.jsonl"
 
 BACKUP_DIR = DATA_DIR_PATH / "backup"
-
-ABSOLUTE_IMAGES_PATH = DIR_PATH / "static" / "images"
+# upstream answers shared by the web workers and the loader
+METADATA_CACHE_PATH = DATA_DIR_PATH / "metadata_cache.db"
+# write-behind intent logs, one per process
+SUBMISSIONS_DIR = DATA_DIR_PATH / "submissions"
+# held by load_next_album.py for the whole rotation
+LOADER_LOCK_PATH = DATA_DIR_PATH / "load_next_album"
+# per-worker metrics merged by /metrics
+METRICS_DIR = DATA_DIR_PATH / "metrics"
+# the loader's last run, for node_exporter's textfile collector
+LOADER_METRICS_PATH = Path(os.environ.get(
+    "AOTW_LOADER_METRICS_FILE", METRICS_DIR / "loader.prom"))
+
+
+# entries per /history page
+HISTORY_PAGE_SIZE = 52
+MAX_HISTORY_PAGE_SIZE = 500
+
+# number of oldest bins considered by the weekly pick
+SELECTION_WINDOW = int(os.environ.get("AOTW_SELECTION_WINDOW", 6))
+
+
+class FileCache():
+    # Caches a value derived from a file, keyed on the file's inode, mtime
+    # and size. Writers replace files with a rename (see write_json_atomic)
+    # or append to them, so a changed file always shows up as a new key in
+    # every worker and a steady-state hit costs one stat() and no parsing.
+    # key_path, when given, is the file whose version is tracked (the one
+    # a writer touches last).
+    def __init__(self, loader):
+        self.loader = loader
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def version(self, path: Path):
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self, path: Path, key_path: Path = None):
+        key = self.version(key_path or path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            # stat before reading: if the file is replaced in between, the
+            # next call sees a new key and reloads
+            value = self.loader(path)
+            self._entries[path] = (key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _format_history_entry(entry: dict) -> dict:
+    date = datetime.fromisoformat(entry.get("chosen_on"))
+    return {
+        "title": entry.get('title'),
+        "artist": entry.get('artist'),
+        "date": date.strftime("%B %d, %Y"),
+    }
+
+
+_album_cache = FileCache(Album.load_from_file)
+_history_cache = FileCache(lambda path: HistoryLog(path).read_all())
 
 
 def get_current_album() -> Album:
-    return Album.load_from_file(ALBUM_INFO_PATH)
+    # shared between requests; callers must not modify it
+    return _album_cache.get(ALBUM_INFO_PATH)
 
 
 def save_current_album(album: Album):
-    with open(ALBUM_INFO_PATH, 'w') as fp:
-        json.dump(album.to_dict(), fp, indent=2)
-    add_current_to_history()
+    # the current album and its history entry change together
+    with file_lock(ALBUM_INFO_PATH):
+        write_json_atomic(ALBUM_INFO_PATH, album.to_dict())
+        add_current_to_history()
+
+
+_queue_store = None
+_snapshot_manager = None
+_submission_queue = None
+_submission_lock = threading.Lock()
+
+
+def get_queue_store() -> QueueStore:
+    global _queue_store
+    if _queue_store is None or _queue_store.path != UPCOMING_DB_PATH:
+        store = QueueStore(UPCOMING_DB_PATH)
+        # one-time migration from the old whole-file JSON queue
+        if store.is_empty() and UPCOMING_PATH.is_file():
+            ua = UpcomingAlbums.load_from_file(UPCOMING_PATH)
+            store.replace(ua)
+        _queue_store = store
+    return _queue_store
+
+
+def get_snapshot_manager() -> SnapshotManager:
+    global _snapshot_manager
+    if _snapshot_manager is None or \
+            _snapshot_manager.directory != BACKUP_DIR:
+        _snapshot_manager = SnapshotManager(BACKUP_DIR,
+                                            SnapshotPolicy.from_env())
+    return _snapshot_manager
+
+
+def _submissions_stored(seqs: list[int]):
+    get_snapshot_manager().maybe_snapshot(get_queue_store())
+
+
+def get_submission_queue() -> SubmissionQueue:
+    global _submission_queue
+    with _submission_lock:
+        queue = _submission_queue
+        # the flusher thread doesn't survive a fork
+        if queue is None or queue.pid != os.getpid() or \
+                queue.directory != SUBMISSIONS_DIR:
+            queue = SubmissionQueue(get_queue_store, SUBMISSIONS_DIR,
+                                    on_flush=_submissions_stored).start()
+            _submission_queue = queue
+        return queue
+
+
+def replay_submissions() -> int:
+    # store submissions a crashed worker logged but never stored
+    return write_behind.replay(get_queue_store(), SUBMISSIONS_DIR)
 
 
 def load_upcoming_albums() -> UpcomingAlbums:
-    ua = UpcomingAlbums.load_from_file(UPCOMING_PATH, BACKUP_DIR)
-    return ua
+    return get_queue_store().load()
 
 
-def add_album_upcoming(album: Album):
-    ua = load_upcoming_albums()
-    ua.add_album(album)
-    ua.save(UPCOMING_PATH)
+def add_album_upcoming(album: Album, on_stored=None) -> int | None:
+    # Returns the album's row id, after calling on_stored(seq). With
+    # write-behind the album is only logged here and stored shortly after
+    # by the flusher, which calls on_stored then; None is returned.
+    if write_behind.WRITE_BEHIND:
+        get_submission_queue().submit(album, on_stored)
+        return None
+    store = get_queue_store()
+    seq = store.add_album(album)
+    get_snapshot_manager().maybe_snapshot(store)
+    if on_stored is not None:
+        on_stored(seq)
+    return seq
 
 
 def add_album_json(album: dict):
@@ -45,14 +182,85 @@ def add_album_json(album: dict):
 
 
 def get_next_album_persist() -> Album:
-    ua = load_upcoming_albums()
-    if ua.length_queue() == 0:
-        return None
-    album = ua.get_next_album()
-    ua.save(UPCOMING_PATH)
+    store = get_queue_store()
+    with store.transaction():
+        ua = store.load()
+        ua.window = SELECTION_WINDOW
+        if ua.length_queue() == 0:
+            return None
+        album = ua.get_next_album()
+        # the selected bin is the new streak bin
+        store.remove_album(ua.streak_id, album)
+        store.save_state(ua)
+    get_snapshot_manager().maybe_snapshot(store, pick=True)
     return album
 
 
+def is_enriched(album: Album) -> bool:
+    # metadata and artwork already fetched by enrich.py
+    return album.image != "" and (DIR_PATH / album.image).is_file()
+
+
+def get_next_album_candidates(k: int, prefer_enriched: bool = False) \
+        -> list[tuple[Album, int, int]]:
+    # The next k picks as get_next_album_persist would make them one after
+    # another, each with the streak (bin id, length) it leaves behind.
+    # Nothing is removed until commit_next_album. With prefer_enriched the
+    # picks are drawn from the enriched albums only, if there are any.
+    ua = get_queue_store().load()
+    ua.window = SELECTION_WINDOW
+    upcoming = ua.copy()
+    if prefer_enriched:
+        enriched = ua.copy(keep=is_enriched)
+        if enriched.length_queue():
+            upcoming = enriched
+    candidates = []
+    for _ in range(k):
+        album = upcoming.get_next_album()
+        if album is None:
+            break
+        candidates.append((album, upcoming.streak_id, upcoming.streak_len))
+    return candidates
+
+
+def commit_next_album(candidates: list[tuple[Album, int, int]],
+                      idx: int) -> bool:
+    # Consume candidates[:idx + 1] in one transaction, as if they had been
+    # picked in turn, leaving the streak of candidates[idx]. Returns False,
+    # changing nothing, if any of them has left the queue in the meantime.
+    store = get_queue_store()
+    try:
+        with store.transaction():
+            for album, bin_id, _ in candidates[:idx + 1]:
+                if not store.remove_album(bin_id, album):
+                    raise QueueChanged(album.title)
+            _, streak_id, streak_len = candidates[idx]
+            store.set_state('streak_id', streak_id)
+            store.set_state('streak_len', streak_len)
+    except QueueChanged:
+        return False
+    get_snapshot_manager().maybe_snapshot(store, pick=True)
+    return True
+
+
+def get_queue_stats() -> dict:
+    return get_queue_store().stats()
+
+
+def get_search_version() -> tuple:
+    # changes whenever history or the queue does
+    log = get_history_log()
+    history_version = None
+    if log.exists():
+        history_version = _history_cache.version(log.index_path)
+    return history_version, get_queue_store().get_state('mutations')
+
+
+def get_search_entries() -> list[dict]:
+    # albums for the local search index
+    return get_history() + get_queue_store().album_titles()
+
+
 def get_ip_address_hash(access_route, remote_addr) -> str:
     ip_string = ""
 
@@ -71,32 +279,47 @@ def get_ip_address_hash(access_route, remote_addr) -> str:
     return h.hexdigest()
 
 
-def add_current_to_history():
-    current = get_current_album()
-
-    if not HISTORY_PATH.is_file():
-        with open(HISTORY_PATH, 'w') as fp:
-            json.dump([], fp)
-
-    with open(HISTORY_PATH, 'r') as fp:
-        history = json.load(fp)
-
-    history.append(current.to_dict())
+def get_history_log() -> HistoryLog:
+    log = HistoryLog(HISTORY_LOG_PATH)
+    # one-time migration from the old whole-file history.json
+    if not log.exists() and HISTORY_PATH.is_file():
+        log.migrate(HISTORY_PATH, replace=False)
+    return log
 
-    with open(HISTORY_PATH, 'w') as fp:
-        json.dump(history, fp, indent=2)
 
-
-def get_absolute_image_path(album_name: str) -> Path:
-    return ABSOLUTE_IMAGES_PATH / f"{album_name}.jpg"
-
-
-def get_relative_image_path(album_name: str) -> str:
-    abs = get_absolute_image_path(album_name)
-    return str(abs.relative_to(DIR_PATH))
-
-
-def get_history() -> dict:
-    with open(HISTORY_PATH, 'r') as fp:
-        history = json.load(fp)
-    return history
+def add_current_to_history():
+    current = get_current_album()
+    get_history_log().append(current.to_dict())
+
+
+def get_history() -> list[dict]:
+    log = get_history_log()
+    if not log.exists():
+        return []
+    # the index is written after the data, so it marks complete appends
+    return _history_cache.get(log.path, key_path=log.index_path)
+
+
+def history_page_bounds(total: int, before: int | None, limit: int):
+    # History entries are numbered oldest first. A page is the `limit`
+    # entries just before the cursor `before` (the newest ones when no
+    # cursor is given), and the next page's cursor is the page's start.
+    if before is None or before > total:
+        before = total
+    before = max(before, 0)
+    start = max(before - limit, 0)
+    next_before = start if start > 0 else None
+    return start, before, next_before
+
+
+def get_history_page(before: int = None, limit: int = HISTORY_PAGE_SIZE,
+                     display: bool = True) -> tuple[list[dict], int | None]:
+    # newest first; display entries have the date formatted for the page.
+    # Only the page's entries are read from the log.
+    log = get_history_log()
+    start, stop, next_before = history_page_bounds(len(log), before, limit)
+    entries = log.read(start, stop)
+    entries.reverse()
+    if display:
+        entries = [_format_history_entry(entry) for entry in entries]
+    return entries, next_before
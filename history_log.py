@@ -0,0 +1,191 @@
+import os
+import json
+import argparse
+
+from array import array
+from pathlib import Path
+
+from safe_io import file_lock, fsync_dir
+
+# one unsigned 64-bit start offset per entry
+OFFSET_TYPE = 'Q'
+OFFSET_SIZE = array(OFFSET_TYPE).itemsize
+
+
+class HistoryLog():
+    # Append-only history: one JSON object per line in `path`, plus a
+    # compact index file of line start offsets so any range of entries can
+    # be read without parsing the ones before it. An entry is written to
+    # the data file (and fsync'd) before its offset goes into the index,
+    # so every indexed entry is complete; append() repairs whatever a crash
+    # in between left behind. Writers hold a lock on the log, so appends
+    # from several processes never interleave.
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.index_path = self.path.with_suffix(".idx")
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def __len__(self) -> int:
+        try:
+            return os.stat(self.index_path).st_size // OFFSET_SIZE
+        except FileNotFoundError:
+            return 0
+
+    def _offsets(self, start: int, stop: int) -> array:
+        offsets = array(OFFSET_TYPE)
+        if stop <= start:
+            return offsets
+        with open(self.index_path, 'rb') as fp:
+            fp.seek(start * OFFSET_SIZE)
+            offsets.frombytes(fp.read((stop - start) * OFFSET_SIZE))
+        return offsets
+
+    def read(self, start: int, stop: int) -> list[dict]:
+        # entries [start, stop), oldest first
+        total = len(self)
+        start = max(start, 0)
+        stop = min(stop, total)
+        if stop <= start:
+            return []
+
+        offsets = self._offsets(start, min(stop + 1, total))
+        with open(self.path, 'rb') as fp:
+            fp.seek(offsets[0])
+            if stop < total:
+                data = fp.read(offsets[-1] - offsets[0])
+            else:
+                data = fp.read()
+        lines = data.split(b"\n")[:stop - start]
+        return [json.loads(line) for line in lines]
+
+    def read_all(self) -> list[dict]:
+        return self.read(0, len(self))
+
+    def recover(self):
+        # Bring the index and data file back in line after a crash: drop a
+        # torn index record, index complete lines that never made it into
+        # the index, and cut off a partially written last line.
+        self.path.touch(exist_ok=True)
+        self.index_path.touch(exist_ok=True)
+
+        index_size = os.stat(self.index_path).st_size
+        data_size = os.stat(self.path).st_size
+        count = index_size // OFFSET_SIZE
+        with open(self.index_path, 'r+b') as index:
+            if index_size % OFFSET_SIZE:
+                index.truncate(count * OFFSET_SIZE)
+
+            end = 0
+            if count:
+                last = self._offsets(count - 1, count)[0]
+                with open(self.path, 'rb') as fp:
+                    fp.seek(last)
+                    line = fp.readline()
+                if line.endswith(b"\n"):
+                    end = last + len(line)
+                else:
+                    # index points past the data; rebuild it from scratch
+                    count = 0
+                    index.truncate(0)
+
+            with open(self.path, 'r+b') as fp:
+                fp.seek(end)
+                offsets = array(OFFSET_TYPE)
+                pos = end
+                for line in fp:
+                    if not line.endswith(b"\n"):
+                        break
+                    offsets.append(pos)
+                    pos += len(line)
+                if pos < data_size:
+                    fp.truncate(pos)
+                    os.fsync(fp.fileno())
+
+            if offsets:
+                index.seek(count * OFFSET_SIZE)
+                index.write(offsets.tobytes())
+                os.fsync(index.fileno())
+
+    def append(self, entry: dict):
+        self.extend([entry])
+
+    def extend(self, entries: list[dict]):
+        # one write and fsync per file for the whole batch
+        data = b"".join(json.dumps(entry, separators=(',', ':')).encode() +
+                        b"\n" for entry in entries)
+        with file_lock(self.path):
+            # recover() rewrites the tail, so it must not race an append
+            self.recover()
+            with open(self.path, 'ab') as fp:
+                offset = fp.tell()
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            offsets = array(OFFSET_TYPE)
+            for entry in data.split(b"\n")[:-1]:
+                offsets.append(offset)
+                offset += len(entry) + 1
+            with open(self.index_path, 'ab') as fp:
+                fp.write(offsets.tobytes())
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def migrate(self, json_path: str | Path, replace: bool = True) -> int:
+        # one-shot conversion of the old history.json list; without replace
+        # a log some other process has created in the meantime is kept
+        with open(json_path, 'r') as fp:
+            entries = json.load(fp)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path):
+            if not replace and self.exists():
+                return 0
+            return self._migrate(entries)
+
+    def _migrate(self, entries: list[dict]) -> int:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp_index = self.index_path.with_name(self.index_path.name + ".tmp")
+        offsets = array(OFFSET_TYPE)
+        with open(tmp, 'wb') as fp:
+            for entry in entries:
+                offsets.append(fp.tell())
+                fp.write(json.dumps(entry, separators=(',', ':')).encode())
+                fp.write(b"\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        with open(tmp_index, 'wb') as fp:
+            fp.write(offsets.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        # data first: if we crash before the index is in place, recover()
+        # rebuilds it from the data file
+        self.index_path.unlink(missing_ok=True)
+        os.replace(tmp, self.path)
+        os.replace(tmp_index, self.index_path)
+        fsync_dir(self.path.parent)
+        return len(entries)
+
+
+def main():
+    import helper
+
+    parser = argparse.ArgumentParser(
+        description="Convert data/history.json to the append-only log")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--source", type=Path, default=helper.HISTORY_PATH)
+    parser.add_argument("--force", action="store_true",
+                        help="overwrite an existing log")
+    args = parser.parse_args()
+
+    log = HistoryLog(helper.HISTORY_LOG_PATH)
+    if log.exists() and len(log) and not args.force:
+        parser.error(f"{log.path} already has {len(log)} entries")
+    print(f"migrated {log.migrate(args.source)} entries to {log.path}")
+
+
+if __name__ == '__main__':
+    main()
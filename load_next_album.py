@@ -1,195 +1,146 @@
 import os
-import json
+import time
+import asyncio
 import logging
-import requests
-import urllib.parse
 
-from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 
+import enrich
+import pages
 import helper
+import metrics
+import log_config
 from album_selector import Album
+from safe_io import file_lock
 
 env = load_dotenv()
-dir_path = Path(__file__).parent.resolve()
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename=dir_path / "logs" / "generator.log",
-                    encoding="utf-8",
-                    format='%(asctime)s %(levelname)s: %(message)s',
-                    datefmt="%Y-%m-%d %H:%M:%S",
-                    level=logging.DEBUG)
-logger.addHandler(logging.StreamHandler())
-
-
-def get_album_matches_from_name(api_key: str, name: str):
-    query = urllib.parse.quote(name)
-    url = "http://ws.audioscrobbler.com/2.0/"
-    # method = "method=album.search"
-    # url = f"{base}?{method}&album={query}&api_key={api_key}&format=json"
-    params = {
-        "method": "album.search",
-        "album": query,
-        "api_key": api_key,
-        "format": "json"
-    }
-
-    logger.debug(f"Sending request to {url}")
-    try:
-        resp = requests.get(url, params=params, timeout=10)
-    except requests.exceptions.Timeout:
-        logger.error(
-            "Error sending request to server: timeout after 10 seconds")
-        return []
-    json_obj = resp.json()
-    matches = json_obj.get("results", "{}").get("albummatches", {})
-    return matches
-
-
-def get_album_matches_from_artist(api_key: str, artist: str):
-    base = "http://ws.audioscrobbler.com/2.0/"
-    method = "method=artist.gettopalbums"
-    url = f"{base}?{method}&artist={artist}&api_key={api_key}&format=json"
 
-    logger.debug(f"Sending request to {url}")
-    resp = requests.get(url)
-    json_obj = resp.json()
-    albums = json_obj.get("topalbums", "{}").get("album", [])
-    return albums
 
+# queued albums resolved in parallel per round
+CANDIDATES = int(os.environ.get("AOTW_LOADER_CANDIDATES", 4))
+# draw only from albums enrich.py has already resolved, when there are any
+PREFER_ENRICHED = os.environ.get("AOTW_PREFER_ENRICHED", "0") != "0"
+# also push each run's summary to this Pushgateway
+PUSHGATEWAY_URL = os.environ.get("AOTW_PUSHGATEWAY_URL", "")
 
-def find_match(matches: dict, api_key: str, album: Album):
-    if album.artist == "":
-        return matches.get("album", [])[0]
+ALBUMS = metrics.counter(
+    "aotw_loader_albums_total", "Albums the loader tried, by outcome",
+    ["result"])
 
-    for match in matches.get("album", []):
-        if match.get("artist", "") == album.artist:
-            return match
 
-    # if name, artist combo not in album search, filter by artist
-    for match in get_album_matches_from_artist(api_key, album.artist):
-        if match.get("name", "") == album.title:
-            return match
+async def resolve_album(album: Album):
+    # enriched albums already have their artwork stored
+    if helper.is_enriched(album):
+        return album.mbid, album.image, None
+    return await enrich.resolve_album(album)
 
-    return matches.get("album", [])[0]
 
-
-def load_album(album):
-    logger.debug(f"loading album: {album.title}")
+async def resolve_first(albums: list[Album]):
+    # Resolve all albums concurrently; return the index of the first one in
+    # queue order that resolved and its result, or (len - 1, None).
+    tasks = [asyncio.create_task(resolve_album(album)) for album in albums]
+    try:
+        for idx, task in enumerate(tasks):
+            result = await task
+            if result is not None:
+                return idx, result
+        return len(tasks) - 1, None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@enrich.STAGE_SECONDS.time(stage="save")
+def save_album(album: Album, mbid: str, image: str, date):
     album.chosen_on = datetime.now()
+    album.mbid = mbid
+    album.image = image
+    if date is not None:
+        album.date = date
+    helper.save_current_album(album)
 
-    api_key = os.environ.get("LASTFM_API_KEY", "")
 
-    matches = get_album_matches_from_name(api_key, album.title)
-    if matches == []:
+def load_album(album):
+    logger.debug("loading album: %s", album.title)
+    result = asyncio.run(resolve_album(album))
+    if result is None:
         return False
-    final_match = find_match(matches, api_key, album)
-
-    mbid = final_match.get("mbid", "")
-    if mbid != "":
-        date, ok = get_date_from_mbid(mbid)
-        image_ok = load_image_from_mbid(mbid, album.title)
-
-        if ok and image_ok:
-            album.date = date
-            album.image = helper.get_relative_image_path(album.title)
-            helper.save_current_album(album)
-            return True
-
-    # not successful in loading with mbid
-    return load_without_mbid(album, final_match)
-
-
-def load_image_from_mbid(mbid: str, title: str):
-    url = f"http://coverartarchive.org/release/{mbid}/front"
-    r = requests.get(url, allow_redirects=True)
-    if r.status_code == 200:
-        open(helper.get_absolute_image_path(title), "wb").write(r.content)
-        return True
-    return False
-
-
-def load_without_mbid(album: Album, final_match):
-    logger.info(f"Attempting to load album {album.title} without mbid")
-
-    image_url = ""
-    for image in final_match['image']:
-        if image['size'] == "extralarge":
-            image_url = image['#text']
-
-    if image_url != "":
-        image_ok = get_and_save_image(
-            image_url, helper.get_absolute_image_path(album.title))
-        if image_ok:
-            album.image = helper.get_relative_image_path(album.title)
-            helper.save_current_album(album)
-            return True
-    return False
-
-
-def get_and_save_image(url, image_path):
-    r = requests.get(url, allow_redirects=True)
-    if r.status_code == 200:
-        open(image_path, "wb").write(r.content)
-        return True
-    return False
-
-
-def get_date_from_mbid(mbid):
-    url = f"https://musicbrainz.org/ws/2/release/{mbid}?fmt=json"
-    r = requests.get(url)
-    if r.status_code < 200 or r.status_code > 299:
-        return 0, False
-    json_obj = r.json()
-    date = json_obj.get("date", "")
-    if date != "":
-        s = date.split("-")
-        if len(s) > 0:
-            date = s[0]
-    return date, True
-
-
-def get_album_art(mbid, image_path):
-    url = f"http://coverartarchive.org/release/{mbid}/front"
-    r = requests.get(url, allow_redirects=True)
-    if r.status_code == 200:
-        open(image_path, "wb").write(r.content)
-        return True
-    return False
-
-
-def get_current_album_info():
-    obj = {}
-    with open("album_info.json") as fp:
-        obj = json.load(fp)
-    return obj
-
-
-def get_history():
-    h = Path("history.json")
-    if not h.is_file():
-        with open(h, "w") as fp:
-            json.dump([], fp)
-
-    history_list = []
-    with open(h, "r") as fp:
-        history_list = json.load(fp)
-    return history_list
+    save_album(album, *result)
+    return True
 
 
 def main():
-    succeeded = False
-    while succeeded is False:
-
-        album = helper.get_next_album_persist()
-        print(album, type(album))
-        if album is None:
+    start = time.time()
+    try:
+        with file_lock(helper.LOADER_LOCK_PATH, blocking=False):
+            loaded = False
+            try:
+                loaded = rotate()
+            finally:
+                report_run(start, loaded)
+    except BlockingIOError:
+        logger.info("Another loader is running. Exiting")
+
+
+def report_run(start: float, loaded: bool):
+    # this run's timings and outcome for node_exporter's textfile collector
+    # and, if one is configured, a Pushgateway
+    try:
+        gauges = [
+            ("aotw_loader_last_run_timestamp_seconds",
+             "When the loader last ran", start),
+            ("aotw_loader_run_seconds", "How long the last run took",
+             time.time() - start),
+            ("aotw_loader_success", "1 if the last run loaded an album",
+             int(loaded)),
+            ("aotw_queue_length", "Albums waiting in the queue",
+             helper.get_queue_stats()["queue_length"]),
+        ]
+        registry = metrics.registry
+        text = registry.render(registry.snapshot(), gauges)
+        metrics.write_textfile(helper.LOADER_METRICS_PATH, text)
+        if PUSHGATEWAY_URL:
+            metrics.push(PUSHGATEWAY_URL, "aotw_loader", text)
+    except Exception:
+        logger.exception("Writing the run summary failed")
+
+
+def rotate() -> bool:
+    # True once an album is loaded, False if the queue ran out
+    helper.replay_submissions()
+    while True:
+        candidates = helper.get_next_album_candidates(CANDIDATES,
+                                                      PREFER_ENRICHED)
+        if not candidates:
             logger.info("No more albums to load. Exiting")
-            return
-
-        succeeded = load_album(album)
-        logger.debug(f"Album {album} success status: {succeeded}")
+            return False
+
+        idx, result = asyncio.run(
+            resolve_first([album for album, _, _ in candidates]))
+        # albums ahead of the first good one are dropped, as if each had
+        # been picked and failed in turn
+        if not helper.commit_next_album(candidates, idx):
+            logger.info("Queue changed while resolving, retrying")
+            continue
+        for album, _, _ in candidates[:idx]:
+            logger.info("Album %s success status: False", album)
+        ALBUMS.inc(idx, result="failed")
+
+        album = candidates[idx][0]
+        logger.info("Album %s success status: %s", album, result is not None)
+        if result is not None:
+            ALBUMS.inc(result="loaded")
+            save_album(album, *result)
+            break
+        ALBUMS.inc(result="failed")
+
+    # render the new pages now so the first visitor doesn't have to
+    pages.warm_render_cache()
+    return True
 
 
 if __name__ == '__main__':
+    log_config.configure("generator.log", stderr=True)
     main()
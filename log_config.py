@@ -0,0 +1,123 @@
+import os
+import sys
+import atexit
+import queue
+import logging
+
+from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from safe_io import file_lock
+
+LOG_DIR = Path(os.environ.get(
+    "AOTW_LOG_DIR", Path(__file__).parent.resolve() / "logs"))
+LOG_LEVEL = os.environ.get("AOTW_LOG_LEVEL", "INFO").upper()
+# rotate a log file at this size, keeping this many old ones
+LOG_MAX_BYTES = int(float(os.environ.get("AOTW_LOG_MAX_MB", 10)) * 1024 * 1024)
+LOG_BACKUPS = int(os.environ.get("AOTW_LOG_BACKUPS", 5))
+FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+_listener = None
+
+
+# Modules only get a logger; each program picks where its records go by
+# calling configure() once at startup. Records are put on a queue by the
+# thread that logs them and formatted and written by a listener thread, so
+# request threads never wait on the disk.
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    # A RotatingFileHandler for a file several processes (the gunicorn
+    # workers) append to. The rollover happens under a file lock, and a
+    # process whose file was rotated by another one reopens it instead of
+    # rotating again.
+    def _moved(self) -> bool:
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        return current.st_ino != os.fstat(self.stream.fileno()).st_ino
+
+    def _reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record) -> bool:
+        if self.stream is not None and self._moved():
+            self._reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with file_lock(Path(self.baseFilename)):
+            if self.stream is not None and self._moved():
+                self._reopen()
+                return
+            super().doRollover()
+
+
+class LocalQueueHandler(QueueHandler):
+    # The listener is in the same process, so records are queued as they
+    # are and only formatted by the listener, not by the thread logging.
+    def prepare(self, record):
+        return record
+
+
+def configure(filename: str = None, level: str = None,
+              stderr: bool = False) -> QueueListener:
+    # Send every record at `level` (AOTW_LOG_LEVEL by default) or above to
+    # LOG_DIR/filename, rotated, and/or to stderr. Calling it again replaces
+    # the previous configuration.
+    global _listener
+    handlers = []
+    if filename is not None:
+        LOG_DIR.mkdir(parents=True, exist_ok=True)
+        handlers.append(SharedRotatingFileHandler(
+            LOG_DIR / filename, maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUPS, encoding="utf-8"))
+    if stderr or not handlers:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    formatter = logging.Formatter(FORMAT, DATEFMT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    stop()
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(LocalQueueHandler(records))
+    root.setLevel((level or LOG_LEVEL).upper())
+
+    _listener = QueueListener(records, *handlers)
+    _listener.start()
+    return _listener
+
+
+def stop():
+    # write out what is queued and close the files
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def _before_fork():
+    # no thread may hold a handler's lock across the fork
+    if _listener is not None:
+        _listener.stop()
+
+
+def _after_fork():
+    # in the parent and the child: threads don't survive a fork
+    if _listener is not None:
+        _listener.start()
+
+
+atexit.register(stop)
+os.register_at_fork(before=_before_fork, after_in_parent=_after_fork,
+                    after_in_child=_after_fork)
@@ -0,0 +1,208 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    body BLOB,
+    negative INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (endpoint, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS entries_added AFTER INSERT ON entries BEGIN
+    UPDATE totals SET bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_removed AFTER DELETE ON entries BEGIN
+    UPDATE totals SET bytes = bytes - old.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resized AFTER UPDATE OF size ON entries
+BEGIN
+    UPDATE totals SET bytes = bytes - old.size + new.size;
+END;
+"""
+
+DAY = 86400
+# seconds an answer is kept, per endpoint; misses are kept for less, since
+# a new release or a fixed typo upstream turns them into hits
+TTLS = {
+    'album.search': 7 * DAY,
+    'artist.gettopalbums': 7 * DAY,
+    'release': 90 * DAY,
+    'cover_art': 90 * DAY,
+    'image': 90 * DAY,
+}
+NEGATIVE_TTLS = {
+    'album.search': DAY,
+    'artist.gettopalbums': DAY,
+    'release': 7 * DAY,
+    'cover_art': 2 * DAY,
+    'image': 2 * DAY,
+}
+MAX_BYTES = int(os.environ.get("AOTW_METADATA_CACHE_MB", 256)) * 2 ** 20
+# last-access times are only rewritten this often, so hits stay reads
+ACCESS_RESOLUTION = 3600
+
+
+class MetadataCache():
+    # Upstream answers (raw response bodies, or small JSON records for
+    # downloaded files) in SQLite, keyed on endpoint
+    # and normalized query or MBID. Shared by every process that talks to
+    # Last.fm, MusicBrainz or the Cover Art Archive. Misses are cached as
+    # negative entries. Least recently used entries are evicted once the
+    # bodies exceed max_bytes.
+    def __init__(self, path: str | Path, max_bytes: int = MAX_BYTES,
+                 ttls: dict = TTLS, negative_ttls: dict = NEGATIVE_TTLS):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.negative_ttls = negative_ttls
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # per process, per endpoint
+        self.counters = {}
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        # the triggers keep the total in step with every write to entries,
+        # in the same transaction; it is only summed up for a new file or
+        # one written before the total existed
+        if conn.execute("SELECT 1 FROM totals").fetchone() is None:
+            conn.execute("INSERT OR IGNORE INTO totals (id, bytes) "
+                         "SELECT 0, COALESCE(SUM(size), 0) FROM entries")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, endpoint: str, name: str, n: int = 1):
+        with self._lock:
+            counters = self.counters.setdefault(endpoint, {
+                'hits': 0, 'negative_hits': 0, 'misses': 0, 'stores': 0,
+                'evictions': 0})
+            counters[name] += n
+
+    def get(self, endpoint: str, key: str,
+            now: float = None) -> tuple[bool, bytes | None]:
+        # (found, body); body is None for a cached miss
+        now = time.time() if now is None else now
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT body, negative, expires, accessed FROM entries "
+            "WHERE endpoint = ? AND key = ?", (endpoint, key)).fetchone()
+        if row is None or row[2] < now:
+            self._count(endpoint, 'misses')
+            return False, None
+        if row[3] < now - ACCESS_RESOLUTION:
+            conn.execute("UPDATE entries SET accessed = ? "
+                         "WHERE endpoint = ? AND key = ?",
+                         (now, endpoint, key))
+        self._count(endpoint, 'negative_hits' if row[1] else 'hits')
+        return True, row[0]
+
+    def put(self, endpoint: str, key: str, body: bytes | None,
+            negative: bool = False, now: float = None):
+        now = time.time() if now is None else now
+        negative = negative or body is None
+        ttl = (self.negative_ttls if negative else self.ttls)[endpoint]
+        size = len(body) if body is not None else 0
+        conn = self._connection()
+        # an upsert rather than INSERT OR REPLACE: the rows REPLACE deletes
+        # don't fire the delete trigger
+        conn.execute(
+            "INSERT INTO entries (endpoint, key, body, negative, size, "
+            "expires, accessed) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (endpoint, key) DO UPDATE SET body = excluded.body, "
+            "negative = excluded.negative, size = excluded.size, "
+            "expires = excluded.expires, accessed = excluded.accessed",
+            (endpoint, key, body, int(negative), size, now + ttl, now))
+        self._count(endpoint, 'stores')
+        self.evict(now)
+
+    def size(self) -> int:
+        # bytes of all bodies, kept up to date by the triggers
+        return self._connection().execute(
+            "SELECT bytes FROM totals").fetchone()[0]
+
+    def evict(self, now: float = None):
+        if self.size() <= self.max_bytes:
+            return
+        now = time.time() if now is None else now
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM entries WHERE expires < ?", (now,))
+            # down to 90% so the next few stores don't evict again
+            excess = self.size() - self.max_bytes * 9 // 10
+            evicted = []
+            for endpoint, key, size in conn.execute(
+                    "SELECT endpoint, key, size FROM entries "
+                    "ORDER BY accessed"):
+                if excess <= 0:
+                    break
+                evicted.append((endpoint, key))
+                excess -= size
+            conn.executemany("DELETE FROM entries "
+                             "WHERE endpoint = ? AND key = ?", evicted)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        for endpoint, _ in evicted:
+            self._count(endpoint, 'evictions')
+
+    def clear(self):
+        self._connection().execute("DELETE FROM entries")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            counters = {endpoint: dict(values)
+                        for endpoint, values in self.counters.items()}
+        for values in counters.values():
+            lookups = values['hits'] + values['negative_hits'] + \
+                values['misses']
+            values['hit_rate'] = (lookups - values['misses']) / lookups \
+                if lookups else None
+        return {'endpoints': counters, 'bytes': self.size(),
+                'max_bytes': self.max_bytes}
+
+
+def main():
+    import helper
+
+    parser = argparse.ArgumentParser(
+        description="Inspect or clear the upstream metadata cache")
+    parser.add_argument("command", choices=["stats", "clear"])
+    args = parser.parse_args()
+
+    cache = MetadataCache(helper.METADATA_CACHE_PATH)
+    if args.command == "clear":
+        cache.clear()
+    conn = cache._connection()
+    for endpoint, count, size, negative in conn.execute(
+            "SELECT endpoint, COUNT(*), SUM(size), SUM(negative) "
+            "FROM entries GROUP BY endpoint ORDER BY endpoint"):
+        print(f"{endpoint}: {count} entries ({negative} misses), "
+              f"{size} bytes")
+
+
+if __name__ == '__main__':
+    main()
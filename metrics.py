@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import logging
+import functools
+import threading
+
+from bisect import bisect_left
+from pathlib import Path
+
+import requests
+
+from safe_io import atomic_write, file_lock
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+# how often a worker writes its values out for /metrics to merge
+FLUSH_INTERVAL = float(os.environ.get("AOTW_METRICS_FLUSH_S", 5))
+# exited workers' values are folded into this file
+ARCHIVE = "archive.json"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# Counters and histograms in the Prometheus text format. Every process keeps
+# its own values in memory; web workers write them to
+# <directory>/<pid>-<start>.json now and then (maybe_flush) and collect()
+# adds up the files of all workers, so any worker can answer a scrape.
+# Nothing is written by processes that never flush, like the cron jobs.
+
+
+class Counter():
+    kind = "counter"
+
+    def __init__(self, registry, name: str, help: str, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            series = self.registry.series(self.name)
+            series[key] = series.get(key, 0) + amount
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, registry, name: str, help: str, labels=(),
+                 buckets=BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        # stored as per-bucket counts (the last one is +Inf), then the sum
+        key = self.key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            series = self.registry.series(self.name)
+            slots = series.get(key)
+            if slots is None:
+                slots = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            slots[idx] += 1
+            slots[-1] += value
+
+    def time(self, **labels) -> "Timer":
+        return Timer(self, labels)
+
+
+class Timer():
+    # Observes the seconds spent in a `with` block or in each call of the
+    # decorated function (coroutine functions included), failures too.
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+    def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args, **kwargs):
+                with Timer(self.histogram, self.labels):
+                    return await func(*args, **kwargs)
+            return timed_async
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with Timer(self.histogram, self.labels):
+                return func(*args, **kwargs)
+        return timed
+
+
+def merge(into: dict, values: dict) -> dict:
+    for name, series in values.items():
+        target = into.setdefault(name, {})
+        for key, value in series.items():
+            if key not in target:
+                target[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                target[key] = [a + b for a, b in zip(target[key], value)]
+            else:
+                target[key] += value
+    return into
+
+
+def to_json(values: dict) -> bytes:
+    return json.dumps({name: [[list(key), value]
+                              for key, value in series.items()]
+                       for name, series in values.items()}).encode()
+
+
+def from_json(data: bytes) -> dict:
+    return {name: {tuple(key): value for key, value in series}
+            for name, series in json.loads(data).items()}
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        # name -> {label values: value}
+        self.values = {}
+        self.pid = os.getpid()
+        self.started = time.time_ns()
+        self.flushed = time.monotonic()
+        self.directory = None
+
+    def register(self, metric: Counter) -> Counter:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name!r} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _check_fork(self):
+        # caller holds the lock. A forked child starts from zero: what it
+        # inherited was counted by its parent.
+        if self.pid != os.getpid():
+            self.values.clear()
+            self.pid = os.getpid()
+            self.started = time.time_ns()
+            self.flushed = time.monotonic()
+            self.directory = None
+
+    def series(self, name: str) -> dict:
+        # caller holds the lock
+        self._check_fork()
+        return self.values.setdefault(name, {})
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self._check_fork()
+            return merge({}, self.values)
+
+    def process_file(self) -> str:
+        return f"{self.pid}-{self.started}.json"
+
+    def flush(self, directory: str | Path):
+        directory = Path(directory)
+        values = self.snapshot()
+        with self.lock:
+            self.flushed = time.monotonic()
+            if self.directory is None:
+                atexit.register(self._flush_at_exit)
+            self.directory = directory
+        atomic_write(directory / self.process_file(), to_json(values),
+                     durable=False)
+
+    def maybe_flush(self, directory: str | Path):
+        if time.monotonic() - self.flushed >= FLUSH_INTERVAL or \
+                self.directory is None:
+            self.flush(directory)
+
+    def _flush_at_exit(self):
+        if self.directory is not None and self.pid == os.getpid() and \
+                self.directory.is_dir():
+            self.flush(self.directory)
+
+    def collect(self, directory: str | Path) -> dict:
+        # This process's values plus the files of every other worker, live
+        # or exited. Files of exited workers are merged into the archive
+        # and removed.
+        directory = Path(directory)
+        self.flush(directory)
+        total = {}
+        with file_lock(directory / ARCHIVE):
+            archive_path = directory / ARCHIVE
+            archive = {}
+            if archive_path.is_file():
+                archive = from_json(archive_path.read_bytes())
+            archived = False
+            for path in sorted(directory.glob("*-*.json")):
+                try:
+                    values = from_json(path.read_bytes())
+                except (OSError, ValueError):
+                    logger.exception("Can't read metrics from %s", path)
+                    continue
+                pid = int(path.name.split("-")[0])
+                if path.name != self.process_file() and not is_running(pid):
+                    merge(archive, values)
+                    archived = True
+                    path.unlink()
+                    continue
+                merge(total, values)
+            if archived:
+                atomic_write(archive_path, to_json(archive), durable=False)
+        return merge(total, archive)
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self.register(Counter(self, name, help, labels))
+
+    def histogram(self, name: str, help: str, labels=(),
+                  buckets=BUCKETS) -> Histogram:
+        return self.register(Histogram(self, name, help, labels, buckets))
+
+    def render(self, values: dict, gauges=()) -> str:
+        # values from snapshot() or collect(); gauges are
+        # (name, help, value) computed by the caller, None values skipped
+        lines = []
+        for name, metric in self.metrics.items():
+            series = values.get(name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(series.items()):
+                labels = list(zip(metric.labels, key))
+                if metric.kind == "counter":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), value):
+                    cumulative += count
+                    le = labels + [("le", format_bound(bound))]
+                    lines.append(
+                        f"{name}_bucket{format_labels(le)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+                lines.append(
+                    f"{name}_count{format_labels(labels)} {cumulative}")
+        for name, help, value in gauges:
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_bound(bound) -> str:
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+
+def format_labels(labels: list[tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"')
+                 .replace("\n", "\\n")) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) \
+        + "}"
+
+
+def write_textfile(path: str | Path, text: str):
+    # for node_exporter's textfile collector, which only reads *.prom
+    atomic_write(path, text.encode(), durable=False)
+
+
+def push(url: str, job: str, text: str, timeout: float = 10) -> bool:
+    # replace this job's metrics on a Pushgateway
+    try:
+        response = requests.put(f"{url.rstrip('/')}/metrics/job/{job}",
+                                data=text.encode(),
+                                headers={"Content-Type": CONTENT_TYPE},
+                                timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException:
+        logger.exception("Pushing metrics to %s failed", url)
+        return False
+    return True
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
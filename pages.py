@@ -0,0 +1,51 @@
+import jinja2
+
+import helper
+import artwork
+from render_cache import render_cache, TEMPLATES_DIR
+
+# The pages kept in the render cache. They're rendered here, without the
+# Flask app, so the cron job can render them right after a rotation; the
+# templates use nothing from Flask. Templates only change with a deploy,
+# which restarts the workers, so they're never reloaded.
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+    autoescape=jinja2.select_autoescape(["html"]), auto_reload=False)
+
+
+def render(name: str, **values) -> str:
+    return templates.get_template(name).render(**values)
+
+
+def render_index() -> str:
+    album = helper.get_current_album()
+    values = {"album": album.to_dict(), "artwork": artwork.srcset(album.image)}
+    return render("index.html", **values)
+
+
+def history_values(before=None, limit=helper.HISTORY_PAGE_SIZE) -> dict:
+    albums, next_before = helper.get_history_page(before, limit)
+    return {'albums': albums, 'next_before': next_before, 'limit': limit}
+
+
+def render_history() -> str:
+    return render("history.html", **history_values())
+
+
+# name -> (data files the page is built from, render function)
+CACHED_PAGES = {
+    "index": (lambda: [helper.ALBUM_INFO_PATH], render_index),
+    "history": (lambda: [helper.get_history_log().index_path],
+                render_history),
+}
+
+
+def cached_page(name: str):
+    # the response for the current request
+    sources, render = CACHED_PAGES[name]
+    return render_cache.respond(name, sources(), render)
+
+
+def warm_render_cache():
+    for name, (sources, render) in CACHED_PAGES.items():
+        render_cache.get(name, sources(), render)
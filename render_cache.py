@@ -0,0 +1,159 @@
+import os
+import gzip
+import hashlib
+import threading
+
+from pathlib import Path
+from datetime import datetime, timezone
+
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import helper
+from safe_io import atomic_write
+
+RENDER_DIR = helper.DATA_DIR_PATH / "rendered"
+TEMPLATES_DIR = helper.DIR_PATH / "templates"
+
+ENCODINGS = ["br", "gzip", "identity"] if brotli is not None \
+    else ["gzip", "identity"]
+
+
+def _templates_version() -> str:
+    # templates only change with a deploy, which restarts the workers
+    versions = sorted(f"{p.name}:{p.stat().st_mtime_ns}"
+                      for p in TEMPLATES_DIR.glob("*.html"))
+    return ",".join(versions)
+
+
+def tag(etag: str, encoding: str) -> str:
+    # a strong ETag names one sequence of bytes, so each encoding of a
+    # version gets its own
+    return etag if encoding == "identity" else f"{etag}-{encoding}"
+
+
+class Rendered():
+    def __init__(self, etag: str, last_modified: datetime, bodies: dict):
+        self.etag = etag
+        self.last_modified = last_modified
+        # encoding -> bytes
+        self.bodies = bodies
+
+
+class RenderCache():
+    # Rendered pages keyed on the versions (inode, mtime, size) of the data
+    # files they are built from. Entries live in memory per worker and on
+    # disk, so a page rendered once - by any worker or by the cron job right
+    # after a rotation - is reused everywhere until its data changes.
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.templates = _templates_version()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def version(self, name: str, sources: list[Path]):
+        parts = [name, self.templates]
+        last_modified = datetime.fromtimestamp(0, timezone.utc)
+        for source in sources:
+            try:
+                st = os.stat(source)
+            except FileNotFoundError:
+                parts.append("missing")
+                continue
+            parts.append(f"{st.st_ino}:{st.st_mtime_ns}:{st.st_size}")
+            modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+            last_modified = max(last_modified, modified)
+        etag = hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+        return etag, last_modified
+
+    def _paths(self, name: str, etag: str) -> dict:
+        base = self.directory / f"{name}-{etag}.html"
+        return {
+            "identity": base,
+            "gzip": base.with_name(base.name + ".gz"),
+            "br": base.with_name(base.name + ".br"),
+        }
+
+    def _load(self, name: str, etag: str) -> dict | None:
+        bodies = {}
+        for encoding, path in self._paths(name, etag).items():
+            if encoding not in ENCODINGS:
+                continue
+            try:
+                bodies[encoding] = path.read_bytes()
+            except FileNotFoundError:
+                return None
+        return bodies
+
+    def _store(self, name: str, etag: str, bodies: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        paths = self._paths(name, etag)
+        # the uncompressed file goes last: its presence marks a complete set
+        for encoding in ["br", "gzip", "identity"]:
+            if encoding not in bodies:
+                continue
+            path = paths[encoding]
+            # rendered again if lost, so no fsync
+            atomic_write(path, bodies[encoding], durable=False)
+
+        for path in self.directory.glob(f"{name}-*.html*"):
+            if etag not in path.name:
+                path.unlink(missing_ok=True)
+
+    def get(self, name: str, sources: list[Path], render) -> Rendered:
+        etag, last_modified = self.version(name, sources)
+        entry = self._entries.get(name)
+        if entry is not None and entry.etag == etag:
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.etag == etag:
+                return entry
+
+            bodies = self._load(name, etag)
+            if bodies is None:
+                body = render().encode("utf-8")
+                bodies = {"identity": body, "gzip": gzip.compress(body, 9)}
+                if brotli is not None:
+                    bodies["br"] = brotli.compress(body)
+                self._store(name, etag, bodies)
+
+            entry = Rendered(etag, last_modified, bodies)
+            self._entries[name] = entry
+        return entry
+
+    def respond(self, name: str, sources: list[Path], render) -> Response:
+        etag, last_modified = self.version(name, sources)
+        encoding = request.accept_encodings.best_match(ENCODINGS, "identity")
+
+        if request.if_none_match:
+            # any encoding of the current version is still fresh
+            not_modified = any(request.if_none_match.contains(tag(etag, e))
+                               for e in ENCODINGS)
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and last_modified <= since
+        if not_modified:
+            response = Response(status=304)
+        else:
+            rendered = self.get(name, sources, render)
+            # the data may have changed since version() above
+            etag, last_modified = rendered.etag, rendered.last_modified
+            response = Response(rendered.bodies[encoding],
+                                mimetype="text/html")
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+
+        response.set_etag(tag(etag, encoding))
+        response.last_modified = last_modified
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+render_cache = RenderCache(RENDER_DIR)
@@ -0,0 +1,96 @@
+import os
+import json
+import threading
+
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks; only safe with a single writer process
+    fcntl = None
+
+
+# Every data file is either replaced whole with a rename (atomic_file and
+# the helpers built on it) or appended to under file_lock(), so a reader
+# never sees a torn file and concurrent writers in the gunicorn workers and
+# the cron jobs never lose each other's updates.
+
+
+def lock_path(path: Path) -> Path:
+    # The lock lives next to the file rather than on it: a file that is
+    # replaced by rename would leave waiters holding a lock on the old inode.
+    return path.with_name(f".{path.name}.lock")
+
+
+@contextmanager
+def file_lock(path: str | Path, shared: bool = False, blocking: bool = True):
+    # Cross-process lock for `path`. flock() locks belong to the open file,
+    # so threads of one process exclude each other too; for the same reason
+    # it isn't reentrant. Raises BlockingIOError when blocking is False and
+    # the lock is held.
+    path = Path(path)
+    if fcntl is None:
+        yield
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(fd, flags)
+        yield
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
+
+
+def fsync_dir(directory: str | Path):
+    # makes a rename in `directory` survive a crash
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def temp_path(path: Path) -> Path:
+    # unique per process and thread, so concurrent writers of the same file
+    # never share a temporary file
+    return path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+@contextmanager
+def atomic_file(path: str | Path, mode: str = 'wb', durable: bool = True,
+                **kwargs):
+    # Write `path` through a temporary file that replaces it on success.
+    # durable: fsync the data and the directory entry, for files that can't
+    # be rebuilt.
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path(path)
+    try:
+        with open(tmp, mode, **kwargs) as fp:
+            yield fp
+            if durable:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    if durable:
+        fsync_dir(path.parent)
+
+
+def atomic_write(path: str | Path, data: bytes, durable: bool = True):
+    with atomic_file(path, 'wb', durable) as fp:
+        fp.write(data)
+
+
+def write_json_atomic(path: str | Path, obj, indent: int = 2):
+    with atomic_file(path, 'w', encoding="utf-8") as fp:
+        json.dump(obj, fp, indent=indent)
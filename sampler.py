@@ -0,0 +1,90 @@
+import random
+
+from bisect import bisect_right
+from itertools import accumulate
+
+# number of oldest bins that take part in a selection
+DEFAULT_WINDOW = 6
+
+
+def bin_weights(bins: list, streak_id: int, streak_len: int,
+                window: int = DEFAULT_WINDOW) -> list[float]:
+    # Each bin in the window is (len + 1) times as likely as the next one,
+    # with the last bin in the window as the unit. The bin that won the last
+    # picks has its multiplier reduced by the streak length, halving for
+    # every step below 1.
+    num_bins = min(len(bins), window)
+    weights = [1 for _ in range(num_bins)]
+
+    # iterate backwards with second to last idx
+    for i in range(num_bins - 2, -1, -1):
+        bin = bins[i]
+        mult = len(bin) + 1
+        if streak_id == bin.id:
+            mult -= streak_len
+            if mult < 1:
+                mult = pow(2, mult)
+        weights[i] = mult * weights[i + 1]
+    return weights
+
+
+# The weights are suffix products, so changing one bin rescales every weight
+# before it; incremental structures such as a Fenwick tree don't pay off for
+# a window this size. Samplers are instead built once per queue state and
+# cached by UpcomingAlbums until the queue or the streak changes.
+class CumulativeSampler():
+    # O(window) build, O(log window) draws
+    def __init__(self, weights: list[float]):
+        self.weights = weights
+        self.cumulative = list(accumulate(weights))
+        self.total = self.cumulative[-1] if self.cumulative else 0
+
+    def draw(self, rng: random.Random = random) -> int:
+        idx = bisect_right(self.cumulative, rng.random() * self.total)
+        # guard against float rounding at the top end
+        return min(idx, len(self.cumulative) - 1)
+
+    def draw_many(self, k: int, rng: random.Random = random) -> list[int]:
+        return [self.draw(rng) for _ in range(k)]
+
+
+class AliasSampler():
+    # Vose's alias method: O(window) build, O(1) draws
+    def __init__(self, weights: list[float]):
+        self.weights = weights
+        n = len(weights)
+        total = sum(weights)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            g = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = g
+            scaled[g] = scaled[g] + scaled[s] - 1
+            if scaled[g] < 1:
+                small.append(g)
+            else:
+                large.append(g)
+        for i in large + small:
+            self.prob[i] = 1.0
+            self.alias[i] = i
+
+    def draw(self, rng: random.Random = random) -> int:
+        i = rng.randrange(len(self.prob))
+        if rng.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+
+    def draw_many(self, k: int, rng: random.Random = random) -> list[int]:
+        return [self.draw(rng) for _ in range(k)]
+
+
+SAMPLERS = {
+    'cumulative': CumulativeSampler,
+    'alias': AliasSampler,
+}
@@ -0,0 +1,292 @@
+import os
+import time
+import logging
+import threading
+
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# number of options shown under the search box
+DISPLAY_LIMIT = 5
+# shortest query the trigram index can answer; shorter ones use the prefix
+# list only
+TRIGRAM = 3
+
+
+def normalize(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def matches(result: dict, query: str) -> bool:
+    return query in normalize(result.get("title", ""))
+
+
+class SearchCache():
+    # LRU cache of normalized query -> upstream results, with a TTL. Keys are
+    # also kept sorted so queries extending a cached one can be found by
+    # bisection.
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, key: str):
+        del self._entries[key]
+        del self._keys[bisect_left(self._keys, key)]
+
+    def get(self, key: str, now: float = None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if entry[0] < now:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, results: list[dict], now: float = None):
+        now = time.monotonic() if now is None else now
+        if key not in self._entries:
+            insort(self._keys, key)
+        self._entries[key] = (now + self.ttl, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def related(self, key: str, now: float = None):
+        # cached results of shorter queries this one extends, longest first,
+        # then of longer queries that extend this one
+        for i in range(len(key) - 1, 0, -1):
+            results = self.get(key[:i], now)
+            if results is not None:
+                yield results
+        idx = bisect_left(self._keys, key)
+        longer = []
+        while idx < len(self._keys) and self._keys[idx].startswith(key):
+            if self._keys[idx] != key:
+                longer.append(self._keys[idx])
+            idx += 1
+        # get() may drop expired keys, so don't iterate _keys directly
+        for other in longer:
+            results = self.get(other, now)
+            if results is not None:
+                yield results
+
+
+class LocalIndex():
+    # Albums we already know about (history and past submissions), searchable
+    # by title prefix and by substring through a trigram index.
+    def __init__(self, entries: list[dict] = ()):
+        self.entries = []
+        self.titles = []
+        self.prefixes = []
+        self.trigrams = {}
+        seen = {}
+        for entry in entries:
+            key = (normalize(entry.get("title") or ""),
+                   normalize(entry.get("artist") or ""))
+            if not key[0]:
+                continue
+            if key in seen:
+                # more popular albums sort first
+                self.entries[seen[key]]["count"] += 1
+                continue
+            seen[key] = len(self.entries)
+            self.entries.append({
+                "title": entry.get("title"),
+                "artist": entry.get("artist") or "",
+                "mbid": entry.get("mbid", ""),
+                "count": 1,
+            })
+            self.titles.append(key[0])
+
+        for idx, title in enumerate(self.titles):
+            self.prefixes.append((title, idx))
+            for i in range(len(title) - TRIGRAM + 1):
+                self.trigrams.setdefault(title[i:i + TRIGRAM], set()).add(idx)
+        self.prefixes.sort()
+
+    def search(self, query: str, limit: int = DISPLAY_LIMIT) -> list[dict]:
+        found = []
+        idx = bisect_left(self.prefixes, (query, -1))
+        while idx < len(self.prefixes) and \
+                self.prefixes[idx][0].startswith(query):
+            found.append(self.prefixes[idx][1])
+            idx += 1
+
+        if len(query) >= TRIGRAM:
+            grams = [query[i:i + TRIGRAM]
+                     for i in range(len(query) - TRIGRAM + 1)]
+            sets = sorted((self.trigrams.get(g, set()) for g in grams),
+                          key=len)
+            candidates = set.intersection(*sets) if sets else set()
+            prefix_hits = set(found)
+            found.extend(sorted(i for i in candidates
+                                if i not in prefix_hits
+                                and query in self.titles[i]))
+
+        ranked = sorted(found,
+                        key=lambda i: (not self.titles[i].startswith(query),
+                                       -self.entries[i]["count"]))
+        return [{k: self.entries[i][k] for k in ("title", "artist", "mbid")}
+                for i in ranked[:limit]]
+
+
+class Searcher():
+    def __init__(self, upstream, local_version, local_entries,
+                 refresh_interval: float = 60, cache: SearchCache = None,
+                 max_upstream: int = None):
+        # upstream(query) -> list of results; local_entries() -> the albums
+        # for the local index, rebuilt when local_version() changes. At most
+        # max_upstream searches wait on upstream at once (0: no limit); the
+        # others are answered from the local index.
+        self.upstream = upstream
+        self.local_version = local_version
+        self.local_entries = local_entries
+        self.refresh_interval = refresh_interval
+        self.cache = cache if cache is not None else SearchCache(
+            max_entries=int(os.environ.get("AOTW_SEARCH_CACHE_SIZE", 1024)),
+            ttl=float(os.environ.get("AOTW_SEARCH_CACHE_TTL", 86400)))
+
+        if max_upstream is None:
+            max_upstream = int(os.environ.get("AOTW_SEARCH_UPSTREAM_SLOTS", 2))
+        self._slots = threading.BoundedSemaphore(max_upstream) \
+            if max_upstream > 0 else None
+
+        self._lock = threading.Lock()
+        self._index = LocalIndex()
+        self._index_version = None
+        self._index_checked = None
+
+        self.counters = {
+            "requests": 0,
+            "cache_hits": 0,
+            "related_hits": 0,
+            "local_hits": 0,
+            "upstream_calls": 0,
+            "upstream_errors": 0,
+            "saturated": 0,
+        }
+        self.upstream_seconds = 0.0
+        self.upstream_max_seconds = 0.0
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def index(self) -> LocalIndex:
+        now = time.monotonic()
+        if self._index_checked is not None and \
+                now - self._index_checked < self.refresh_interval:
+            return self._index
+        self._index_checked = now
+
+        version = self.local_version()
+        if version != self._index_version:
+            self._index = LocalIndex(self.local_entries())
+            self._index_version = version
+        return self._index
+
+    def lookup(self, query: str) -> list[dict] | None:
+        # everything that can be answered without an upstream call
+        with self._lock:
+            results = self.cache.get(query)
+            if results is not None:
+                self.counters["cache_hits"] += 1
+                return results[:DISPLAY_LIMIT]
+
+            for related in self.cache.related(query):
+                filtered = [r for r in related if matches(r, query)]
+                if len(filtered) >= DISPLAY_LIMIT:
+                    self.counters["related_hits"] += 1
+                    return filtered[:DISPLAY_LIMIT]
+
+        local = self.index().search(query)
+        if len(local) >= DISPLAY_LIMIT:
+            self._count("local_hits")
+            return local
+        return None
+
+    def store(self, query: str, results: list[dict]):
+        with self._lock:
+            self.cache.put(query, results)
+
+    def record_upstream(self, seconds: float, ok: bool = True):
+        with self._lock:
+            self.counters["upstream_calls"] += 1
+            if not ok:
+                self.counters["upstream_errors"] += 1
+            self.upstream_seconds += seconds
+            self.upstream_max_seconds = max(self.upstream_max_seconds,
+                                            seconds)
+
+    def _start(self, query: str) -> tuple[str, list[dict] | None]:
+        query = normalize(query or "")
+        if query == "":
+            return query, []
+        self._count("requests")
+        return query, self.lookup(query)
+
+    def _failed(self, query: str, start: float) -> list[dict]:
+        # a failed lookup only costs this keystroke its suggestions
+        logger.exception("Upstream search failed for %r", query)
+        self.record_upstream(time.perf_counter() - start, ok=False)
+        return []
+
+    def _fetched(self, query: str, results: list[dict],
+                 start: float) -> list[dict]:
+        self.record_upstream(time.perf_counter() - start)
+        self.store(query, results)
+        return results[:DISPLAY_LIMIT]
+
+    def _acquire(self) -> bool:
+        return self._slots is None or self._slots.acquire(blocking=False)
+
+    def _release(self):
+        if self._slots is not None:
+            self._slots.release()
+
+    def _saturated(self, query: str) -> list[dict]:
+        # fewer suggestions rather than another thread stuck upstream
+        self._count("saturated")
+        return self.index().search(query)
+
+    def search(self, query: str) -> list[dict]:
+        query, results = self._start(query)
+        if results is not None:
+            return results
+        if not self._acquire():
+            return self._saturated(query)
+
+        start = time.perf_counter()
+        try:
+            results = self.upstream(query)
+        except Exception:
+            return self._failed(query, start)
+        finally:
+            self._release()
+        return self._fetched(query, results, start)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            calls = counters["upstream_calls"]
+            requests = counters["requests"]
+            hits = counters["cache_hits"] + counters["related_hits"] + \
+                counters["local_hits"]
+            return {
+                **counters,
+                "hit_rate": hits / requests if requests else None,
+                "cache_entries": len(self.cache),
+                "local_index_entries": len(self._index.entries),
+                "upstream_mean_seconds":
+                    self.upstream_seconds / calls if calls else None,
+                "upstream_max_seconds": self.upstream_max_seconds,
+            }
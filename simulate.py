@@ -0,0 +1,266 @@
+import json
+import time
+import argparse
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from album_selector import UpcomingAlbums, Album
+from sampler import DEFAULT_WINDOW
+
+
+def synthetic_queue(n_albums: int, n_bins: int, n_submitters: int = 10,
+                    seed: int = None) -> UpcomingAlbums:
+    # bins two days apart; bin sizes and submitters drawn at random
+    rng = np.random.default_rng(seed)
+    start = datetime(2024, 1, 1)
+    bin_of_album = np.sort(rng.integers(0, n_bins, n_albums))
+    submitters = rng.integers(0, n_submitters, n_albums)
+
+    upcoming = UpcomingAlbums()
+    for i in range(n_albums):
+        submitted_on = start + timedelta(days=2 * int(bin_of_album[i]),
+                                         minutes=i % 600)
+        upcoming.add_album(Album(f"album {i}", f"artist {i}",
+                                 submitted_on=submitted_on,
+                                 submitted_by=f"ip{submitters[i]}"))
+    return upcoming
+
+
+class Simulation():
+    # Runs many independent copies ("trials") of the weekly pick in lockstep,
+    # one vectorized step per week. Mirrors UpcomingAlbums.get_next_album:
+    # the window is the first `window` non-empty bins and the streak follows
+    # the bin picked last.
+    #
+    # The weights only depend on how many albums are left in each bin, so
+    # that is all a trial keeps: the bins of its window and their counts.
+    # Bins only empty by being picked from, so the window moves along the
+    # queue in order. Which album a pick takes is left out: it is equally
+    # likely to be any album of the bin, so the per-submitter figures are
+    # computed exactly from per-bin totals. A week costs O(trials * window)
+    # whatever the size of the queue.
+    def __init__(self, upcoming: UpcomingAlbums, window: int = None):
+        self.window = window if window is not None else upcoming.window
+        self.bin_ids = np.array([bin.id for bin in upcoming.bins])
+        self.albums = [a for bin in upcoming.bins for a in bin.elements]
+        self.album_bin = np.repeat(np.arange(len(upcoming.bins)),
+                                   [len(bin) for bin in upcoming.bins])
+        self.counts = np.array([len(bin) for bin in upcoming.bins],
+                               dtype=np.int64)
+
+        submitters = sorted(set(a.submitted_by for a in self.albums))
+        self.submitters = submitters
+        lookup = {s: i for i, s in enumerate(submitters)}
+        self.album_submitter = np.array(
+            [lookup[a.submitted_by] for a in self.albums], dtype=np.int64)
+
+        # days each album had already waited when the simulation starts,
+        # taking the latest submission as "now"
+        latest = max((a.submitted_on for a in self.albums), default=None)
+        self.age_days = np.array(
+            [(latest - a.submitted_on).total_seconds() / 86400
+             for a in self.albums])
+
+        # bin x submitter: how many of the bin's albums are theirs, and
+        # how long those have waited in total
+        shape = (len(self.bin_ids), len(submitters))
+        self.bin_submitter = np.zeros(shape)
+        np.add.at(self.bin_submitter, (self.album_bin, self.album_submitter),
+                  1)
+        self.bin_submitter_age = np.zeros(shape)
+        np.add.at(self.bin_submitter_age,
+                  (self.album_bin, self.album_submitter), self.age_days)
+
+        self.streak_bin = -1
+        matches = np.flatnonzero(self.bin_ids == upcoming.streak_id)
+        if len(matches):
+            self.streak_bin = int(matches[0])
+        self.streak_len = upcoming.streak_len
+
+    def weights(self, counts, streak, streak_len):
+        # counts: albums left in each window slot, the non-empty bins first
+        # and 0 after them; streak: the slot of the streak's bin
+        nonempty = counts > 0
+        n_in = nonempty.sum(axis=1)
+        last = np.arange(counts.shape[1])[None, :] == (n_in - 1)[:, None]
+
+        mult = (counts + 1).astype(np.float64)
+        mult = np.where(streak, mult - streak_len[:, None], mult)
+        mult = np.where(mult < 1, np.exp2(mult), mult)
+
+        # weight of a bin is the product of the multipliers from it to the
+        # end of the window, excluding the last bin; done in log space
+        log_mult = np.where(nonempty & ~last, np.log(mult), 0.0)
+        log_w = np.flip(np.cumsum(np.flip(log_mult, axis=1), axis=1), axis=1)
+        log_w -= np.where(nonempty, log_w, -np.inf).max(axis=1)[:, None]
+        return np.where(nonempty, np.exp(log_w), 0.0)
+
+    def run(self, trials: int, weeks: int = None, seed: int = None) -> dict:
+        rng = np.random.default_rng(seed)
+        n_albums = len(self.albums)
+        if n_albums == 0:
+            raise ValueError("cannot simulate an empty queue")
+        weeks = n_albums if weeks is None else min(weeks, n_albums)
+        rows = np.arange(trials)
+        n_bins = len(self.bin_ids)
+
+        # the bins each trial's window is made of, in queue order (-1 past
+        # the end of the queue), and where the next one comes from
+        order = np.flatnonzero(self.counts > 0)
+        size = self.window
+        slots = np.arange(size)
+        first = np.full(size, -1)
+        first[:len(order[:size])] = order[:size]
+        window = np.tile(first, (trials, 1))
+        counts = np.tile(np.where(first >= 0, self.counts[first], 0),
+                         (trials, 1))
+        following = np.full(trials, min(size, len(order)))
+
+        streak_bin = np.full(trials, self.streak_bin)
+        streak_len = np.full(trials, self.streak_len, dtype=np.int64)
+
+        # per bin: picks and the sum of the weeks they were made in
+        picks = np.zeros(n_bins, dtype=np.int64)
+        pick_weeks = np.zeros(n_bins, dtype=np.int64)
+        first_bin = None
+        repeats = 0
+        max_streak = np.zeros(trials, dtype=np.int64)
+        streaks = np.zeros(weeks + self.streak_len + 2, dtype=np.int64)
+
+        for week in range(weeks):
+            w = self.weights(counts, window == streak_bin[:, None],
+                             streak_len)
+            cumulative = np.cumsum(w, axis=1)
+            u = rng.random(trials) * cumulative[:, -1]
+            slot = (cumulative <= u[:, None]).sum(axis=1)
+            slot = np.minimum(slot, size - 1)
+            selected = window[rows, slot]
+
+            picked = np.bincount(selected, minlength=n_bins)
+            picks += picked
+            pick_weeks += week * picked
+            if first_bin is None:
+                first_bin = selected
+
+            same = selected == streak_bin
+            if week > 0:
+                repeats += int(same.sum())
+            streak_len = np.where(same, streak_len + 1, 1)
+            streak_bin = selected
+            max_streak = np.maximum(max_streak, streak_len)
+            streaks += np.bincount(streak_len, minlength=len(streaks))
+
+            # a bin picked empty leaves the window: the slots after it move
+            # up and the next bin of the queue comes in at the end
+            counts[rows, slot] -= 1
+            emptied = np.flatnonzero(counts[rows, slot] == 0)
+            if len(emptied):
+                at = slot[emptied]
+                nxt = following[emptied]
+                more = nxt < len(order)
+                new_bin = np.where(more, order[np.minimum(nxt,
+                                                          len(order) - 1)],
+                                   -1)
+                new_count = np.where(more, self.counts[new_bin], 0)
+                following[emptied] += more
+                source = np.where(slots[None, :] < at[:, None], slots,
+                                  slots + 1)
+                window[emptied] = np.take_along_axis(
+                    np.column_stack([window[emptied], new_bin]), source,
+                    axis=1)
+                counts[emptied] = np.take_along_axis(
+                    np.column_stack([counts[emptied], new_count]), source,
+                    axis=1)
+
+        return self.report(trials, weeks, first_bin, picks, pick_weeks,
+                           repeats, max_streak, streaks)
+
+    def report(self, trials, weeks, first_bin, picks, pick_weeks, repeats,
+               max_streak, streaks) -> dict:
+        n_bins = len(self.bin_ids)
+        total = trials * weeks
+
+        first_bin = np.bincount(first_bin, minlength=n_bins) / trials
+        all_bins = picks / total
+
+        # each pick from a bin is any of its albums with equal odds
+        share_of_bin = self.bin_submitter / \
+            np.maximum(self.counts, 1)[:, None]
+        first_submitter = first_bin @ share_of_bin
+        submitter_picks = picks @ share_of_bin
+        share = submitter_picks / total
+
+        # days from submission until picked, with the first pick a week
+        # from now; albums not picked within the horizon are reported
+        # separately
+        waits = (picks @ (self.bin_submitter_age /
+                          np.maximum(self.counts, 1)[:, None]) +
+                 7 * (pick_weeks + picks) @ share_of_bin)
+        per_submitter_wait = {}
+        for i, name in enumerate(self.submitters):
+            if submitter_picks[i] > 0:
+                per_submitter_wait[name] = float(waits[i] /
+                                                 submitter_picks[i])
+
+        return {
+            'trials': trials,
+            'weeks': weeks,
+            'picks': int(total),
+            'bins': {
+                int(id): {'first_pick': float(first_bin[i]),
+                          'share_of_picks': float(all_bins[i])}
+                for i, id in enumerate(self.bin_ids)
+            },
+            'submitters': {
+                name: {'first_pick': float(first_submitter[i]),
+                       'share_of_picks': float(share[i]),
+                       'mean_wait_days': per_submitter_wait.get(name)}
+                for i, name in enumerate(self.submitters)
+            },
+            'mean_wait_days': float(waits.sum() / total),
+            'unpicked_fraction':
+                float(1 - total / (trials * len(self.albums))),
+            'streak': {
+                'repeat_fraction': float(repeats / (trials * (weeks - 1)))
+                if weeks > 1 else 0.0,
+                'mean_max_streak': float(max_streak.mean()),
+                'length_distribution': {
+                    int(n): float(c / total)
+                    for n, c in enumerate(streaks) if c
+                },
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Monte Carlo simulation of the weekly album pick")
+    parser.add_argument("--trials", type=int, default=10000)
+    parser.add_argument("--weeks", type=int, default=None,
+                        help="picks per trial (defaults to draining the "
+                        "queue)")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--synthetic", type=int, nargs=2, default=None,
+                        metavar=("ALBUMS", "BINS"),
+                        help="simulate a synthetic queue instead of the "
+                        "live one")
+    args = parser.parse_args()
+
+    if args.synthetic is not None:
+        upcoming = synthetic_queue(*args.synthetic, seed=args.seed)
+    else:
+        import helper
+        upcoming = helper.load_upcoming_albums()
+
+    start = time.perf_counter()
+    simulation = Simulation(upcoming, window=args.window)
+    report = simulation.run(args.trials, args.weeks, seed=args.seed)
+    report['seconds'] = time.perf_counter() - start
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+import os
+import sqlite3
+import argparse
+import threading
+
+from sys import intern
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime
+
+from album_selector import UpcomingAlbums, Album, Bin, BIN_WINDOW
+from codec import album_from_row, load_queue, TIMESPEC
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bins (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER NOT NULL UNIQUE,
+    start TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bins_start ON bins (start);
+
+CREATE TABLE IF NOT EXISTS albums (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    bin_id INTEGER NOT NULL,
+    title TEXT,
+    artist TEXT,
+    submitted_on TEXT NOT NULL,
+    submitted_by TEXT NOT NULL DEFAULT '',
+    chosen_on TEXT NOT NULL,
+    image TEXT NOT NULL DEFAULT '',
+    date TEXT NOT NULL DEFAULT '',
+    mbid TEXT NOT NULL DEFAULT '',
+    enriched INTEGER NOT NULL DEFAULT 0,
+    enrich_attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS albums_bin ON albums (bin_id, seq);
+
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# albums columns added after the first release, with their definitions
+ADDED_COLUMNS = {
+    'mbid': "TEXT NOT NULL DEFAULT ''",
+    'enriched': "INTEGER NOT NULL DEFAULT 0",
+    'enrich_attempts': "INTEGER NOT NULL DEFAULT 0",
+}
+
+# albums.enriched: metadata and artwork looked up by enrich.py
+ENRICH_PENDING = 0
+ENRICH_DONE = 1
+ENRICH_FAILED = 2
+
+STATE_DEFAULTS = {
+    'next_id': 1,
+    'streak_len': 0,
+    'streak_id': -1,
+    # maintained on insert/delete so stats() never scans the tables
+    'queue_length': 0,
+    'bin_count': 0,
+    # bookkeeping for snapshots.py
+    'mutations': 0,
+    'snapshot_mutations': 0,
+    'snapshot_at': 0,
+    'snapshot_seq': 0,
+}
+
+
+def _ts(value: datetime) -> str:
+    return value.isoformat(timespec=TIMESPEC)
+
+
+# raised to roll back a transaction that found the queue changed under it
+class QueueChanged(Exception):
+    pass
+
+
+# SQLite (WAL) backed storage for the upcoming album queue. A submission is a
+# single indexed insert and SQLite's locking serializes writers across the
+# gunicorn workers and the cron job. The selector reads the queue back as an
+# UpcomingAlbums through load(); the JSON file stays as import/export format.
+class QueueStore():
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        # connections must not be shared across a fork
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        self._init_columns(conn)
+        self._init_counters(conn)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        self._local.depth = 0
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @contextmanager
+    def transaction(self, immediate: bool = True):
+        conn = self._connection()
+        if self._local.depth > 0:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        # IMMEDIATE takes the write lock up front so concurrent
+        # read-modify-write cycles serialize instead of failing late
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def _get_state(self, conn, key: str) -> int:
+        row = conn.execute("SELECT value FROM state WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None:
+            return STATE_DEFAULTS[key]
+        return row[0]
+
+    def _set_state(self, conn, key: str, value: int):
+        conn.execute("INSERT INTO state (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                     (key, value))
+
+    def get_state(self, key: str) -> int:
+        return self._get_state(self._connection(), key)
+
+    def set_state(self, key: str, value: int):
+        with self.transaction() as conn:
+            self._set_state(conn, key, value)
+
+    def _columns(self, conn) -> set[str]:
+        return {row[1] for row in conn.execute("PRAGMA table_info(albums)")}
+
+    def _init_columns(self, conn):
+        # databases created before the columns existed
+        if ADDED_COLUMNS.keys() - self._columns(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            for name in ADDED_COLUMNS.keys() - self._columns(conn):
+                conn.execute(f"ALTER TABLE albums ADD COLUMN {name} "
+                             f"{ADDED_COLUMNS[name]}")
+            conn.execute(f"UPDATE albums SET enriched = {ENRICH_DONE} "
+                         "WHERE image != ''")
+            conn.execute("COMMIT")
+        conn.execute("CREATE INDEX IF NOT EXISTS albums_enriched "
+                     "ON albums (enriched, seq)")
+
+    def _init_counters(self, conn):
+        # databases created before the counters existed
+        row = conn.execute("SELECT 1 FROM state WHERE key = 'queue_length'")
+        if row.fetchone() is not None:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._set_state(conn, 'queue_length', conn.execute(
+            "SELECT COUNT(*) FROM albums").fetchone()[0])
+        self._set_state(conn, 'bin_count', conn.execute(
+            "SELECT COUNT(*) FROM bins").fetchone()[0])
+        conn.execute("COMMIT")
+
+    def _add_counter(self, conn, key: str, delta: int):
+        self._set_state(conn, key, self._get_state(conn, key) + delta)
+
+    def _count_mutation(self, conn):
+        self._set_state(conn, 'mutations',
+                        self._get_state(conn, 'mutations') + 1)
+
+    def _insert_album(self, conn, bin_id: int, album: Album) -> int:
+        # albums imported with artwork don't need enriching
+        enriched = ENRICH_DONE if album.image else ENRICH_PENDING
+        return conn.execute(
+            "INSERT INTO albums (bin_id, title, artist, submitted_on, "
+            "submitted_by, chosen_on, image, date, mbid, enriched) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (bin_id, album.title, album.artist, _ts(album.submitted_on),
+             album.submitted_by, _ts(album.chosen_on), album.image,
+             album.date, album.mbid, enriched)).lastrowid
+
+    def _album(self, row) -> Album:
+        # row: codec.ROW_FIELDS, plus anything after them
+        return album_from_row(row)
+
+    def is_empty(self) -> bool:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT 1 FROM state WHERE key = 'next_id'").fetchone()
+        if row is not None:
+            return False
+        return conn.execute("SELECT 1 FROM bins LIMIT 1").fetchone() is None
+
+    def add_album(self, album: Album) -> int:
+        # returns the album's row id, used by enrich.py
+        with self.transaction() as conn:
+            # first bin (in creation order) whose window contains the album,
+            # same as UpcomingAlbums.add_album
+            row = conn.execute(
+                "SELECT id FROM bins WHERE start > ? AND start < ? "
+                "ORDER BY seq LIMIT 1",
+                (_ts(album.submitted_on - BIN_WINDOW),
+                 _ts(album.submitted_on + BIN_WINDOW))).fetchone()
+            if row is not None:
+                bin_id = row[0]
+            else:
+                bin_id = self._get_state(conn, 'next_id')
+                self._set_state(conn, 'next_id', bin_id + 1)
+                conn.execute("INSERT INTO bins (id, start) VALUES (?, ?)",
+                             (bin_id, _ts(album.submitted_on)))
+                self._add_counter(conn, 'bin_count', 1)
+            seq = self._insert_album(conn, bin_id, album)
+            self._add_counter(conn, 'queue_length', 1)
+            self._count_mutation(conn)
+        return seq
+
+    def add_albums(self, albums: list[Album], intents: str = None,
+                   applied: int = 0) -> list[int]:
+        # Insert a batch in one transaction. `applied` is how many entries of
+        # the write-behind intent log `intents` are stored once it commits.
+        with self.transaction() as conn:
+            seqs = [self.add_album(album) for album in albums]
+            if intents is not None:
+                self._set_state(conn, f"intents:{intents}", applied)
+        return seqs
+
+    def add_binned(self, bins: list[Bin], albums: list[tuple[int, Album]],
+                   next_id: int) -> int:
+        # Bulk insert albums already assigned to bins (bin id, album) by
+        # UpcomingAlbums.add_album on a copy of the queue loaded in the same
+        # transaction. `bins` are the new ones, in creation order.
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO bins (id, start) VALUES (?, ?)",
+                             [(bin.id, _ts(bin.start)) for bin in bins])
+            conn.executemany(
+                "INSERT INTO albums (bin_id, title, artist, submitted_on, "
+                "submitted_by, chosen_on, image, date, mbid, enriched) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(bin_id, album.title, album.artist,
+                  _ts(album.submitted_on), album.submitted_by,
+                  _ts(album.chosen_on), album.image, album.date, album.mbid,
+                  ENRICH_DONE if album.image else ENRICH_PENDING)
+                 for bin_id, album in albums])
+            self._set_state(conn, 'next_id', next_id)
+            self._add_counter(conn, 'bin_count', len(bins))
+            self._add_counter(conn, 'queue_length', len(albums))
+            self._add_counter(conn, 'mutations', len(albums))
+        return len(albums)
+
+    def iter_albums(self, batch: int = 1000):
+        # every queued album in insertion order, read in batches so the
+        # queue is never loaded whole
+        conn = self._connection()
+        last = 0
+        while True:
+            rows = conn.execute(
+                "SELECT seq, title, artist, submitted_on, submitted_by, "
+                "chosen_on, image, date, mbid FROM albums WHERE seq > ? "
+                "ORDER BY seq LIMIT ?", (last, batch)).fetchall()
+            for row in rows:
+                yield self._album(row[1:])
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def intents_applied(self, intents: str) -> int:
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE key = ?",
+            (f"intents:{intents}",)).fetchone()
+        return 0 if row is None else row[0]
+
+    def forget_intents(self, intents: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM state WHERE key = ?",
+                         (f"intents:{intents}",))
+
+    def remove_album(self, bin_id: int, album: Album) -> bool:
+        with self.transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM albums WHERE seq = ("
+                "SELECT seq FROM albums WHERE bin_id = ? AND title IS ? "
+                "AND artist IS ? AND submitted_by = ? AND submitted_on = ? "
+                "ORDER BY seq LIMIT 1)",
+                (bin_id, album.title, album.artist, album.submitted_by,
+                 _ts(album.submitted_on))).rowcount
+            self._add_counter(conn, 'queue_length', -deleted)
+            remaining = conn.execute(
+                "SELECT 1 FROM albums WHERE bin_id = ? LIMIT 1",
+                (bin_id,)).fetchone()
+            if remaining is None:
+                bins = conn.execute("DELETE FROM bins WHERE id = ?",
+                                    (bin_id,)).rowcount
+                self._add_counter(conn, 'bin_count', -bins)
+            self._count_mutation(conn)
+        return deleted > 0
+
+    def save_state(self, upcoming: UpcomingAlbums):
+        with self.transaction() as conn:
+            self._set_state(conn, 'next_id', upcoming.next_id)
+            self._set_state(conn, 'streak_len', upcoming.streak_len)
+            self._set_state(conn, 'streak_id', upcoming.streak_id)
+
+    def load(self, **kwargs) -> UpcomingAlbums:
+        # Bins are lazy: their rows are only turned into Albums when a bin's
+        # elements are used, which for most bins is never.
+        with self.transaction(immediate=False) as conn:
+            bins = {id: start for id, start in conn.execute(
+                "SELECT id, start FROM bins ORDER BY seq")}
+            rows = {id: [] for id in bins}
+            # repeated strings (artists, submitters and the chosen_on of
+            # albums not picked yet) are shared rather than one per row
+            for title, artist, submitted_on, submitted_by, chosen_on, \
+                    image, date, mbid, bin_id in conn.execute(
+                        "SELECT title, artist, submitted_on, submitted_by, "
+                        "chosen_on, image, date, mbid, bin_id "
+                        "FROM albums ORDER BY bin_id, seq"):
+                rows[bin_id].append((
+                    title, artist and intern(artist), submitted_on,
+                    intern(submitted_by), intern(chosen_on), image, date,
+                    mbid))
+
+            upcoming = UpcomingAlbums(**kwargs)
+            for id, start in bins.items():
+                upcoming.append_bin(Bin.lazy(datetime.fromisoformat(start),
+                                             id, rows[id], album_from_row))
+            upcoming.next_id = self._get_state(conn, 'next_id')
+            upcoming.streak_len = self._get_state(conn, 'streak_len')
+            upcoming.streak_id = self._get_state(conn, 'streak_id')
+        return upcoming
+
+    def get_album(self, seq: int) -> tuple[Album, int] | None:
+        # (album, enrichment status), or None once it has left the queue
+        row = self._connection().execute(
+            "SELECT title, artist, submitted_on, submitted_by, chosen_on, "
+            "image, date, mbid, enriched FROM albums WHERE seq = ?",
+            (seq,)).fetchone()
+        if row is None:
+            return None
+        return self._album(row), row[8]
+
+    def pending_enrichment(self, limit: int = None) -> list[int]:
+        # oldest first, so the albums nearest the front are done first
+        return [seq for seq, in self._connection().execute(
+            "SELECT seq FROM albums WHERE enriched = ? ORDER BY seq "
+            "LIMIT ?", (ENRICH_PENDING, -1 if limit is None else limit))]
+
+    def set_enrichment(self, seq: int, mbid: str, image: str, date: str):
+        with self.transaction() as conn:
+            updated = conn.execute(
+                "UPDATE albums SET mbid = ?, image = ?, date = ?, "
+                "enriched = ? WHERE seq = ?",
+                (mbid, image, date, ENRICH_DONE, seq)).rowcount
+            if updated:
+                self._count_mutation(conn)
+
+    def enrichment_failed(self, seq: int, max_attempts: int):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE albums SET enrich_attempts = enrich_attempts + 1, "
+                "enriched = CASE WHEN enrich_attempts + 1 >= ? THEN ? "
+                "ELSE enriched END WHERE seq = ?",
+                (max_attempts, ENRICH_FAILED, seq))
+
+    def album_titles(self) -> list[dict]:
+        conn = self._connection()
+        return [{'title': title, 'artist': artist} for title, artist in
+                conn.execute("SELECT title, artist FROM albums")]
+
+    def stats(self, now: datetime = None) -> dict:
+        if now is None:
+            now = datetime.now()
+        with self.transaction(immediate=False) as conn:
+            oldest = conn.execute("SELECT MIN(start) FROM bins").fetchone()[0]
+            oldest_age = None
+            if oldest is not None:
+                oldest_age = (now - datetime.fromisoformat(oldest)) \
+                    .total_seconds()
+            return {
+                'queue_length': self._get_state(conn, 'queue_length'),
+                'bin_count': self._get_state(conn, 'bin_count'),
+                'oldest_bin_age': oldest_age,
+                'streak_id': self._get_state(conn, 'streak_id'),
+                'streak_len': self._get_state(conn, 'streak_len'),
+            }
+
+    def replace(self, upcoming: UpcomingAlbums):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM albums")
+            conn.execute("DELETE FROM bins")
+            for bin in upcoming.bins:
+                conn.execute("INSERT INTO bins (id, start) VALUES (?, ?)",
+                             (bin.id, _ts(bin.start)))
+                for album in bin.elements:
+                    self._insert_album(conn, bin.id, album)
+            self.save_state(upcoming)
+            self._set_state(conn, 'queue_length', upcoming.length_queue())
+            self._set_state(conn, 'bin_count', len(upcoming.bins))
+            self._count_mutation(conn)
+
+    def import_json(self, filename: str | Path):
+        with open(filename, 'rb') as fp:
+            upcoming = load_queue(fp.read())
+        self.replace(upcoming)
+
+    def export_json(self, filename: str | Path, fmt: str = "json"):
+        self.load().save(filename, fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import or export the upcoming album queue as JSON")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("json_file", type=Path)
+    parser.add_argument("--db", type=Path, default=None,
+                        help="queue database (defaults to data/upcoming.db)")
+    args = parser.parse_args()
+
+    import helper
+    store = QueueStore(args.db or helper.UPCOMING_DB_PATH)
+    if args.command == "import":
+        store.import_json(args.json_file)
+    else:
+        store.export_json(args.json_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,25 @@
+import json
+import time
+import random
 import unittest
+import threading
+import tempfile
+import importlib.util
+from unittest import mock
+import helper
 import album_selector
-from datetime import datetime
+import storage
+import snapshots
+import sampler
+import history_log
+import search
+import artwork
+import api_client
+from pathlib import Path
+from datetime import datetime, timedelta
 from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 class TestAlbumSelector(unittest.TestCase):
 
@@ -34,6 +52,31 @@ class TestAlbumSelector(unittest.TestCase):
         self.assertEqual(len(ua.bins[3]), 2)
         self.assertEqual(len(ua.bins[4]), 2)
         self.assertEqual(ua.length_queue(), len(generate_dummy_data()))
+        self.assertEqual(ua.length_queue(), sum(len(bin) for bin in ua.bins))
+
+    def test_bin_index_matches_linear_scan(self):
+        # overlapping bins only come from hand-edited or imported queues, so
+        # build them directly and check the first created bin wins
+        start = datetime(2024, 10, 1, 8, 0)
+        data = {'bins': [], 'next_id': 4}
+        for id, hours in [(1, 10), (2, 0), (3, 5)]:
+            album = album_selector.Album("S", "artist",
+                                         start + timedelta(hours=hours))
+            data['bins'].append({'id': id,
+                                 'start': album.submitted_on.isoformat(),
+                                 'elements': [album.to_dict()]})
+        rng = random.Random(5)
+        for _ in range(200):
+            ua = album_selector.UpcomingAlbums.load_from_dict(data)
+            for _ in range(20):
+                offset = timedelta(minutes=rng.randrange(-3000, 3000))
+                album = album_selector.Album("T", "artist", start + offset)
+                expected = next((bin for bin in ua.bins
+                                 if bin.is_album_valid_entry(album)), None)
+                self.assertIs(ua.find_bin(album), expected)
+                ua.add_album(album)
+                if rng.random() < .2:
+                    ua.get_next_album()
 
     def test_selector_works(self):
         ua = album_selector.UpcomingAlbums()
@@ -69,6 +112,62 @@ class TestAlbumSelector(unittest.TestCase):
             self.assertGreater(actual, prob - .05, "More than 5% difference")
             self.assertGreater(prob + .05, actual, "More than 5% difference")
 
+    def test_bin_weights(self):
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+        self.assertEqual(ua.get_sampler().weights, [120, 24, 6, 3, 1])
+
+        ua.window = 3
+        self.assertEqual(ua.get_sampler().weights, [20, 4, 1])
+
+        ua.window = 6
+        ua.streak_id = ua.bins[0].id
+        ua.streak_len = 6
+        self.assertEqual(ua.get_sampler().weights, [.5 * 24, 24, 6, 3, 1])
+
+    def test_samplers_agree(self):
+        weights = [96, 24, 6, 3, 1]
+        expected = [w / sum(weights) for w in weights]
+        rng = random.Random(7)
+        n = 20000
+        for name, cls in sampler.SAMPLERS.items():
+            counts = [0] * len(weights)
+            for idx in cls(weights).draw_many(n, rng):
+                counts[idx] += 1
+            for count, prob in zip(counts, expected):
+                self.assertAlmostEqual(count / n, prob, delta=.02, msg=name)
+
+    def test_preview(self):
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+        before = ua.to_dict()
+
+        albums = ua.preview(4)
+        self.assertEqual(len(albums), 4)
+        self.assertEqual(len(set(a.title for a in albums)), 4)
+        self.assertEqual(ua.to_dict(), before)
+        self.assertEqual(len(ua.preview(100)), len(generate_dummy_data()))
+
+    def test_seeded_selection_replays(self):
+        def picks(seed):
+            ua = album_selector.UpcomingAlbums(seed=seed)
+            for album in generate_dummy_data():
+                ua.add_album(album)
+            return [ua.get_next_album().title for _ in range(8)]
+
+        self.assertEqual(picks(3), picks(3))
+
+        ua = album_selector.UpcomingAlbums(rng=random.Random(3))
+        for album in generate_dummy_data():
+            ua.add_album(album)
+        preview = [album.title for album in ua.preview(8)]
+        self.assertEqual(preview, picks(3))
+        ua.sample_bin_indices(50)
+        self.assertEqual([ua.get_next_album().title for _ in range(8)],
+                         picks(3))
+
     def test_empty_ua(self):
         ua = album_selector.UpcomingAlbums()
         next = ua.get_next_album()
@@ -82,6 +181,1508 @@ class TestAlbumSelector(unittest.TestCase):
             album = ua.get_next_album()
         self.assertEqual(len(ua.bins), 0)
 
+@unittest.skipIf(importlib.util.find_spec("numpy") is None,
+                 "numpy is not installed")
+class TestSimulation(unittest.TestCase):
+
+    def test_first_pick_matches_sampler(self):
+        import simulate
+
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+        ua.streak_id = ua.bins[0].id
+        ua.streak_len = 3
+        weights = ua.get_sampler().weights
+        expected = [w / sum(weights) for w in weights]
+
+        report = simulate.Simulation(ua).run(20000, weeks=3, seed=1)
+        for bin, prob in zip(ua.bins, expected):
+            actual = report['bins'][bin.id]['first_pick']
+            self.assertAlmostEqual(actual, prob, delta=.02)
+
+    def test_drains_queue(self):
+        import simulate
+
+        ua = simulate.synthetic_queue(60, 12, seed=2)
+        report = simulate.Simulation(ua).run(500, seed=2)
+        self.assertEqual(report['weeks'], 60)
+        self.assertEqual(report['unpicked_fraction'], 0)
+        shares = [b['share_of_picks'] for b in report['bins'].values()]
+        self.assertAlmostEqual(sum(shares), 1)
+        # every album gets picked, so each submitter's share is their
+        # share of the queue
+        albums = [a for bin in ua.bins for a in bin.elements]
+        for name, values in report['submitters'].items():
+            mine = sum(a.submitted_by == name for a in albums)
+            self.assertAlmostEqual(values['share_of_picks'],
+                                   mine / len(albums))
+
+class TestHistoryLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = history_log.HistoryLog(Path(self.tmp.name) / "h.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_append_and_read(self):
+        for i in range(10):
+            self.log.append({'title': f"T{i}", 'i': i})
+
+        self.assertEqual(len(self.log), 10)
+        self.assertEqual([e['i'] for e in self.log.read(3, 6)], [3, 4, 5])
+        self.assertEqual([e['i'] for e in self.log.read(8, 20)], [8, 9])
+        self.assertEqual(len(self.log.read_all()), 10)
+        self.assertEqual(self.log.read(5, 5), [])
+
+    def test_recover_after_crash(self):
+        for i in range(3):
+            self.log.append({'i': i})
+
+        # entry written but not indexed, then a torn write
+        with open(self.log.path, 'ab') as fp:
+            fp.write(b'{"i":3}\n{"i":')
+        with open(self.log.index_path, 'ab') as fp:
+            fp.write(b'\x01\x02')
+        self.assertEqual(len(self.log), 3)
+
+        self.log.append({'i': 4})
+        self.assertEqual([e['i'] for e in self.log.read_all()], [0, 1, 2, 3, 4])
+
+        self.log.index_path.unlink()
+        self.log.recover()
+        self.assertEqual([e['i'] for e in self.log.read_all()], [0, 1, 2, 3, 4])
+
+class TestSearch(unittest.TestCase):
+
+    def make_searcher(self, local=()):
+        self.calls = []
+
+        def upstream(query):
+            self.calls.append(query)
+            return [{'title': f"{query} album {i}", 'artist': "a",
+                     'mbid': ""} for i in range(10)]
+
+        return search.Searcher(upstream, lambda: 1, lambda: list(local))
+
+    def test_cache_lru_and_ttl(self):
+        cache = search.SearchCache(max_entries=2, ttl=10)
+        cache.put("a", [1], now=0)
+        cache.put("b", [2], now=0)
+        cache.get("a", now=1)
+        cache.put("c", [3], now=1)
+        self.assertIsNone(cache.get("b", now=1))
+        self.assertEqual(cache.get("a", now=1), [1])
+        self.assertIsNone(cache.get("a", now=11))
+        self.assertEqual(len(cache), 1)
+
+    def test_related_queries_use_cache(self):
+        searcher = self.make_searcher()
+        self.assertEqual(len(searcher.search("Radio")), 5)
+        # longer and shorter queries are filtered from cached results
+        searcher.search("radio alb")
+        searcher.search("radi")
+        searcher.search("  RADIO ")
+        self.assertEqual(self.calls, ["radio"])
+        metrics = searcher.metrics()
+        self.assertEqual(metrics["related_hits"], 2)
+        self.assertEqual(metrics["cache_hits"], 1)
+        self.assertEqual(metrics["upstream_calls"], 1)
+
+        # not enough matches among cached results
+        searcher.search("radio album 1")
+        self.assertEqual(self.calls, ["radio", "radio album 1"])
+
+    def test_local_index(self):
+        local = [{'title': f"Greatest Hits {i}", 'artist': "x"}
+                 for i in range(6)]
+        local += [{'title': "Greatest Hits 3", 'artist': "x"}] * 3
+        searcher = self.make_searcher(local)
+
+        results = searcher.search("hits")
+        self.assertEqual(self.calls, [])
+        self.assertEqual(results[0]['title'], "Greatest Hits 3")
+        self.assertEqual(len(searcher.search("great")), 5)
+        self.assertEqual(searcher.metrics()["local_hits"], 2)
+
+        searcher.search("gr")
+        self.assertEqual(self.calls, [])
+        searcher.search("hits 1")
+        self.assertEqual(self.calls, ["hits 1"])
+
+    def test_upstream_slots(self):
+        local = [{'title': "Slow Songs", 'artist': "x", 'mbid': ""}]
+        started, release = threading.Event(), threading.Event()
+
+        def upstream(query):
+            started.set()
+            release.wait(5)
+            return []
+
+        searcher = search.Searcher(upstream, lambda: 1, lambda: list(local),
+                                   max_upstream=1)
+        waiting = threading.Thread(target=searcher.search, args=("slow",))
+        waiting.start()
+        self.assertTrue(started.wait(5))
+        # the only slot is taken: answered locally, without waiting
+        self.assertEqual(searcher.search("slow songs"), local)
+        release.set()
+        waiting.join()
+        self.assertEqual(searcher.metrics()["saturated"], 1)
+        self.assertEqual(searcher.metrics()["upstream_calls"], 1)
+        self.assertEqual(searcher.search("songs"), [])
+        self.assertEqual(searcher.metrics()["upstream_calls"], 2)
+
+class TestQueueStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.store = storage.QueueStore(self.path / "upcoming.db")
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_store_matches_in_memory(self):
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+            self.store.add_album(album)
+
+        self.assertEqual(self.store.load(), ua)
+
+    def test_remove_album(self):
+        for album in generate_dummy_data():
+            self.store.add_album(album)
+
+        ua = self.store.load()
+        while ua.length_queue() > 0:
+            album = ua.get_next_album()
+            self.store.remove_album(ua.streak_id, album)
+            self.store.save_state(ua)
+            self.assertEqual(self.store.load(), ua)
+        self.assertEqual(len(self.store.load().bins), 0)
+
+    def test_stats(self):
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+            self.store.add_album(album)
+
+        now = datetime(2025, 3, 1)
+        self.assertEqual(self.store.stats(now), ua.stats(now))
+        self.assertEqual(ua.stats(now)['queue_length'], 12)
+        self.assertEqual(ua.stats(now)['bin_count'], 5)
+
+        for _ in range(5):
+            album = ua.get_next_album()
+            self.store.remove_album(ua.streak_id, album)
+            self.store.save_state(ua)
+        self.assertEqual(self.store.stats(now), ua.stats(now))
+        self.assertEqual(ua.stats(now)['queue_length'], 7)
+
+    def test_json_round_trip(self):
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+        ua.save(self.path / "upcoming.json")
+
+        self.store.import_json(self.path / "upcoming.json")
+        self.store.export_json(self.path / "exported.json")
+        exported = album_selector.UpcomingAlbums.load_from_file(
+            self.path / "exported.json")
+        self.assertEqual(exported, ua)
+
+class TestCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        import codec
+
+        ua = album_selector.UpcomingAlbums()
+        for album in generate_dummy_data():
+            ua.add_album(album)
+        ua.streak_id, ua.streak_len = 2, 1
+        for fmt in codec.CODECS:
+            loaded = codec.load_queue(codec.dump_queue(ua, fmt))
+            self.assertEqual(loaded, ua)
+        self.assertEqual(codec.decode(ua.to_dict()), ua)
+        with self.assertRaises(ValueError):
+            codec.dump_queue(ua, "xml")
+
+        # fixed width, like the timestamps QueueStore writes
+        album = album_selector.Album("T", "artist", datetime(2024, 10, 1))
+        row = codec.album_to_row(album)
+        self.assertEqual(row[2], "2024-10-01T00:00:00.000000")
+        self.assertEqual(row[2], storage._ts(album.submitted_on))
+
+    def test_lazy_bins(self):
+        import codec
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        store = storage.QueueStore(Path(tmp.name) / "upcoming.db")
+        self.addCleanup(store.close)
+        for album in generate_dummy_data():
+            store.add_album(album)
+
+        ua = store.load(seed=1)
+        self.assertTrue(all(bin.rows() is not None for bin in ua.bins))
+        self.assertEqual([len(bin) for bin in ua.bins], [4, 3, 1, 2, 2])
+        # copies and the rows format leave them undecoded
+        copy = ua.copy()
+        codec.dump_queue(ua, "rows")
+        self.assertIsNotNone(copy.bins[0].rows())
+        self.assertIsNotNone(ua.bins[0].rows())
+        album = ua.get_next_album()
+        # only the bin picked from is decoded
+        self.assertEqual(len(ua.bins), 5)
+        self.assertEqual(sum(bin.rows() is None for bin in ua.bins), 1)
+        self.assertEqual(copy.get_next_album(), album)
+        self.assertFalse(hasattr(album, "__dict__"))
+
+
+class TestBulk(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.store = storage.QueueStore(self.path / "upcoming.db")
+        self.patch = mock.patch.object(helper, "BACKUP_DIR",
+                                       self.path / "backup")
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_import_matches_submissions(self):
+        import io
+        import bulk
+
+        albums = generate_dummy_data()
+        for album in albums[:3]:
+            self.store.add_album(album)
+        expected = album_selector.UpcomingAlbums()
+        for album in albums:
+            expected.add_album(album)
+
+        csv_file = io.StringIO()
+        bulk.write_records(csv_file, "csv",
+                           [album.to_dict() for album in albums[3:][::-1]])
+        csv_file.seek(0)
+        self.assertEqual(bulk.import_queue(bulk.read_albums(csv_file, "csv"),
+                                           self.store), len(albums) - 3)
+        self.assertEqual(self.store.load(), expected)
+        self.assertEqual(self.store.stats()["queue_length"], len(albums))
+
+        with self.assertRaisesRegex(ValueError, "record 2"):
+            bulk.read_albums(io.StringIO('{"title": "A"}\n{"artist": "B"}'),
+                             "jsonl")
+
+    def test_export(self):
+        import io
+        import bulk
+
+        for album in generate_dummy_data():
+            self.store.add_album(album)
+        log = history_log.HistoryLog(self.path / "history.jsonl")
+        bulk.import_history(generate_dummy_data()[:3], log)
+
+        with mock.patch.object(bulk, "EXPORT_BATCH", 2):
+            out = io.StringIO()
+            self.assertEqual(bulk.write_records(
+                out, "jsonl", bulk.history_records(log)), 3)
+        self.assertEqual(
+            [json.loads(line)["title"]
+             for line in out.getvalue().splitlines()],
+            ["A", "B", "C"])
+
+        out = io.StringIO()
+        bulk.write_records(out, "jsonl", bulk.queue_records(self.store))
+        out.seek(0)
+        self.assertEqual(bulk.read_albums(out, "jsonl"),
+                         generate_dummy_data())
+        self.assertEqual(list(self.store.iter_albums(batch=5)),
+                         generate_dummy_data())
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.store = storage.QueueStore(self.path / "upcoming.db")
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_policy(self):
+        policy = snapshots.SnapshotPolicy(every_mutations=10,
+                                          every_seconds=60, on_pick=True)
+        self.assertFalse(policy.is_due(0, 1000, pick=True))
+        self.assertTrue(policy.is_due(1, 0, pick=True))
+        self.assertFalse(policy.is_due(9, 30, pick=False))
+        self.assertTrue(policy.is_due(10, 30, pick=False))
+        self.assertTrue(policy.is_due(1, 60, pick=False))
+
+    def test_restore_from_full_and_delta(self):
+        policy = snapshots.SnapshotPolicy(every_mutations=1, full_every=5)
+        manager = snapshots.SnapshotManager(self.path / "backup", policy)
+
+        states = []
+        for album in generate_dummy_data():
+            self.store.add_album(album)
+            manager.maybe_snapshot(self.store)
+            states.append(self.store.load())
+
+        ua = self.store.load()
+        album = ua.get_next_album()
+        self.store.remove_album(ua.streak_id, album)
+        self.store.save_state(ua)
+        manager.maybe_snapshot(self.store, pick=True)
+        states.append(self.store.load())
+
+        names = [p.name for p in manager.list()]
+        self.assertEqual(len(names), len(states))
+        self.assertTrue(names[0].endswith("_full.json.gz"))
+        self.assertTrue(names[1].endswith("_delta.json.gz"))
+        for name, expected in zip(names, states):
+            self.assertEqual(manager.load(name), expected)
+
+        restored = storage.QueueStore(self.path / "restored.db")
+        manager.restore(restored)
+        self.assertEqual(restored.load(), states[-1])
+        restored.close()
+
+    def test_json_format(self):
+        # snapshots written before the rows format still load and take
+        # deltas
+        policy = snapshots.SnapshotPolicy(every_mutations=1, full_every=5)
+        manager = snapshots.SnapshotManager(self.path / "backup", policy)
+        with mock.patch.object(snapshots, "CODEC", "json"):
+            for album in generate_dummy_data()[:2]:
+                self.store.add_album(album)
+                manager.maybe_snapshot(self.store)
+        for album in generate_dummy_data()[2:]:
+            self.store.add_album(album)
+        manager.maybe_snapshot(self.store)
+        self.assertEqual(len(manager.list()), 3)
+        self.assertEqual(manager.load(), self.store.load())
+
+    def test_rotation(self):
+        policy = snapshots.SnapshotPolicy(every_mutations=1, keep_full=2,
+                                          full_every=2)
+        manager = snapshots.SnapshotManager(self.path / "backup", policy)
+        for album in generate_dummy_data():
+            self.store.add_album(album)
+            manager.maybe_snapshot(self.store)
+
+        fulls = [p for p in manager.list() if "_full" in p.name]
+        self.assertEqual(len(fulls), 2)
+        self.assertEqual(manager.list()[0], fulls[0])
+
+    def test_writers_not_blocked(self):
+        import sqlite3
+
+        manager = snapshots.SnapshotManager(self.path / "backup")
+        for album in generate_dummy_data():
+            self.store.add_album(album)
+        write_gz = snapshots._write_gz
+
+        def write_while_submitting(path, payload):
+            # another process submits while the file is being written
+            other = storage.QueueStore(self.path / "upcoming.db")
+            with mock.patch.object(sqlite3, "connect",
+                                   lambda *a, **kw: connect(*a, timeout=0.1)):
+                other.add_album(album_selector.Album(
+                    "Z", "artist", datetime(2025, 2, 3, 9, 0)))
+            other.close()
+            write_gz(path, payload)
+
+        connect = sqlite3.connect
+        with mock.patch.object(snapshots, "_write_gz",
+                               write_while_submitting):
+            path = manager.maybe_snapshot(self.store, pick=True)
+        # the snapshot holds the queue as it was read
+        self.assertEqual(manager.load(path.name).length_queue(), 12)
+        self.assertEqual(self.store.load().length_queue(), 13)
+        # the submission that raced it is still due for the next one
+        self.assertEqual(self.store.get_state('mutations') -
+                         self.store.get_state('snapshot_mutations'), 1)
+
+class TestHelperCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = Path(self.tmp.name)
+        self.patches = [
+            mock.patch.object(helper, "ALBUM_INFO_PATH",
+                              path / "album_info.json"),
+            mock.patch.object(helper, "HISTORY_PATH", path / "history.json"),
+            mock.patch.object(helper, "HISTORY_LOG_PATH",
+                              path / "history.jsonl"),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def test_current_album_cached_until_rotation(self):
+        first = album_selector.Album("A", "artist", datetime(2024, 10, 1))
+        helper.save_current_album(first)
+
+        album = helper.get_current_album()
+        self.assertEqual(album, first)
+        with mock.patch.object(helper._album_cache, "loader") as load:
+            self.assertIs(helper.get_current_album(), album)
+            load.assert_not_called()
+
+        second = album_selector.Album("B", "artist", datetime(2024, 10, 8))
+        helper.save_current_album(second)
+        self.assertEqual(helper.get_current_album(), second)
+
+    def test_history(self):
+        for i, title in enumerate(["A", "B", "C"]):
+            album = album_selector.Album(title, "artist",
+                                         chosen_on=datetime(2024, 10, i + 1))
+            helper.save_current_album(album)
+
+        history = helper.get_history()
+        self.assertIs(helper.get_history(), history)
+        self.assertEqual([a['title'] for a in history], ["A", "B", "C"])
+
+        page, next_before = helper.get_history_page(limit=2)
+        self.assertEqual([a['title'] for a in page], ["C", "B"])
+        self.assertEqual(page[0]['date'], "October 03, 2024")
+        self.assertEqual(next_before, 1)
+
+        helper.save_current_album(album_selector.Album("D", "artist"))
+        self.assertEqual(len(helper.get_history()), 4)
+
+    def test_history_migration(self):
+        history = [album_selector.Album(t, "artist").to_dict()
+                   for t in ["A", "B"]]
+        helper.write_json_atomic(helper.HISTORY_PATH, history)
+
+        self.assertEqual(helper.get_history(), history)
+        helper.save_current_album(album_selector.Album("C", "artist"))
+        self.assertEqual([a['title'] for a in helper.get_history()],
+                         ["A", "B", "C"])
+
+class TestRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        import app
+        import render_cache
+        import pages
+
+        self.tmp = tempfile.TemporaryDirectory()
+        path = Path(self.tmp.name)
+        self.patches = [
+            mock.patch.object(helper, "ALBUM_INFO_PATH",
+                              path / "album_info.json"),
+            mock.patch.object(helper, "HISTORY_PATH", path / "history.json"),
+            mock.patch.object(helper, "HISTORY_LOG_PATH",
+                              path / "history.jsonl"),
+            mock.patch.object(render_cache, "render_cache",
+                              render_cache.RenderCache(path / "rendered")),
+            mock.patch.object(pages, "render_cache",
+                              render_cache.RenderCache(path / "rendered")),
+            mock.patch.object(helper, "METRICS_DIR", path / "metrics"),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.app = app
+        self.client = app.app.test_client()
+        helper.save_current_album(album_selector.Album("A", "artist"))
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def test_conditional_get(self):
+        import pages
+
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"<i>A</i>", resp.data)
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+
+        with mock.patch.object(pages, "render") as render:
+            resp = self.client.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            resp = self.client.get("/", headers={
+                "If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 304)
+            render.assert_not_called()
+
+        helper.save_current_album(album_selector.Album("B", "artist"))
+        resp = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertIn(b"<i>B</i>", resp.data)
+
+    def test_precompressed(self):
+        import gzip
+
+        resp = self.client.get("/history",
+                               headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"artist - A", gzip.decompress(resp.data))
+        etag = resp.headers["ETag"]
+        identity = self.client.get("/history",
+                                   headers={"Accept-Encoding": "identity"})
+        self.assertNotEqual(identity.headers["ETag"], etag)
+        # a gzip tag revalidates a request for another encoding as well
+        resp = self.client.get("/history", headers={
+            "Accept-Encoding": "identity", "If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers["ETag"], identity.headers["ETag"])
+
+    def test_history_pages(self):
+        for i in range(5):
+            album = album_selector.Album(f"T{i}", "artist",
+                                         chosen_on=datetime(2024, 10, i + 1))
+            helper.save_current_album(album)
+
+        resp = self.client.get("/history.json?limit=2")
+        self.assertEqual([a['title'] for a in resp.json['albums']],
+                         ["T4", "T3"])
+        resp = self.client.get(
+            f"/history.json?limit=2&before={resp.json['next_before']}")
+        self.assertEqual([a['title'] for a in resp.json['albums']],
+                         ["T2", "T1"])
+        resp = self.client.get(
+            f"/history.json?limit=2&before={resp.json['next_before']}")
+        self.assertEqual([a['title'] for a in resp.json['albums']],
+                         ["T0", "A"])
+        self.assertIsNone(resp.json['next_before'])
+
+        resp = self.client.get("/history?before=3&limit=2")
+        body = resp.get_data(as_text=True)
+        self.assertIn("artist - T1", body)
+        self.assertIn("artist - T0", body)
+        self.assertNotIn("artist - T2", body)
+        self.assertIn("/history?before=1&amp;limit=2", body)
+
+    def test_warm(self):
+        import pages
+
+        pages.warm_render_cache()
+        with mock.patch.object(pages, "render") as render:
+            pages.render_cache._entries.clear()
+            resp = self.client.get("/")
+            self.assertIn(b"<i>A</i>", resp.data)
+            render.assert_not_called()
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, so connection reuse is visible through client_address
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        server.seen.append((url.path, parse_qs(url.query),
+                            self.client_address,
+                            self.headers.get("User-Agent")))
+        status, body = server.routes.get(url.path, [(404, b"")])[0]
+        if len(server.routes.get(url.path, [])) > 1:
+            server.routes[url.path].pop(0)
+        if status == "slow":
+            time.sleep(0.5)
+            status = 200
+        start = self.headers.get("Range", "bytes=0-")[6:-1]
+        if status == 200 and int(start):
+            status = 206
+            body = body[int(start):]
+        self.send_response(200 if status == "cut" else status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status == "cut":
+            # drop the connection half way through the body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestApiClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.routes = {}
+        self.server.seen = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_port}/"
+        self.client = api_client.Client(
+            lastfm_url=base + "lastfm/", musicbrainz_url=base + "mb/",
+            coverart_url=base + "caa/", api_key="key", timeout=(1, 0.2),
+            backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def search_body(self, titles):
+        return json.dumps({"results": {"albummatches": {"album": [
+            {"name": t, "artist": "x", "mbid": ""} for t in titles]}}}
+        ).encode()
+
+    def test_pooled_requests(self):
+        self.server.routes["/lastfm/"] = [(200, self.search_body(["OK"]))]
+        self.server.routes["/mb/release/abc"] = [(200, b'{"date": "1997"}')]
+        result = self.client.album_search("ok computer")
+        self.assertEqual(result["results"]["albummatches"]["album"][0]
+                         ["name"], "OK")
+        self.assertEqual(self.client.release("abc"), {"date": "1997"})
+
+        (path, query, first, agent), (_, mb_query, second, _) = \
+            self.server.seen
+        self.assertEqual(query["album"], ["ok computer"])
+        self.assertEqual(query["api_key"], ["key"])
+        self.assertEqual(mb_query["fmt"], ["json"])
+        self.assertEqual(agent, api_client.USER_AGENT)
+        # same keep-alive connection
+        self.assertEqual(first, second)
+
+    def test_retries_and_errors(self):
+        self.server.routes["/mb/release/abc"] = [
+            (503, b""), (503, b""), (200, b"{}")]
+        self.assertEqual(self.client.release("abc"), {})
+        self.assertEqual(len(self.server.seen), 3)
+
+        self.assertIsNone(self.client.release("missing"))
+        self.server.routes["/mb/release/slow"] = [("slow", b"{}")]
+        self.assertIsNone(self.client.release("slow"))
+        self.server.routes["/mb/release/bad"] = [(200, b"not json")]
+        self.assertIsNone(self.client.release("bad"))
+
+    def test_fetch_file(self):
+        import os
+        import hashlib
+        import metadata_cache
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        directory = Path(tmp.name)
+        self.client.cache = metadata_cache.MetadataCache(
+            directory / "cache.sqlite3")
+        image = b"\xff\xd8\xff" + os.urandom(300000)
+        url = self.client.cover_art_url("abc")
+
+        def store(download):
+            self.assertEqual(download.path.read_bytes(), image)
+            target = directory / f"{download.sha256}.jpg"
+            os.replace(download.path, target)
+            return target.name
+
+        def is_image(head):
+            return artwork.sniff(head) is not None
+
+        # cut off half way, then resumed from where it stopped
+        self.server.routes["/caa/release/abc/front"] = [
+            ("cut", image), (200, image)]
+        record = self.client.fetch_file("cover_art", "abc", url, directory,
+                                        store, is_image)
+        sha256 = hashlib.sha256(image).hexdigest()
+        self.assertEqual(record["sha256"], sha256)
+        self.assertEqual(record["size"], len(image))
+        self.assertEqual(record["stored"], f"{sha256}.jpg")
+        self.assertEqual(len(self.server.seen), 2)
+        self.assertFalse(list(directory.glob("*.part")))
+        # the record is cached, not the file
+        self.assertEqual(self.client.fetch_file(
+            "cover_art", "abc", url, directory, store, is_image), record)
+        self.assertEqual(len(self.server.seen), 2)
+
+        # not an image, or too large
+        self.server.routes["/caa/release/text/front"] = [(200, b"<html>")]
+        self.assertIsNone(self.client.fetch_file(
+            "cover_art", "text", self.client.cover_art_url("text"),
+            directory, store, is_image))
+        with mock.patch.object(api_client, "MAX_DOWNLOAD_BYTES", 1000):
+            self.assertIsNone(self.client.fetch_file(
+                "cover_art", "abc", url, directory, store, is_image,
+                refresh=True))
+        self.assertFalse(list(directory.glob(".*.part")))
+
+    def test_search_endpoint(self):
+        import app
+
+        self.server.routes["/lastfm/"] = [
+            (200, self.search_body([f"Album {i}" for i in range(8)]))]
+        searcher = search.Searcher(app.upstream_search, lambda: 1,
+                                   lambda: [])
+        with mock.patch.object(api_client, "get_client",
+                               return_value=self.client), \
+                mock.patch.object(app, "searcher", searcher), \
+                tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(helper, "METRICS_DIR", Path(tmp)):
+            resp = app.app.test_client().get("/search?title=album")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Album 4", resp.data)
+            self.assertNotIn(b"Album 5", resp.data)
+            # answered from the cache
+            app.app.test_client().get("/search?title=alb")
+        self.assertEqual(len(self.server.seen), 1)
+        self.assertEqual(searcher.metrics()["upstream_calls"], 1)
+
+    def test_failed_search_not_cached(self):
+        import app
+
+        refused = api_client.Client(lastfm_url="http://127.0.0.1:9/",
+                                    api_key="key", retries=0, backoff=0)
+        self.addCleanup(refused.close)
+        # Last.fm reports a bad key with a 200 and an error body
+        self.server.routes["/lastfm/"] = [
+            (200, b'{"error": 10, "message": "Invalid API key"}')]
+        for client in [refused, self.client]:
+            searcher = search.Searcher(app.upstream_search, lambda: 1,
+                                       lambda: [])
+            with mock.patch.object(api_client, "get_client",
+                                   return_value=client), \
+                    self.assertLogs("search", "ERROR"):
+                self.assertEqual(searcher.search("ok computer"), [])
+            self.assertEqual(len(searcher.cache), 0)
+            metrics = searcher.metrics()
+            self.assertEqual(metrics["upstream_errors"], 1)
+            self.assertEqual(metrics["upstream_calls"], 1)
+
+    def test_metadata_cache(self):
+        import metadata_cache
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.client.cache = metadata_cache.MetadataCache(
+            Path(tmp.name) / "cache.db")
+        self.server.routes["/lastfm/"] = [(200, self.search_body(["OK"]))]
+        self.server.routes["/mb/release/flaky"] = [(503, b""), (503, b""),
+                                                   (503, b""), (200, b"{}")]
+
+        first = self.client.album_search("OK  Computer")
+        self.assertEqual(self.client.album_search("ok computer"), first)
+        self.assertIsNone(self.client.release("missing"))
+        self.assertIsNone(self.client.release("missing"))
+        # errors aren't cached
+        self.assertIsNone(self.client.release("flaky"))
+        self.assertEqual(self.client.release("flaky"), {})
+        self.assertEqual([path for path, *_ in self.server.seen],
+                         ["/lastfm/", "/mb/release/missing"] +
+                         ["/mb/release/flaky"] * 4)
+
+        metrics = self.client.cache.metrics()["endpoints"]
+        self.assertEqual(metrics["album.search"]["hits"], 1)
+        self.assertEqual(metrics["release"]["negative_hits"], 1)
+
+    def test_metadata_cache_expiry_and_eviction(self):
+        import metadata_cache
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache = metadata_cache.MetadataCache(Path(tmp.name) / "cache.db",
+                                             max_bytes=100)
+        cache.put("release", "a", b"x" * 40, now=0)
+        cache.put("album.search", "b", b"{}", negative=True, now=0)
+        self.assertEqual(cache.get("album.search", "b", now=1), (True, b"{}"))
+        self.assertEqual(cache.get("album.search", "b",
+                                   now=metadata_cache.DAY + 1),
+                         (False, None))
+
+        cache.put("cover_art", "c", b"y" * 40, now=2)
+        cache.get("release", "a", now=metadata_cache.ACCESS_RESOLUTION + 3)
+        cache.put("cover_art", "d", b"z" * 40, now=4)
+        # least recently used goes first
+        self.assertEqual(cache.get("cover_art", "c", now=5), (False, None))
+        self.assertTrue(cache.get("release", "a", now=5)[0])
+        self.assertLessEqual(cache.size(), 100)
+
+        # the running total follows replacements and deletions
+        cache.put("release", "a", b"x" * 10, now=6)
+        cache.put("image", "e", None, now=6)
+        conn = cache._connection()
+        total = conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+        self.assertEqual(cache.size(), total)
+        self.assertEqual(total, 50)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+        # a cache file from before the total is summed up once
+        conn.execute("INSERT INTO entries "
+                     "VALUES ('image', 'f', ?, 0, 7, 9, 9)", (b"w" * 7,))
+        conn.execute("DROP TABLE totals")
+        reopened = metadata_cache.MetadataCache(cache.path, max_bytes=100)
+        self.assertEqual(reopened.size(), 7)
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        import load_next_album
+
+        self.tmp = tempfile.TemporaryDirectory()
+        path = Path(self.tmp.name)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.routes = {}
+        self.server.seen = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_port}/"
+        self.client = api_client.AsyncClient(api_client.Client(
+            lastfm_url=base + "lastfm/", musicbrainz_url=base + "mb/",
+            coverart_url=base + "caa/", api_key="key", timeout=(1, 2),
+            backoff=0))
+        self.patches = [
+            mock.patch.object(helper, "DIR_PATH", path),
+            mock.patch.object(artwork, "ARTWORK_DIR",
+                              path / "static" / "artwork"),
+            mock.patch.object(helper, "ALBUM_INFO_PATH",
+                              path / "album_info.json"),
+            mock.patch.object(helper, "HISTORY_PATH", path / "history.json"),
+            mock.patch.object(helper, "HISTORY_LOG_PATH",
+                              path / "history.jsonl"),
+            mock.patch.object(helper, "UPCOMING_PATH", path / "upcoming.json"),
+            mock.patch.object(helper, "UPCOMING_DB_PATH", path / "up.db"),
+            mock.patch.object(helper, "BACKUP_DIR", path / "backup"),
+            mock.patch.object(helper, "LOADER_LOCK_PATH", path / "loader"),
+            mock.patch.object(helper, "METRICS_DIR", path / "metrics"),
+            mock.patch.object(helper, "LOADER_METRICS_PATH",
+                              path / "loader.prom"),
+            mock.patch.object(api_client, "get_async_client",
+                              return_value=self.client),
+            mock.patch.object(load_next_album.pages, "warm_render_cache"),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.loader = load_next_album
+
+        start = datetime(2024, 1, 1)
+        for i in range(4):
+            helper.add_album_upcoming(album_selector.Album(
+                f"T{i}", f"a{i}", submitted_on=start + timedelta(days=i)))
+        self.server.routes["/lastfm/"] = [(200, json.dumps({
+            "results": {"albummatches": {"album": [
+                {"name": f"T{i}", "artist": f"a{i}", "mbid": f"m{i}",
+                 "image": []} for i in range(4)]}}}).encode())]
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_commits_first_resolved_candidate(self):
+        random.seed(7)
+        candidates = helper.get_next_album_candidates(3)
+        first, second, third = [int(album.artist[1:])
+                                for album, _, _ in candidates]
+        # the first candidate has no release; the second resolves slowly,
+        # with its date and artwork fetched at the same time
+        self.server.routes[f"/mb/release/m{second}"] = [
+            ("slow", b'{"date": "1999-03-01"}')]
+        self.server.routes[f"/caa/release/m{second}/front"] = [
+            ("slow", make_image("red"))]
+        for i in range(4):
+            self.server.routes.setdefault(f"/mb/release/m{i}", [
+                (200, b'{"date": "2000"}')])
+            self.server.routes.setdefault(f"/caa/release/m{i}/front", [
+                (200, make_image("blue"))])
+        del self.server.routes[f"/mb/release/m{first}"]
+
+        random.seed(7)
+        with mock.patch.object(self.loader, "CANDIDATES", 3):
+            start = time.perf_counter()
+            self.loader.main()
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 0.9)
+
+        current = helper.get_current_album()
+        self.assertEqual(current.title, f"T{second}")
+        self.assertEqual(current.date, "1999")
+        self.assertEqual(current.image, artwork.save(make_image("red")))
+        self.assertTrue((helper.DIR_PATH / current.image).is_file())
+        # the failed candidate is dropped with it; the rest stay queued
+        upcoming = helper.load_upcoming_albums()
+        titles = [a.title for bin in upcoming.bins for a in bin.elements]
+        self.assertEqual(sorted(titles),
+                         sorted(f"T{i}" for i in range(4)
+                                if i not in (first, second)))
+        self.assertEqual(upcoming.streak_id, candidates[1][1])
+        self.assertEqual(upcoming.streak_len, candidates[1][2])
+
+        summary = helper.LOADER_METRICS_PATH.read_text().splitlines()
+        self.assertIn("aotw_loader_success 1", summary)
+        self.assertIn("aotw_queue_length 2", summary)
+        self.assertTrue(any(line.startswith(
+            'aotw_resolve_stage_seconds_count{stage="save"} ')
+            for line in summary))
+
+    def test_commit_detects_changed_queue(self):
+        candidates = helper.get_next_album_candidates(2)
+        album, bin_id, _ = candidates[0]
+        helper.get_queue_store().remove_album(bin_id, album)
+        self.assertFalse(helper.commit_next_album(candidates, 1))
+        self.assertEqual(helper.load_upcoming_albums().length_queue(), 3)
+        self.assertTrue(helper.commit_next_album(candidates[1:], 0))
+        self.assertEqual(helper.load_upcoming_albums().length_queue(), 2)
+
+    def test_enrichment(self):
+        import app
+        import enrich
+        import storage
+
+        self.server.routes["/mb/release/m3"] = [(200, b'{"date": "2001"}')]
+        self.server.routes["/caa/release/m3/front"] = [
+            (200, make_image("green"))]
+        store = helper.get_queue_store()
+        seqs = store.pending_enrichment()
+        self.assertEqual(len(seqs), 4)
+
+        self.assertTrue(enrich.enrich(seqs[3]))
+        album, status = store.get_album(seqs[3])
+        self.assertEqual(status, storage.ENRICH_DONE)
+        self.assertEqual((album.mbid, album.date), ("m3", "2001"))
+        self.assertTrue(helper.is_enriched(album))
+
+        # no artwork for the rest; they are retried up to the limit
+        for _ in range(2):
+            self.assertEqual(enrich.sweep(), (0, 3))
+        self.assertEqual(len(store.pending_enrichment()), 3)
+        self.assertFalse(enrich.enrich(seqs[0], max_attempts=3))
+        self.assertEqual(len(store.pending_enrichment()), 2)
+
+        with mock.patch.object(enrich.enricher, "submit") as submit:
+            app.app.test_client().post("/submit", data={"title": "T4 (a4)"})
+        submit.assert_called_once_with(seqs[3] + 1)
+
+        # rotation uses the stored metadata without going upstream
+        seen = len(self.server.seen)
+        with mock.patch.object(self.loader, "PREFER_ENRICHED", True):
+            self.loader.main()
+        self.assertEqual(len(self.server.seen), seen)
+        current = helper.get_current_album()
+        self.assertEqual((current.title, current.mbid, current.date),
+                         ("T3", "m3", "2001"))
+        self.assertEqual(helper.load_upcoming_albums().length_queue(), 4)
+
+class TestArtwork(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patches = [
+            mock.patch.object(helper, "DIR_PATH", Path(self.tmp.name)),
+            mock.patch.object(artwork, "ARTWORK_DIR",
+                              Path(self.tmp.name) / "static" / "artwork"),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    @unittest.skipIf(artwork.Image is None, "Pillow not installed")
+    def test_variants(self):
+        data = make_image("red", width=1600, height=1000)
+        path = artwork.save(data)
+        self.assertRegex(path, r"^static/artwork/[0-9a-f]{32}-600\.jpg$")
+        self.assertEqual(artwork.save(data), path)
+
+        widths = sorted({w for w, _, _ in artwork.variants(
+            artwork.ARTWORK_DIR, Path(path).name[:32])})
+        self.assertEqual(widths, [150, 300, 600, 1200])
+        sets = artwork.srcset(path)
+        self.assertIn("-300.webp 300w", sets["webp"])
+        self.assertIn("-1200.jpg 1200w", sets["jpg"])
+
+        # small originals aren't scaled up
+        small = artwork.save(make_image("blue", width=200, height=200))
+        self.assertTrue(small.endswith("-200.jpg"))
+        self.assertIsNone(artwork.srcset("static/images/Old Title.jpg"))
+
+    def test_without_pillow(self):
+        with mock.patch.object(artwork, "Image", None):
+            path = artwork.save(b"\x89PNG\r\n\x1a\n" + b"0" * 32)
+        self.assertTrue(path.endswith(".png"))
+        self.assertIsNone(artwork.srcset(path))
+        with self.assertRaises(ValueError):
+            artwork.save(b"<html>not found</html>")
+
+    def test_cache_headers(self):
+        import app
+
+        with app.app.test_request_context("/static/artwork/x-600.jpg"):
+            response = app.artwork_cache_headers(app.app.response_class("x"))
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", response.headers["Cache-Control"])
+
+
+class TestConcurrentWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = Path(self.tmp.name)
+        self.patches = [
+            mock.patch.object(helper, "ALBUM_INFO_PATH",
+                              path / "album_info.json"),
+            mock.patch.object(helper, "HISTORY_PATH", path / "history.json"),
+            mock.patch.object(helper, "HISTORY_LOG_PATH",
+                              path / "history.jsonl"),
+            mock.patch.object(helper, "UPCOMING_PATH", path / "upcoming.json"),
+            mock.patch.object(helper, "UPCOMING_DB_PATH", path / "up.db"),
+            mock.patch.object(helper, "BACKUP_DIR", path / "backup"),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def run_writers(self, target, workers: int = 8, n: int = 25):
+        import multiprocessing
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=target, args=(worker, n))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        return {f"w{worker}-{i}" for worker in range(workers)
+                for i in range(n)}
+
+    def test_submissions(self):
+        def submit(worker, n):
+            for i in range(n):
+                helper.add_album_upcoming(album_selector.Album(
+                    f"w{worker}-{i}", "artist", datetime.now(), f"ip{worker}"))
+
+        expected = self.run_writers(submit)
+        upcoming = helper.load_upcoming_albums()
+        titles = [a.title for bin in upcoming.bins for a in bin.elements]
+        self.assertEqual(len(titles), len(expected))
+        self.assertEqual(set(titles), expected)
+
+    def test_rotations(self):
+        def rotate(worker, n):
+            for i in range(n):
+                helper.save_current_album(album_selector.Album(
+                    f"w{worker}-{i}", "artist", chosen_on=datetime.now()))
+
+        expected = self.run_writers(rotate, n=10)
+        history = helper.get_history_log().read_all()
+        self.assertEqual(len(history), len(expected))
+        self.assertEqual({entry["title"] for entry in history}, expected)
+        # the current album is the last one written to history
+        self.assertEqual(helper.get_current_album().title,
+                         history[-1]["title"])
+        self.assertEqual(list(Path(self.tmp.name).glob("*.tmp")), [])
+
+    def test_atomic_file_and_lock(self):
+        import safe_io
+
+        path = Path(self.tmp.name) / "file.json"
+        safe_io.write_json_atomic(path, {"a": 1})
+        with self.assertRaises(TypeError):
+            safe_io.write_json_atomic(path, {"a": object()})
+        self.assertEqual(json.loads(path.read_text()), {"a": 1})
+        self.assertEqual(list(path.parent.glob("*.tmp")), [])
+
+        if safe_io.fcntl is not None:
+            with safe_io.file_lock(path):
+                with self.assertRaises(BlockingIOError):
+                    with safe_io.file_lock(path, blocking=False):
+                        pass
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.store = storage.QueueStore(self.path / "up.db")
+        self.directory = self.path / "submissions"
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_group_commit(self):
+        import write_behind
+
+        stored = []
+        queue = write_behind.SubmissionQueue(
+            lambda: self.store, self.directory, interval=60,
+            max_batch=20).start()
+
+        def submit(worker):
+            for i in range(10):
+                queue.submit(album_selector.Album(f"w{worker}-{i}", "a"),
+                             on_stored=stored.append)
+
+        threads = [threading.Thread(target=submit, args=(worker,))
+                   for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(queue.path.read_bytes().splitlines()), 80)
+
+        queue.close()
+        self.assertEqual(self.store.stats()["queue_length"], 80)
+        self.assertEqual(sorted(stored), list(range(1, 81)))
+        metrics = queue.metrics()
+        self.assertEqual(metrics["stored"], 80)
+        # stored as soon as 20 are waiting, with whatever arrived meanwhile
+        self.assertLessEqual(metrics["flushes"], 4)
+        self.assertIsNotNone(metrics["submit_p99_seconds"])
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_replay(self):
+        import write_behind
+
+        # a worker that died after storing the first of three submissions
+        self.directory.mkdir()
+        log = self.directory / "1-1.jsonl"
+        albums = [album_selector.Album(f"T{i}", "a") for i in range(3)]
+        log.write_bytes(b"".join(
+            json.dumps(album.to_dict()).encode() + b"\n" for album in albums) +
+            b'{"title": "torn')
+        self.store.add_albums(albums[:1], log.name, 1)
+
+        queue = write_behind.SubmissionQueue(lambda: self.store,
+                                             self.directory).start()
+        # a live process's log is left alone
+        self.assertEqual(write_behind.replay(self.store, self.directory), 0)
+        self.assertTrue(queue.path.is_file())
+        queue.close()
+
+        titles = [a.title for bin in self.store.load().bins
+                  for a in bin.elements]
+        self.assertEqual(sorted(titles), ["T0", "T1", "T2"])
+        self.assertFalse(log.exists())
+        self.assertEqual(self.store.intents_applied(log.name), 0)
+
+
+class TestBench(unittest.TestCase):
+
+    def test_synthetic_albums(self):
+        import bench
+
+        for distribution in bench.DISTRIBUTIONS:
+            albums = bench.synthetic_albums(500, distribution)
+            self.assertEqual(len(albums), 500)
+            upcoming = bench.build_queue(albums)
+            self.assertEqual(sum(len(bin) for bin in upcoming.bins), 500)
+        self.assertEqual(
+            len(bench.build_queue(bench.synthetic_albums(50, "sparse")).bins),
+            50)
+        self.assertEqual(
+            len(bench.build_queue(bench.synthetic_albums(50, "burst")).bins), 1)
+
+    def test_run_and_compare(self):
+        import bench
+
+        results = bench.run_benchmarks([10], ["uniform"],
+                                       ["add_album", "store_load", "GET /"],
+                                       repeat=1)
+        self.assertEqual(sorted(results), ["GET /[10,uniform]",
+                                           "add_album[10,uniform]",
+                                           "store_load[10,uniform]"])
+        self.assertEqual(bench.compare(results, results), [])
+        faster = {key: {**result, "median": result["median"] / 10}
+                  for key, result in results.items()}
+        regressions = [key for key, _, _ in bench.compare(results, faster)]
+        # sub-microsecond timings are never flagged, so add_album may not be
+        self.assertIn("GET /[10,uniform]", regressions)
+        self.assertIn("store_load[10,uniform]", regressions)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_render_and_timer(self):
+        import asyncio
+        import metrics
+
+        registry = metrics.Registry()
+        calls = registry.counter("calls_total", "Calls", ["kind"])
+        seconds = registry.histogram("seconds", "Time", ["stage"],
+                                     buckets=(.1, 1))
+
+        @seconds.time(stage="sync")
+        def work():
+            calls.inc(kind='a "quoted"\nvalue')
+
+        @seconds.time(stage="async")
+        async def awork():
+            await asyncio.sleep(0)
+
+        work()
+        asyncio.run(awork())
+        with self.assertRaises(KeyError):
+            with seconds.time(stage="failed"):
+                raise KeyError()
+        seconds.observe(5, stage="sync")
+
+        text = registry.render(registry.snapshot(),
+                               [("depth", "Depth", 3), ("none", "x", None)])
+        lines = text.splitlines()
+        self.assertIn('calls_total{kind="a \\"quoted\\"\\nvalue"} 1',
+                      lines)
+        self.assertIn("# TYPE seconds histogram", lines)
+        self.assertIn('seconds_bucket{stage="sync",le="0.1"} 1', lines)
+        self.assertIn('seconds_bucket{stage="sync",le="+Inf"} 2', lines)
+        self.assertIn('seconds_count{stage="async"} 1', lines)
+        self.assertIn('seconds_count{stage="failed"} 1', lines)
+        self.assertIn("depth 3", lines)
+        self.assertNotIn("none", text)
+
+    def test_workers_merged(self):
+        import multiprocessing
+        import metrics
+
+        registry = metrics.Registry()
+        calls = registry.counter("calls_total", "Calls")
+        seconds = registry.histogram("seconds", "Time", buckets=(1,))
+        calls.inc()
+
+        def worker():
+            # a forked worker starts from zero
+            calls.inc(2)
+            seconds.observe(0.5)
+            registry.flush(self.path)
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=worker) for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+
+        for _ in range(2):
+            values = registry.collect(self.path)
+            self.assertEqual(values["calls_total"][()], 7)
+            self.assertEqual(values["seconds"][()], [3, 0, 1.5])
+        # the exited workers' files were folded into the archive
+        self.assertEqual(sorted(p.name for p in self.path.glob("*.json")),
+                         sorted([metrics.ARCHIVE, registry.process_file()]))
+
+    def test_endpoint(self):
+        import app
+        import render_cache
+        import pages
+
+        patches = [
+            mock.patch.object(helper, "ALBUM_INFO_PATH",
+                              self.path / "album_info.json"),
+            mock.patch.object(helper, "HISTORY_PATH",
+                              self.path / "history.json"),
+            mock.patch.object(helper, "HISTORY_LOG_PATH",
+                              self.path / "history.jsonl"),
+            mock.patch.object(helper, "UPCOMING_DB_PATH", self.path / "up.db"),
+            mock.patch.object(helper, "BACKUP_DIR", self.path / "backup"),
+            mock.patch.object(helper, "METRICS_DIR", self.path / "metrics"),
+            mock.patch.object(pages, "render_cache",
+                              render_cache.RenderCache(self.path / "rendered")),
+        ]
+        for patch in patches:
+            patch.start()
+        self.addCleanup(lambda: [patch.stop() for patch in patches])
+
+        helper.save_current_album(album_selector.Album("A", "artist"))
+        for album in generate_dummy_data()[:3]:
+            helper.add_album_upcoming(album)
+        client = app.app.test_client()
+        client.get("/")
+        resp = client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertIn("aotw_queue_length 3", lines)
+        self.assertIn("aotw_queue_bins 1", lines)
+        self.assertIn("aotw_history_length 1", lines)
+        self.assertTrue(any(line.startswith(
+            'aotw_request_seconds_count{endpoint="index"} ')
+            for line in lines))
+
+
+class TestPreload(unittest.TestCase):
+
+    def test_forked_worker(self):
+        import os
+        import app
+        import render_cache
+        import pages
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name)
+        rendered = render_cache.RenderCache(path / "rendered")
+        patches = [
+            mock.patch.object(helper, "ALBUM_INFO_PATH",
+                              path / "album_info.json"),
+            mock.patch.object(helper, "HISTORY_PATH", path / "history.json"),
+            mock.patch.object(helper, "HISTORY_LOG_PATH",
+                              path / "history.jsonl"),
+            mock.patch.object(helper, "UPCOMING_DB_PATH", path / "up.db"),
+            mock.patch.object(helper, "BACKUP_DIR", path / "backup"),
+            mock.patch.object(helper, "METRICS_DIR", path / "metrics"),
+            mock.patch.object(pages, "render_cache", rendered),
+            mock.patch.object(app.gc, "freeze"),
+        ]
+        for patch in patches:
+            patch.start()
+        self.addCleanup(lambda: [patch.stop() for patch in patches])
+
+        helper.save_current_album(album_selector.Album("A", "artist"))
+        for album in generate_dummy_data():
+            helper.add_album_upcoming(album)
+        app.preload()
+        app.gc.freeze.assert_called_once_with()
+        # rendered before any request, and no connection left to inherit
+        self.assertIn("index", rendered._entries)
+        self.assertIsNone(helper.get_queue_store()._local.conn)
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                app.after_fork()
+                with mock.patch.object(pages, "render") as render:
+                    resp = app.app.test_client().get("/")
+                    if resp.status_code == 200 and b"<i>A</i>" in resp.data \
+                            and not render.called:
+                        code = 0
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+
+class TestLogConfig(unittest.TestCase):
+
+    def setUp(self):
+        import logging
+        import log_config
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        root = logging.getLogger()
+        saved = root.handlers[:], root.level
+        self.patches = [
+            mock.patch.object(log_config, "LOG_DIR", self.path),
+            mock.patch.object(log_config, "LOG_MAX_BYTES", 4096),
+            mock.patch.object(log_config, "LOG_BACKUPS", 100),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        def restore():
+            log_config.stop()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            for handler in saved[0]:
+                root.addHandler(handler)
+            root.setLevel(saved[1])
+        self.addCleanup(restore)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def test_formatted_by_listener(self):
+        import logging
+        import log_config
+
+        threads = []
+
+        class Arg():
+            def __str__(self):
+                threads.append(threading.current_thread())
+                return "arg"
+
+        listener = log_config.configure("app.log", level="info")
+        listener_thread = listener._thread
+        logger = logging.getLogger("test")
+        logger.debug("hidden %s", Arg())
+        logger.info("shown %s", Arg())
+        log_config.stop()
+
+        # only the shown message, and only on the listener's thread
+        self.assertEqual(set(threads), {listener_thread})
+        text = (self.path / "app.log").read_text()
+        self.assertIn("INFO test: shown arg", text)
+        self.assertNotIn("hidden", text)
+
+    def test_processes_share_rotated_file(self):
+        import logging
+        import multiprocessing
+        import log_config
+
+        def worker(n):
+            log_config.configure("app.log")
+            for i in range(300):
+                logging.getLogger("test").info("worker %d line %d", n, i)
+            log_config.stop()
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=worker, args=(n,))
+                     for n in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+
+        files = list(self.path.glob("app.log*"))
+        self.assertGreater(len(files), 2)
+        lines = [line for path in files
+                 for line in path.read_text().splitlines()]
+        self.assertEqual(len(lines), 1200)
+        self.assertEqual(len(set(line.split(": ", 1)[1] for line in lines)),
+                         1200)
+        # a file can grow by what other processes write while one rotates
+        self.assertTrue(all(path.stat().st_size < 2 * 4096 for path in files))
+
+
+def make_image(color: str, width: int = 400, height: int = 400) -> bytes:
+    import io
+
+    if artwork.Image is None:
+        # enough for artwork.save without Pillow
+        return b"\xff\xd8\xff\xe0" + color.encode()
+    out = io.BytesIO()
+    artwork.Image.new("RGB", (width, height), color).save(out, "JPEG")
+    return out.getvalue()
+
+
 def generate_dummy_data() -> list[album_selector.Album]:
     return [
         album_selector.Album("A", "artist", datetime(2024, 10, 1, 8, 0), 'ip1'),
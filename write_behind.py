@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+
+from pathlib import Path
+from collections import deque
+from contextlib import ExitStack
+
+from album_selector import Album
+from safe_io import file_lock, fsync_dir, lock_path
+
+logger = logging.getLogger(__name__)
+
+# store submissions from a background thread in batches instead of on the
+# request
+WRITE_BEHIND = os.environ.get("AOTW_WRITE_BEHIND", "0") != "0"
+# longest a submission waits before it is stored, and the number waiting
+# that is stored right away
+FLUSH_INTERVAL = float(os.environ.get("AOTW_FLUSH_INTERVAL_MS", 50)) / 1000
+FLUSH_BATCH = int(os.environ.get("AOTW_FLUSH_BATCH", 64))
+# recent submit latencies and batches kept for the metrics
+SAMPLES = 1024
+SUFFIX = ".jsonl"
+
+
+def percentile(samples: list[float], q: float) -> float | None:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def read_intents(path: Path) -> list[Album]:
+    # a torn last line was never acknowledged, so it is dropped
+    with open(path, 'rb') as fp:
+        lines = fp.read().split(b"\n")[:-1]
+    return [Album.load_from_dict(json.loads(line)) for line in lines]
+
+
+def replay(store, directory: Path, skip: str = None) -> int:
+    # Store what is left in the intent logs of processes that are gone
+    # (their lock is free) and delete the logs. Entries a process already
+    # stored are skipped, so nothing is added twice. Returns the number of
+    # albums added.
+    if not directory.is_dir():
+        return 0
+    added = 0
+    for path in sorted(directory.glob(f"*{SUFFIX}")):
+        if path.name == skip:
+            continue
+        try:
+            with file_lock(path, blocking=False):
+                if not path.is_file():
+                    # replayed by another process in the meantime
+                    continue
+                albums = read_intents(path)
+                applied = store.intents_applied(path.name)
+                store.add_albums(albums[applied:], path.name, len(albums))
+                path.unlink()
+                fsync_dir(directory)
+                store.forget_intents(path.name)
+                lock_path(path).unlink(missing_ok=True)
+                added += max(len(albums) - applied, 0)
+        except BlockingIOError:
+            # its process is still running
+            continue
+        except ValueError:
+            logger.exception("Can't replay %s", path)
+    if added:
+        logger.info("Replayed %d submissions from %s", added, directory)
+    return added
+
+
+class SubmissionQueue():
+    # Write-behind for submissions. submit() appends the album to this
+    # process's intent log, fsyncs it and returns; a flusher thread stores
+    # everything pending in one transaction (group commit) once the oldest
+    # entry has waited `interval` seconds or `max_batch` are waiting. The
+    # store records how much of the log each batch covers, in the same
+    # transaction, and logs left behind by a crash are replayed by the next
+    # process to start.
+    def __init__(self, get_store, directory: str | Path,
+                 interval: float = FLUSH_INTERVAL,
+                 max_batch: int = FLUSH_BATCH, on_flush=None):
+        # get_store() -> the QueueStore; on_flush(seqs) runs after each batch
+        self.get_store = get_store
+        self.directory = Path(directory)
+        self.interval = interval
+        self.max_batch = max_batch
+        self.on_flush = on_flush
+        self.pid = os.getpid()
+        self.name = f"{self.pid}-{time.time_ns()}{SUFFIX}"
+        self.path = self.directory / self.name
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # (intent log line, album, on_stored)
+        self._pending = []
+        self._since = None
+        self._lines = 0
+        self._synced = 0
+        self._closed = False
+        self._fp = None
+        self._thread = None
+        self._hold = ExitStack()
+
+        self.counters = {
+            "submitted": 0,
+            "stored": 0,
+            "flushes": 0,
+            "flush_errors": 0,
+        }
+        self.latencies = deque(maxlen=SAMPLES)
+        # (size, seconds)
+        self.batches = deque(maxlen=SAMPLES)
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # held while the process lives, so replay() leaves the log alone
+        self._hold.enter_context(file_lock(self.path))
+        self._fp = open(self.path, 'ab')
+        fsync_dir(self.directory)
+        replay(self.get_store(), self.directory, skip=self.name)
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="write-behind")
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def submit(self, album: Album, on_stored=None):
+        # Returns once the album is durable in the intent log.
+        # on_stored(seq) is called from the flusher after it is stored.
+        start = time.perf_counter()
+        line = json.dumps(album.to_dict(), separators=(',', ':')).encode()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("submission queue is closed")
+            self._fp.write(line + b"\n")
+            self._fp.flush()
+            self._lines += 1
+            written = self._lines
+            self._pending.append((written, album, on_stored))
+            if self._since is None:
+                self._since = time.monotonic()
+            self._cond.notify()
+
+        # one fsync covers every submission written before it
+        with self._sync_lock:
+            if self._synced < written:
+                target = self._lines
+                os.fsync(self._fp.fileno())
+                self._synced = target
+
+        with self._cond:
+            self.counters["submitted"] += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    # close() stores the rest
+                    return
+                while len(self._pending) < self.max_batch:
+                    remaining = self._since + self.interval - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush(self) -> int:
+        # store everything pending now; returns the number stored
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                self._since = None
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                seqs = self.get_store().add_albums(
+                    [album for _, album, _ in batch], self.name, batch[-1][0])
+            except Exception:
+                logger.exception("Storing %d submissions failed", len(batch))
+                with self._cond:
+                    self._pending[:0] = batch
+                    self._since = time.monotonic()
+                    self.counters["flush_errors"] += 1
+                return 0
+            with self._cond:
+                self.counters["flushes"] += 1
+                self.counters["stored"] += len(batch)
+                self.batches.append((len(batch), time.perf_counter() - start))
+
+        if self.on_flush is not None:
+            self._call(self.on_flush, seqs)
+        for (_, _, on_stored), seq in zip(batch, seqs):
+            if on_stored is not None:
+                self._call(on_stored, seq)
+        return len(batch)
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Submission callback %r failed", func)
+
+    def close(self):
+        # store what is pending and remove the intent log
+        if os.getpid() != self.pid:
+            return
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._fp is not None:
+            self._fp.close()
+            if not self._pending:
+                self.path.unlink(missing_ok=True)
+                self.get_store().forget_intents(self.name)
+                lock_path(self.path).unlink(missing_ok=True)
+        self._hold.close()
+
+    def metrics(self) -> dict:
+        with self._cond:
+            counters = dict(self.counters)
+            pending = len(self._pending)
+            latencies = list(self.latencies)
+            batches = list(self.batches)
+        sizes = [size for size, _ in batches]
+        return {
+            **counters,
+            "pending": pending,
+            "submit_p50_seconds": percentile(latencies, 0.5),
+            "submit_p99_seconds": percentile(latencies, 0.99),
+            "batch_mean": sum(sizes) / len(sizes) if sizes else None,
+            "batch_max": max(sizes, default=None),
+            "flush_p99_seconds": percentile(
+                [seconds for _, seconds in batches], 0.99),
+        }
@@ -1,3 +1,9 @@
+import os
+
+import log_config
+# a file in logs/, or stderr (gunicorn's error log) when set to ""
+log_config.configure(os.environ.get("AOTW_WEB_LOG", "app.log") or None)
+
 from app import app
 if __name__ =='__main__':
-    app.run()
\ No newline at end of file
+    app.run()